@@ -1,12 +1,15 @@
 # Importing necessary libraries
 import random
+from collections import namedtuple
 from mesa import Agent
 from shapely.geometry import Point
-from shapely import contains_xy
 #from model import AdaptationModel
 
 # Import functions from functions.py
-from functions import generate_random_location_within_map_domain, get_flood_depth, calculate_basic_flood_damage, floodplain_multipolygon
+from functions import calculate_basic_flood_damage
+
+# Import the descriptor for household attributes stored in arrays
+from household_state import StateColumn, TrackedStateColumn
 
 # Define the Households agent class
 class Households(Agent):
@@ -16,9 +19,26 @@ class Households(Agent):
     In a real scenario, this would be based on actual geographical data or more complex logic.
     """
 
-    def __init__(self, unique_id, model, political_situation, welfare):
+    # attributes stored in the arrays of the model's household_state, see household_state.py
+    flood_depth_estimated = StateColumn()
+    flood_depth_actual = StateColumn()
+    sandbags_placed = StateColumn()
+    flood_damage_estimated = StateColumn()
+    household_attitude = StateColumn()
+    insurance_taken_by_household = StateColumn()
+    # the model keeps the sums of these attributes over all households up to date, see AdaptationModel.aggregate
+    flood_damage_actual = TrackedStateColumn()
+    is_adapted = TrackedStateColumn()
+    political_perception = TrackedStateColumn()
+
+    def __init__(self, unique_id, model, political_situation, welfare, node):
         super().__init__(unique_id, model)
 
+        # node of the household in the social network, also its index in the household_state arrays
+        self.node = node
+        self.state_columns = model.household_state.columns
+        self.state_sums = model.household_state.sums
+
         #import all functions of the model to be able to use them in Government
         self.main_model = model
 
@@ -37,24 +57,25 @@ class Households(Agent):
         # initialise for all households in a way that they do not have an insurance first
         self.insurance_taken_by_household = 0
 
+        # the location, house value and estimated flood depth of the household are part of the model world,
+        # see world.py. The world is indexed by the node of the household in the social network
+        world = model.world
+
         # determine value of house to convert flood damages to monetary damages
-        self.value_house = random.randrange(200, 1500, 1) * 1000
+        self.value_house = int(world.value_house[node])
 
         # getting flood map values
         # Get a random location on the map
-        loc_x, loc_y = generate_random_location_within_map_domain()
-        self.location = Point(loc_x, loc_y)
+        self.location = Point(world.x[node], world.y[node])
 
         # Check whether the location is within floodplain
         # Where is this used?
-        self.in_floodplain = False
-        if contains_xy(geom=floodplain_multipolygon, x=self.location.x, y=self.location.y):
-            self.in_floodplain = True
+        self.in_floodplain = bool(world.in_floodplain[node])
 
         # Get the estimated flood depth at those coordinates. 
         # the estimated flood depth is calculated based on the flood map (i.e., past data) so this is not the actual flood depth
         # Flood depth can be negative if the location is at a high elevation
-        self.flood_depth_estimated = get_flood_depth(corresponding_map=model.flood_map, location=self.location, band=model.band_flood_img)
+        self.flood_depth_estimated = float(world.flood_depth_estimated[node])
         # handle negative values of flood depth
         if self.flood_depth_estimated < 0:
             self.flood_depth_estimated = 0
@@ -64,7 +85,8 @@ class Households(Agent):
         self.flood_damage_estimated = calculate_basic_flood_damage(flood_depth=self.flood_depth_estimated, sandbags_household=self.sandbags_placed,
                                                                    waterboard_adaptation=0,
                                                                    warning_system_government=0,
-                                                                   infrastructure=0) + random.randrange(-10, 10, 1)/100
+                                                                   infrastructure=0,
+                                                                   damage_curve=model.damage_curve) + random.randrange(-10, 10, 1)/100
 
         #compute estimated monetary flood damages
         #damages are lowered by 70% if insurance is taken
@@ -81,7 +103,8 @@ class Households(Agent):
         self.flood_damage_actual = calculate_basic_flood_damage(flood_depth=self.flood_depth_actual, sandbags_household=self.sandbags_placed,
                                                                    waterboard_adaptation=0,
                                                                    warning_system_government=0,
-                                                                   infrastructure=0)
+                                                                   infrastructure=0,
+                                                                   damage_curve=model.damage_curve)
 
         #compute actual monetary flood damages
         #damages are lowered by 70% if insurance is taken
@@ -126,37 +149,24 @@ class Households(Agent):
         #compute new value for political perception based upon own political peeception and the average political perception of neighbours
         self.political_perception = 0.3*self.political_perception + 0.7*self.average_political_perception_neighbours
 
-    def advance(self):
-        #compute the waterboard adapatation, warning system government and infrastructure values to use these for
-        #determining the estimated flood damages. We use all variable values here that have just been updated in the
-        #step function of every agent. Since households perform their 'advance' function first,
-        #we have to redetermine the values of all other agents here by calling their respective functions. These functions
-        #will later be called by the respective agents themselves as well, to be stored in these agents
-        self.advance_waterboard_adaptation = self.main_model.waterboard.determine_waterboard_adaptation(
-            (self.main_model.policy_maker.determine_provide_information(self.main_model.policy_maker.provide_information,
-                                                                           self.main_model.government.government_budget,
-                                                                           self.main_model.government.political_perception_government,
-                                                                           self.main_model.waterboard.waterboard_attitude,
-                                                                           self.main_model.protest)),
-            (self.main_model.policy_maker.determine_regulation(self.main_model.policy_maker.regulation,
-                                                                      self.main_model.government.government_budget,
-                                                                      self.main_model.government.political_perception_government,
-                                                                      self.main_model.waterboard.waterboard_attitude,
-                                                                      self.main_model.protest)),
-            self.main_model.waterboard.waterboard_attitude)
-
-        self.advance_warning_system_government=(self.main_model.government.determine_government_warning_system(self.main_model.policy_maker.provide_information,
-                                                                                                               self.main_model.policy_maker.regulation))
-
-        self.advance_infrastructure=(self.main_model.policy_maker.determine_infrastructure_government(self.main_model.policy_maker.infrastructure_government,
-                                                                                                    self.main_model.government.government_budget,
-                                                                                                    self.main_model.government.political_perception_government,
-                                                                                                    self.main_model.waterboard.waterboard_attitude))
+    def advance(self, noise=None):
+        #the waterboard adapatation, warning system government and infrastructure values used for determining the
+        #estimated flood damages are the same for all households. The model determines them once per step,
+        #see HouseholdContext
+        context = self.main_model.household_context()
+        self.advance_waterboard_adaptation = context.waterboard_adaptation
+        self.advance_warning_system_government = context.warning_system_government
+        self.advance_infrastructure = context.infrastructure
+
+        # uncertainty of the estimated flood damage in percent, drawn here unless the caller drew it (see change_tracking.py)
+        if noise is None:
+            noise = random.randrange(-10, 10, 1)
 
         # calculate the estimated flood damage given the actual flood depth. Flood damage is a factor between 0 and 1
-        self.flood_damage_estimated = calculate_basic_flood_damage(flood_depth=self.flood_depth_actual, sandbags_household=self.sandbags_placed,
+        self.expected_flood_damage = calculate_basic_flood_damage(flood_depth=self.flood_depth_actual, sandbags_household=self.sandbags_placed,
                                                                 waterboard_adaptation=self.advance_waterboard_adaptation, warning_system_government=self.advance_warning_system_government,
-                                                                infrastructure=self.advance_infrastructure) + + random.randrange(-10, 10, 1)/100
+                                                                infrastructure=self.advance_infrastructure, damage_curve=self.main_model.damage_curve)
+        self.flood_damage_estimated = self.expected_flood_damage + noise/100
 
         #insurance willingness
         #insurance media activity
@@ -164,10 +174,10 @@ class Households(Agent):
         self.insurance_company_media_platform_usage = self.main_model.insurance_company.media_platform_usage
 
         #determine if this household takes an insurance of this time period
-        self.insurance_taken_by_household = (0.3*self.main_model.policy_maker.subsidies + 0.3*self.insurance_willingness +
-                                             0.3*self.insurance_company_media_platform_usage + 0.5*self.main_model.policy_maker.infrastructure_government +
-                                             0.1*self.savings_household/1000 + 0.3*self.household_attitude)
-        if self.insurance_taken_by_household < 1.5:
+        insurance_taken_by_household = (0.3*self.main_model.policy_maker.subsidies + 0.3*self.insurance_willingness +
+                                        0.3*self.insurance_company_media_platform_usage + 0.5*self.main_model.policy_maker.infrastructure_government +
+                                        0.1*self.savings_household/1000 + 0.3*self.household_attitude)
+        if insurance_taken_by_household < 1.5:
             self.insurance_taken_by_household = 0
         else:
             self.insurance_taken_by_household = 1
@@ -193,6 +203,63 @@ class Households(Agent):
         else:
             self.is_adapted = False   # Agent is not adapted anymore
 
+class HouseholdContext(namedtuple('HouseholdContext', ['waterboard_adaptation', 'warning_system_government', 'infrastructure',
+                                                       'total_policy_value', 'media_platform_usage', 'provide_information',
+                                                       'subsidies', 'regulation', 'infrastructure_government'])):
+    """
+    Values of the other agents that the households use in their advance, the same for all households in a step.
+    """
+
+    @classmethod
+    def determine(cls, model):
+        """
+        Determine the context from the values that have just been updated in the step function of every agent.
+        Since households perform their 'advance' function first, the waterboard adaptation, warning system and
+        infrastructure are redetermined here by calling the functions of the respective agents. These functions
+        will later be called by the respective agents themselves as well, to be stored in these agents.
+        """
+        policy_maker = model.policy_maker
+        government = model.government
+        waterboard = model.waterboard
+        waterboard_adaptation = waterboard.determine_waterboard_adaptation(
+            policy_maker.determine_provide_information(policy_maker.provide_information, government.government_budget,
+                                                       government.political_perception_government, waterboard.waterboard_attitude,
+                                                       model.protest),
+            policy_maker.determine_regulation(policy_maker.regulation, government.government_budget,
+                                              government.political_perception_government, waterboard.waterboard_attitude,
+                                              model.protest),
+            waterboard.waterboard_attitude)
+        warning_system_government = government.determine_government_warning_system(policy_maker.provide_information,
+                                                                                   policy_maker.regulation)
+        infrastructure = policy_maker.determine_infrastructure_government(policy_maker.infrastructure_government,
+                                                                          government.government_budget,
+                                                                          government.political_perception_government,
+                                                                          waterboard.waterboard_attitude)
+        # the total policy value as the insurance company determines it in determine_willingness_to_provide_insurance
+        total_policy_value = (policy_maker.provide_information + policy_maker.subsidies
+                              + policy_maker.regulation + policy_maker.infrastructure_government)
+        return cls(waterboard_adaptation, warning_system_government, infrastructure, total_policy_value,
+                   model.insurance_company.media_platform_usage, policy_maker.provide_information,
+                   policy_maker.subsidies, policy_maker.regulation, policy_maker.infrastructure_government)
+
+# coefficients of the government and policy maker. They can be changed per run with the coefficients argument
+# of the model, e.g. for the sensitivity analysis in experiment_design.py
+DEFAULT_COEFFICIENTS = {
+    # weight of the previous political perception of the government, the rest is the average of the households
+    'government_perception_inertia': 0.5,
+    # weights of welfare and political perception in the government budget (swapped in scenario 3)
+    'budget_welfare_weight': 0.6,
+    'budget_perception_weight': 1.4,
+    # weights of provide information and regulation in the warning system
+    'warning_information_weight': 3,
+    'warning_regulation_weight': 2,
+    # multipliers of the weights of government budget, political perception, waterboard attitude and protest in the policies
+    'policy_budget_scale': 1.0,
+    'policy_perception_scale': 1.0,
+    'policy_waterboard_scale': 1.0,
+    'policy_protest_scale': 1.0,
+}
+
 # Define the Government agent class
 class Government(Agent):
     def __init__(self, unique_id, model, welfare, political_situation):
@@ -218,7 +285,8 @@ class Government(Agent):
 
     def determine_political_perception_government(self, political_perception_government, average_political_perception_households):
         # Determine the new political perception of the government
-        political_perception_government = (0.5*political_perception_government + 0.5*average_political_perception_households)
+        inertia = self.main_model.coefficients['government_perception_inertia']
+        political_perception_government = (inertia*political_perception_government + (1 - inertia)*average_political_perception_households)
 
         #keep political perception value between bounds, 0 and 1
         if political_perception_government > 1:
@@ -230,7 +298,8 @@ class Government(Agent):
 
     def determine_government_warning_system(self, provide_information, regulation):
         # determine whether government uses a warning system
-        return provide_information * 3 + regulation * 2
+        coefficients = self.main_model.coefficients
+        return provide_information * coefficients['warning_information_weight'] + regulation * coefficients['warning_regulation_weight']
 
     def step(self):
         #Compute average political perception among households,
@@ -240,10 +309,12 @@ class Government(Agent):
         self.political_perception_government = self.determine_political_perception_government(self.political_perception_government, self.average_political_perception_households)
 
         # determine government budget based upon welfare and political perception of the government
+        welfare_weight = self.main_model.coefficients['budget_welfare_weight']
+        perception_weight = self.main_model.coefficients['budget_perception_weight']
         if self.main_model.scenarioNO == 3:
-            self.government_budget = 1.4*self.welfare + 0.6*self.political_perception_government
+            self.government_budget = perception_weight*self.welfare + welfare_weight*self.political_perception_government
         else:
-            self.government_budget = 0.6*self.welfare + 1.4*self.political_perception_government
+            self.government_budget = welfare_weight*self.welfare + perception_weight*self.political_perception_government
 
     def advance(self):
         # determine whether government uses a warning system
@@ -276,18 +347,10 @@ class Waterboard(Agent):
         return (provide_information + 3*regulation + 3*waterboard_attitude)
 
     def step(self):
-        #initialise to 0
-        self.household_average_flood_damage = 0
-        #get average flood damage of households
-        for agent in self.main_model.schedule.agents:
-            # only execute code for households
-            if type(agent) == Households:
-                self.household_average_flood_damage = self.household_average_flood_damage + calculate_basic_flood_damage(agent.flood_depth_actual,
-                                                                         agent.sandbags_placed,
-                                                                         self.adaptation_on_rivers_and_drainages,
-                                                                         self.main_model.government.warning_system,
-                                                                         self.main_model.policy_maker.infrastructure_government)
-        self.household_average_flood_damage = self.household_average_flood_damage / self.main_model.number_of_households
+        #get average flood damage of households. The damage of the households is calculated by the flood event engine
+        #at the start of the model step with the same waterboard, government and policy maker values as used here,
+        #so the average follows from the running sum of flood_damage_actual
+        self.household_average_flood_damage = self.main_model.average_flood_damage_households()
         # append past_flood_damages list with the new actual flood damage
         self.past_flood_damages.append(self.household_average_flood_damage)
 
@@ -355,29 +418,39 @@ class Policy_maker(Agent):
         friends = []
         return len(friends)
 
+    def policy_scales(self):
+        #multipliers of the weights of government budget, political perception, waterboard attitude and protest
+        coefficients = self.main_model.coefficients
+        return (coefficients['policy_budget_scale'], coefficients['policy_perception_scale'],
+                coefficients['policy_waterboard_scale'], coefficients['policy_protest_scale'])
+
     def determine_provide_information(self, provide_information, government_budget, political_perception_government, waterboard_attitude, protest):
+        b, p, w, r = self.policy_scales()
         if self.main_model.scenarioNO == 4:
-            return (0.1*government_budget + 0.3*political_perception_government + 0.2*waterboard_attitude + 0.1*protest)/0.7
+            return (0.1*b*government_budget + 0.3*p*political_perception_government + 0.2*w*waterboard_attitude + 0.1*r*protest)/0.7
         else:
-            return (provide_information + 0.1 * government_budget + 0.3 * political_perception_government + 0.2 * waterboard_attitude + 0.1 * protest) / 1.7
+            return (provide_information + 0.1*b * government_budget + 0.3*p * political_perception_government + 0.2*w * waterboard_attitude + 0.1*r * protest) / 1.7
 
     def determine_subsidies(self, government_budget, subsidies, political_perception_government, waterboard_attitude, protest):
+        b, p, w, r = self.policy_scales()
         if self.main_model.scenarioNO == 4:
-            return government_budget * (0.3 * political_perception_government + 0.2 * waterboard_attitude + 0.1 * protest) / 2
+            return government_budget * (0.3*p * political_perception_government + 0.2*w * waterboard_attitude + 0.1*r * protest) / 2
         else:
-            return government_budget*(subsidies + 0.3*political_perception_government + 0.2*waterboard_attitude + 0.1*protest)/3
+            return government_budget*(subsidies + 0.3*p*political_perception_government + 0.2*w*waterboard_attitude + 0.1*r*protest)/3
 
     def determine_regulation(self, regulation, government_budget, political_perception_government, waterboard_attitude, protest):
+        b, p, w, r = self.policy_scales()
         if self.main_model.scenarioNO == 4:
-            return (0.05 * government_budget + 0.2 * political_perception_government + 0.05 * waterboard_attitude + 0.1 * protest) / 0.4
+            return (0.05*b * government_budget + 0.2*p * political_perception_government + 0.05*w * waterboard_attitude + 0.1*r * protest) / 0.4
         else:
-            return (regulation + 0.05*government_budget + 0.2*political_perception_government + 0.05*waterboard_attitude + 0.1*protest)/1.4
+            return (regulation + 0.05*b*government_budget + 0.2*p*political_perception_government + 0.05*w*waterboard_attitude + 0.1*r*protest)/1.4
 
     def determine_infrastructure_government(self, infrastructure_government, government_budget, political_perception_government, waterboard_attitude):
+        b, p, w, r = self.policy_scales()
         if self.main_model.scenarioNO == 4:
-            return (0.2 * government_budget + 0.3 * political_perception_government + 0.2 * waterboard_attitude) / 0.9
+            return (0.2*b * government_budget + 0.3*p * political_perception_government + 0.2*w * waterboard_attitude) / 0.9
         else:
-            return (infrastructure_government + 0.2*government_budget + 0.3*political_perception_government + 0.2*waterboard_attitude)/1.9
+            return (infrastructure_government + 0.2*b*government_budget + 0.3*p*political_perception_government + 0.2*w*waterboard_attitude)/1.9
 
     def step(self):
         # determine new policy values
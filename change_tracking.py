@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Change tracking of the household updates for the Flood Adaptation Model.
+
+Once the policy values have settled, many households get the same inputs in every step: in the step
+a household averages the political perceptions of its neighbours, in the advance it decides on
+insurance and sandbags from its flood depth and damage, the sandbags it placed, its attitude (the
+average of its last three flood damages) and the values of the other agents (see HouseholdContext in
+agents.py). The HouseholdChangeTracker marks a household dirty when one of these inputs changed since
+its last update and only updates the dirty households:
+
+    step: a household is dirty when its own political perception or that of a neighbour changed
+    advance: a household is dirty when its flood depth, flood damage, sandbags or last two past flood
+             damages changed, and all households are dirty when the HouseholdContext changed
+
+With a tolerance of 0 the results are exactly those of updating all households. With a larger tolerance,
+changes of the political perceptions and of the HouseholdContext up to the tolerance do not make a
+household dirty, which skips far more households once a run has settled, at the cost of results that
+differ up to about the tolerance. In the verification mode the skipped households are updated anyway
+and an AssertionError is raised when an update changes anything.
+
+The uncertainty of the estimated flood damage is drawn for every household in every step, also for the
+skipped households, so that the random numbers are drawn in the same order as without change tracking.
+"""
+import random
+
+import numpy as np
+
+
+class HouseholdChangeTracker:
+    """
+    Updates only the households whose inputs changed, as the step and advance phase functions of the
+    households (see PhasedActivation.set_phase_function).
+
+    Parameters
+    ----------
+    model: the AdaptationModel
+    tolerance: changes of the political perceptions and of the HouseholdContext up to this value are ignored
+    verify: update the skipped households anyway and check that this changes nothing, the tolerance is then 0
+    """
+
+    def __init__(self, model, tolerance=0.0, verify=False):
+        self.model = model
+        self.verify = verify
+        self.tolerance = 0.0 if verify else tolerance
+        households = model.households
+        number_of_households = len(households)
+        # households that update their political perception in the next step phase, one byte per node
+        self.perception_dirty = bytearray(b'\x01') * number_of_households
+        # political perception of every household when its neighbours were last marked dirty
+        self.published_perception = model.household_state.political_perception.copy()
+        # inputs of the advance of every household at its last update: flood depth, flood damage, sandbags
+        # and the last two past flood damages, NaN (unequal to everything) before the first update
+        self.seen_inputs = np.full((5, number_of_households), np.nan)
+        # last two entries of the past flood damages of every household
+        self.past_damages = np.array([[household.past_flood_damages[-1] for household in households],
+                                      [household.past_flood_damages[-2] for household in households]], dtype=float)
+        # HouseholdContext with which all households were last updated
+        self.reference_context = None
+        # number of households updated in the last step and advance phase
+        self.updated_in_step = 0
+        self.updated_in_advance = 0
+
+    def step_households(self, households):
+        """Step the households of which the own or a neighbour's political perception changed."""
+        dirty = self.perception_dirty
+        perception = self.model.household_state.political_perception
+        published = self.published_perception
+        tolerance = self.tolerance
+        updated = 0
+        for household in households:
+            node = household.node
+            if not dirty[node]:
+                if self.verify:
+                    self._verify_step(household)
+                continue
+            old = perception.item(node)
+            household.step()
+            updated += 1
+            new = perception.item(node)
+            # the own perception is an input of the next update, so the household stays dirty while it changes
+            dirty[node] = abs(new - old) > tolerance
+            if abs(new - published.item(node)) > tolerance:
+                published[node] = new
+                for friend in household.friends:
+                    dirty[friend.node] = 1
+        self.updated_in_step = updated
+
+    def advance_households(self, households):
+        """Advance the households of which an input changed, and draw the estimated damage of the others."""
+        model = self.model
+        state = model.household_state
+        context = model.household_context()
+        values = np.array(context, dtype=float)
+        context_changed = (self.reference_context is None
+                           or bool(np.any(np.abs(values - self.reference_context) > self.tolerance)))
+        if context_changed:
+            self.reference_context = values
+        # drawn in the order of the households, as every household draws it in its advance
+        noise = [random.randrange(-10, 10, 1) for _ in households]
+        inputs = np.stack([state.flood_depth_actual, state.flood_damage_actual, state.sandbags_placed,
+                           self.past_damages[0], self.past_damages[1]])
+        if context_changed or context.total_policy_value > 2:
+            # above a total policy value of 2, the insurance willingness depends on the uncertain estimated damage
+            dirty = np.ones(len(households), dtype=bool)
+        else:
+            dirty = np.any(inputs != self.seen_inputs, axis=0)
+        self.seen_inputs[:, dirty] = inputs[:, dirty]
+        for household, household_noise, household_dirty in zip(households, noise, dirty.tolist()):
+            if household_dirty:
+                household.advance(household_noise)
+            elif self.verify:
+                self._verify_advance(household, household_noise)
+            else:
+                household.flood_damage_estimated = household.expected_flood_damage + household_noise/100
+        # the advance appends the flood damage to the past flood damages. For a skipped household the damage
+        # equals the last two past damages, so they stay the same
+        self.past_damages[1, dirty] = self.past_damages[0, dirty]
+        self.past_damages[0, dirty] = state.flood_damage_actual[dirty]
+        self.updated_in_advance = int(dirty.sum())
+
+    def _verify_step(self, household):
+        """Check that the step of a skipped household would not change its political perception."""
+        expected = household.political_perception
+        household.step()
+        if household.political_perception != expected:
+            raise AssertionError(f"Household {household.unique_id} was skipped in the step, but its political perception "
+                                 f"changes from {expected} to {household.political_perception}")
+
+    def _verify_advance(self, household, noise):
+        """Check that the advance of a skipped household gives the values that skipping it keeps."""
+        expected = (household.expected_flood_damage + noise/100, household.insurance_taken_by_household,
+                    household.household_attitude, household.sandbags_placed, household.is_adapted)
+        household.advance(noise)
+        actual = (household.flood_damage_estimated, household.insurance_taken_by_household,
+                  household.household_attitude, household.sandbags_placed, household.is_adapted)
+        if actual != expected:
+            raise AssertionError(f"Household {household.unique_id} was skipped in the advance, but its update gives "
+                                 f"{actual} instead of {expected}")
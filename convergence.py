@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Steady-state detection for the Flood Adaptation Model.
+
+Many runs reach a steady state well before max_steps: the policy values of the policy maker converge,
+the political perceptions of the households homogenise over the network and the households stop
+changing their decisions between floods. Because a flood hits every few steps and the institutions
+react to random events, the state does not become constant but keeps fluctuating within every flood
+cycle. The ConvergenceMonitor therefore averages a set of state quantities over every flood cycle,
+and the run has converged when these averages changed less than a tolerance between a number of
+consecutive cycles.
+
+A converged model either stops (model.running is set to False, which ends a Mesa batch_run), or is
+fast-forwarded: the remaining steps are not simulated, the data of the last flood cycle is repeated
+for every later cycle instead (see StepDataCollector.replay).
+"""
+import numpy as np
+
+# stop the run when it has converged
+STOP = 'stop'
+# extrapolate the periodic steady state until max_steps when the run has converged
+FAST_FORWARD = 'fast_forward'
+
+# state quantities that can be monitored, by name
+QUANTITIES = {
+    'provide_information': lambda m: m.policy_maker.provide_information,
+    'subsidies': lambda m: m.policy_maker.subsidies,
+    'regulation': lambda m: m.policy_maker.regulation,
+    'infrastructure_government': lambda m: m.policy_maker.infrastructure_government,
+    'political_situation': lambda m: m.political_situation,
+    'political_perception_mean': lambda m: m.aggregate('political_perception') / m.number_of_households,
+    # spread of the political perceptions, zero when they are homogeneous over the network
+    'political_perception_std': lambda m: np.std(m.household_state.political_perception).item(),
+    'adapted_share': lambda m: m.aggregate('is_adapted') / m.number_of_households,
+    # the damage depends on the random flood intensity of every flood, so it converges only with many households
+    'mean_flood_damage': lambda m: m.average_flood_damage_households(),
+}
+
+# quantities monitored by default
+DEFAULT_QUANTITIES = ('provide_information', 'subsidies', 'regulation', 'infrastructure_government',
+                      'political_situation', 'political_perception_mean', 'political_perception_std', 'adapted_share')
+
+
+class ConvergenceMonitor:
+    """
+    Detects that a model reached a periodic steady state.
+
+    Parameters
+    ----------
+    action: STOP or FAST_FORWARD, what the model does when it has converged
+    period: length of the flood cycle in steps, the cycles start at the multiples of period
+    tolerance: largest change of the cycle average of a quantity between two cycles, relative to the absolute
+               value of the average but at least 1, so it is an absolute tolerance for shares and policy values
+    windows: number of consecutive cycle changes within the tolerance before the run counts as converged
+    quantities: names of QUANTITIES to monitor, None for DEFAULT_QUANTITIES
+    """
+
+    def __init__(self, action=STOP, period=5, tolerance=1e-2, windows=2, quantities=None):
+        if action not in (STOP, FAST_FORWARD):
+            raise ValueError(f"Unknown convergence action: {action!r}. Use '{STOP}' or '{FAST_FORWARD}'")
+        if not isinstance(period, int) or period < 1 or not isinstance(windows, int) or windows < 1:
+            raise ValueError(f"Convergence period and windows must be positive numbers, got {period!r} and {windows!r}")
+        if quantities is None:
+            quantities = DEFAULT_QUANTITIES
+        unknown = [name for name in quantities if name not in QUANTITIES]
+        if unknown:
+            raise ValueError(f"Unknown convergence quantities: {unknown}. Available are {list(QUANTITIES)}")
+        self.action = action
+        self.period = period
+        self.tolerance = tolerance
+        self.windows = windows
+        self.quantities = list(quantities)
+        # step on which the model was found to have converged, the first step of a cycle, None while it has not
+        self.converged_at = None
+        # averages of the quantities per completed cycle, only the last one is kept
+        self.cycle_average = None
+        # values of the quantities on the observed steps of the current cycle
+        self._cycle = []
+        # number of consecutive cycle changes within the tolerance
+        self._steady_cycles = 0
+
+    @property
+    def converged(self):
+        return self.converged_at is not None
+
+    def observe(self, model):
+        """
+        Record the state of the model at the start of its current step and return whether it has converged.
+        Convergence is checked on the first step of every cycle, once converged the state is no longer observed.
+        """
+        if self.converged:
+            return True
+        step = model.schedule.steps
+        if step % self.period == 0 and len(self._cycle) == self.period:
+            average = np.mean(self._cycle, axis=0)
+            if self.cycle_average is not None:
+                change = np.abs(average - self.cycle_average)
+                if np.all(change <= self.tolerance * np.maximum(np.abs(self.cycle_average), 1.0)):
+                    self._steady_cycles += 1
+                else:
+                    self._steady_cycles = 0
+            self.cycle_average = average
+            if self._steady_cycles >= self.windows:
+                self.converged_at = step
+                return True
+        if step % self.period == 0:
+            # a cycle starts, steps observed before it (e.g. of a monitor created mid-cycle) are not a full cycle
+            self._cycle = []
+        self._cycle.append([QUANTITIES[name](model) for name in self.quantities])
+        return False
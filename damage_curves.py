@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Depth-damage curves for the Flood Adaptation Model.
+
+calculate_basic_flood_damage evaluates a damage curve on the (corrected) flood depth between 0.025 and 6 m.
+By default that is the logarithmic fit on de Moer, Huizinga (2017). A damage curve object can replace it:
+every curve has a scalar method for the agent code and an array method for the vectorized code.
+The DamageLookupTable precomputes any curve on a grid and interpolates linearly within a given error bound.
+It does not speed up the logarithmic curve, math.log and np.log are at least as fast as a table lookup,
+it bounds the cost of curves that are expensive to evaluate. The TabulatedDamageCurve interpolates a table of depths and damage factors, e.g. per building type.
+"""
+import bisect
+import math
+
+import numpy as np
+
+# range of flood depths in meters on which the damage curves are evaluated
+MIN_DEPTH = 0.025
+MAX_DEPTH = 6
+
+
+class LogarithmicDamageCurve:
+    """The logarithmic regression over de Moer, Huizinga (2017), see flood_damage.xlsx."""
+
+    def scalar(self, depth):
+        return 0.1746 * math.log(depth) + 0.6483
+
+    def array(self, depth):
+        return 0.1746 * np.log(depth) + 0.6483
+
+
+class TabulatedDamageCurve:
+    """
+    Damage curve given as a table, interpolated linearly between the points.
+
+    Parameters
+    ----------
+    depths: increasing flood depths in meters
+    damages: damage factor between 0 and 1 at each depth
+    """
+
+    def __init__(self, depths, damages):
+        if len(depths) != len(damages) or len(depths) < 2:
+            raise ValueError("A tabulated damage curve needs at least two points and as many depths as damages")
+        if any(b <= a for a, b in zip(depths, depths[1:])):
+            raise ValueError("The depths of a tabulated damage curve must be increasing")
+        self.depths = [float(depth) for depth in depths]
+        self.damages = [float(damage) for damage in damages]
+        self._depths_array = np.asarray(self.depths)
+        self._damages_array = np.asarray(self.damages)
+
+    def scalar(self, depth):
+        i = bisect.bisect_right(self.depths, depth)
+        if i == 0:
+            return self.damages[0]
+        if i == len(self.depths):
+            return self.damages[-1]
+        fraction = (depth - self.depths[i - 1]) / (self.depths[i] - self.depths[i - 1])
+        return self.damages[i - 1] + fraction * (self.damages[i] - self.damages[i - 1])
+
+    def array(self, depth):
+        return np.interp(depth, self._depths_array, self._damages_array)
+
+
+class DamageLookupTable:
+    """
+    Precomputed damage curve on an equally spaced grid between MIN_DEPTH and MAX_DEPTH, with linear interpolation.
+    The grid is refined until the largest interpolation error, measured against the curve between the grid points,
+    is at most max_error. The slope and intercept of every interval are precomputed, so that evaluating the table
+    is one index computation and one multiply-add. For the logarithmic curve this is about as fast as math.log
+    for scalars and about four times slower than np.log for arrays, the table pays off for expensive curves.
+
+    Parameters
+    ----------
+    curve: damage curve to tabulate, by default the LogarithmicDamageCurve
+    max_error: maximum absolute difference between the table and the curve
+    min_depth, max_depth: range of the table
+    """
+
+    def __init__(self, curve=None, max_error=1e-4, min_depth=MIN_DEPTH, max_depth=MAX_DEPTH):
+        self.curve = curve if curve is not None else LogarithmicDamageCurve()
+        self.max_error = max_error
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        number_of_points = 65
+        while True:
+            self._build(number_of_points)
+            self.error = self.validate()
+            if self.error <= max_error or number_of_points > 2 ** 22:
+                break
+            number_of_points = 2 * number_of_points - 1
+
+    def _build(self, number_of_points):
+        self.depths = np.linspace(self.min_depth, self.max_depth, number_of_points)
+        self.damages = self.curve.array(self.depths)
+        self.step = (self.max_depth - self.min_depth) / (number_of_points - 1)
+        self._inverse_step = 1 / self.step
+        self._offset = self.min_depth * self._inverse_step
+        # damage = intercept + slope * depth on every interval
+        self.slopes = np.diff(self.damages) / np.diff(self.depths)
+        self.intercepts = self.damages[:-1] - self.slopes * self.depths[:-1]
+        self._slopes_list = self.slopes.tolist()
+        self._intercepts_list = self.intercepts.tolist()
+        self._last = number_of_points - 2
+
+    def validate(self, points_per_interval=8):
+        """Return the largest absolute difference between the table and the curve, checked between the grid points."""
+        depths = np.linspace(self.min_depth, self.max_depth, (len(self.depths) - 1) * points_per_interval + 1)
+        return float(np.max(np.abs(self.array(depths) - self.curve.array(depths))))
+
+    def __len__(self):
+        return len(self.depths)
+
+    def scalar(self, depth):
+        i = int(depth * self._inverse_step - self._offset)
+        if i < 0:
+            i = 0
+        elif i > self._last:
+            i = self._last
+        return self._intercepts_list[i] + self._slopes_list[i] * depth
+
+    def array(self, depth):
+        depth = np.asarray(depth, dtype=np.float64)
+        i = (depth * self._inverse_step - self._offset).astype(np.intp)
+        np.clip(i, 0, self._last, out=i)
+        return self.intercepts.take(i) + self.slopes.take(i) * depth
+
+
+def get_damage_curve(damage_curve):
+    """
+    Return the damage curve object for the damage_curve argument of the model.
+
+    Parameters
+    ----------
+    damage_curve: None for the analytic curve in calculate_basic_flood_damage, 'lookup' for a DamageLookupTable
+                  of that curve, or a damage curve object
+
+    Returns
+    -------
+    curve: damage curve object or None
+    """
+    if damage_curve is None or not isinstance(damage_curve, str):
+        return damage_curve
+    if damage_curve == 'lookup':
+        return DamageLookupTable()
+    raise ValueError(f"Unknown damage curve: '{damage_curve}'. Use None, 'lookup' or a damage curve object")
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Data collection with a configurable cadence for the Flood Adaptation Model.
+
+The StepDataCollector collects model and agent data separately, so that a run can collect model
+data every k steps and agent data every m steps, or only on the steps with a flood event. Steps on
+which the model data is skipped hold None, so that model_vars stays indexed by step as the Mesa
+batch_run expects, and get_model_vars_dataframe only returns the collected steps.
+"""
+import bisect
+import types
+from functools import partial
+
+import pandas as pd
+from mesa.datacollection import DataCollector
+
+# collect agent data only on the steps with a flood event
+FLOOD_EVENTS = 'flood_events'
+
+
+def select_reporters(reporters, names, kind):
+    """
+    Return the reporters in names, all reporters if names is None.
+
+    Parameters
+    ----------
+    reporters: dictionary of all reporters of the model
+    names: list of reporter names to keep, or None
+    kind: 'model' or 'agent', used in the error message
+    """
+    if names is None:
+        return reporters
+    unknown = [name for name in names if name not in reporters]
+    if unknown:
+        raise ValueError(f"Unknown {kind} reporters: {unknown}. Available are {list(reporters)}")
+    return {name: reporters[name] for name in names}
+
+
+def collects_at(every, step, flood_event=False):
+    """
+    Return whether data with cadence every is collected at step.
+
+    Parameters
+    ----------
+    every: collect every k steps (from step 0 on), FLOOD_EVENTS for the steps with a flood event, or None for never
+    step: model step
+    flood_event: whether a flood event happens at step
+    """
+    if every is None:
+        return False
+    if every == FLOOD_EVENTS:
+        return flood_event
+    if not isinstance(every, int) or every < 1:
+        raise ValueError(f"Collection cadence must be a positive number of steps, '{FLOOD_EVENTS}' or None, got {every!r}")
+    return step % every == 0
+
+
+class StepDataCollector(DataCollector):
+    """DataCollector of which the model and agent data can be collected on different steps."""
+
+    def __init__(self, model_reporters=None, agent_reporters=None, tables=None):
+        super().__init__(model_reporters=model_reporters, agent_reporters=agent_reporters, tables=tables)
+        # steps on which the model data was collected
+        self.model_steps = []
+
+    @staticmethod
+    def _report(reporter, model):
+        """Return the value of a model reporter, as DataCollector.collect evaluates it."""
+        if isinstance(reporter, (types.LambdaType, partial)):
+            return reporter(model)
+        elif isinstance(reporter, str):
+            return getattr(model, reporter, None)
+        elif isinstance(reporter, list):
+            return reporter[0](*reporter[1])
+        else:
+            return reporter()
+
+    def collect_model_vars(self, model):
+        """Collect the model variables, as DataCollector.collect does."""
+        for var, reporter in self.model_reporters.items():
+            self.model_vars[var].append(self._report(reporter, model))
+        self.model_steps.append(model.schedule.steps)
+
+    def skip_model_vars(self, model):
+        """Store None for all model variables of this step."""
+        for values in self.model_vars.values():
+            values.append(None)
+
+    def collect_agent_vars(self, model):
+        """Collect the agent variables, as DataCollector.collect does."""
+        if self.agent_reporters:
+            self._agent_records[model.schedule.steps] = list(self._record_agents(model))
+
+    def collect(self, model, model_vars=True, agent_vars=True):
+        """Collect the data of the given model object, model_vars and agent_vars select which data."""
+        if model_vars:
+            self.collect_model_vars(model)
+        else:
+            self.skip_model_vars(model)
+        if agent_vars:
+            self.collect_agent_vars(model)
+
+    def replay(self, model, period, model_vars=True, agent_vars=True, current=()):
+        """
+        Store the data of an earlier step as the data of the current step, for a model that is fast-forwarded
+        through a periodic steady state (see convergence.py). The data of the latest step a multiple of period
+        steps back on which it was collected is used. When there is no such step, e.g. because the collection
+        cadence does not fit the period, the data is collected from the model as it is.
+
+        Parameters
+        ----------
+        model: the model
+        period: period of the steady state in steps
+        model_vars, agent_vars: which data is stored for this step, as in collect
+        current: names of model reporters that are evaluated on the model instead of copied
+        """
+        step = model.schedule.steps
+        if model_vars:
+            source = self._earlier_step(step, period, self._has_model_step)
+            if source is None:
+                self.collect_model_vars(model)
+            else:
+                for var, values in self.model_vars.items():
+                    values.append(self._report(self.model_reporters[var], model) if var in current else values[source])
+                self.model_steps.append(step)
+        else:
+            self.skip_model_vars(model)
+        if agent_vars and self.agent_reporters:
+            source = self._earlier_step(step, period, self._agent_records.__contains__)
+            if source is None:
+                self.collect_agent_vars(model)
+            else:
+                self._replay_agent_vars(step, source)
+
+    @staticmethod
+    def _earlier_step(step, period, collected):
+        """Return the latest step step - k * period (k >= 1) for which collected is true, None if there is none."""
+        for source in range(step - period, -1, -period):
+            if collected(source):
+                return source
+        return None
+
+    def _has_model_step(self, step):
+        index = bisect.bisect_left(self.model_steps, step)
+        return index < len(self.model_steps) and self.model_steps[index] == step
+
+    def _replay_agent_vars(self, step, source):
+        """Store the agent records of step source as the records of step."""
+        self._agent_records[step] = [(step,) + record[1:] for record in self._agent_records[source]]
+
+    def get_model_vars_dataframe(self):
+        """Create a pandas DataFrame from the model variables, indexed by the steps on which they were collected."""
+        if not self.model_reporters:
+            raise UserWarning(
+                "No model reporters have been defined in the DataCollector, returning empty DataFrame."
+            )
+        df = pd.DataFrame(self.model_vars)
+        if len(self.model_steps) != len(df):
+            # drop the skipped steps, the position of a row in model_vars is its step
+            df = df.iloc[self.model_steps]
+        return df
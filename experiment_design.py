@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Space-filling experiment designs and global sensitivity analysis for the Flood Adaptation Model.
+
+Instead of full factorial grids, a fixed budget of runs is spread over the parameter space with a
+Latin hypercube or a Sobol sequence. Parameters are model arguments such as political_situation and
+welfare, or coefficients of the government and policy maker (see DEFAULT_COEFFICIENTS in agents.py),
+written as 'coefficients.<name>'. The design points are run in parallel and their outputs are
+streamed back as the runs finish. Sobol designs follow the Saltelli scheme, from which the first
+order and total Sobol indices are estimated (Saltelli et al. 2010, Jansen 1999).
+"""
+import random
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc, spearmanr
+
+from model import AdaptationModel
+
+COEFFICIENT_PREFIX = 'coefficients.'
+
+# model outputs of a run: the final value of these model reporters
+DEFAULT_OUTPUTS = ('total_adapted_households', 'provide_information', 'subsidies', 'regulation', 'infrastructure_government')
+
+
+class ExperimentDesign:
+    """
+    Design points of an experiment.
+
+    Parameters
+    ----------
+    bounds: dictionary mapping parameter name to (low, high)
+    samples: array with one row per design point and one column per parameter, in parameter units
+    method: 'lhs' or 'sobol'
+    base_samples: for Sobol designs the number N of base points, the samples are then the Saltelli
+                  matrices A, B and AB_i for every parameter i, N rows each
+    """
+
+    def __init__(self, bounds, samples, method, base_samples=None):
+        self.bounds = dict(bounds)
+        self.names = list(bounds)
+        self.samples = samples
+        self.method = method
+        self.base_samples = base_samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def parameters(self, index):
+        """Return the keyword arguments of the model for design point index."""
+        kwargs = {}
+        coefficients = {}
+        for name, value in zip(self.names, self.samples[index].tolist()):
+            if name.startswith(COEFFICIENT_PREFIX):
+                coefficients[name[len(COEFFICIENT_PREFIX):]] = value
+            else:
+                kwargs[name] = value
+        if coefficients:
+            kwargs['coefficients'] = coefficients
+        return kwargs
+
+    def seed_offset(self, index):
+        """
+        Return the offset of the seed of design point index. The rows of A, B and every AB_i of a Sobol design that
+        belong to the same base point share their seed (common random numbers), so that the differences between
+        their outputs, from which the Sobol indices are estimated, come from the parameters and not from the noise.
+        """
+        if self.base_samples is None:
+            return index
+        return index % self.base_samples
+
+    def to_dataframe(self):
+        """Return the design points as a DataFrame with one column per parameter."""
+        return pd.DataFrame(self.samples, columns=self.names)
+
+
+def _scale(unit_samples, bounds):
+    low = np.array([bound[0] for bound in bounds.values()], dtype=np.float64)
+    high = np.array([bound[1] for bound in bounds.values()], dtype=np.float64)
+    return qmc.scale(unit_samples, low, high)
+
+
+def latin_hypercube_design(bounds, budget, seed=None):
+    """Return an ExperimentDesign with budget Latin hypercube samples over bounds."""
+    unit_samples = qmc.LatinHypercube(d=len(bounds), seed=seed).random(budget)
+    return ExperimentDesign(bounds, _scale(unit_samples, bounds), 'lhs')
+
+
+def sobol_design(bounds, budget, seed=None):
+    """
+    Return a Saltelli ExperimentDesign for the estimation of Sobol indices within budget runs.
+    With d parameters the design has N (d + 2) points, N being the largest power of two that fits the budget.
+    """
+    d = len(bounds)
+    base_samples = 2 ** int(np.floor(np.log2(budget / (d + 2))))
+    if base_samples < 2:
+        raise ValueError(f"A Sobol design over {d} parameters needs a budget of at least {2 * (d + 2)} runs")
+    # the matrices A and B are the two halves of a Sobol sequence in 2d dimensions
+    unit_samples = qmc.Sobol(d=2 * d, scramble=True, seed=seed).random(base_samples)
+    a = unit_samples[:, :d]
+    b = unit_samples[:, d:]
+    matrices = [a, b]
+    for i in range(d):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        matrices.append(ab)
+    return ExperimentDesign(bounds, _scale(np.vstack(matrices), bounds), 'sobol', base_samples)
+
+
+def run_design_point(task):
+    """
+    Run the model for one design point and return (index, outputs), used by the worker processes.
+
+    Parameters
+    ----------
+    task: (index, model class, model keyword arguments, output names, max_steps)
+    """
+    index, model_cls, kwargs, outputs, max_steps = task
+    # the agents also draw from the random module, seed it so that every run is reproducible
+    random.seed(kwargs['seed'])
+    model = model_cls(**kwargs)
+    for _ in range(max_steps):
+        model.step()
+    model_vars = model.datacollector.model_vars
+    return index, {name: model_vars[name][-1] for name in outputs}
+
+
+def evaluate_design(design, model_parameters=None, model_cls=AdaptationModel, outputs=DEFAULT_OUTPUTS,
+                    max_steps=20, number_processes=None, seed=0):
+    """
+    Run the model for every design point in parallel and yield (index, outputs) in the order the runs finish.
+
+    Parameters
+    ----------
+    design: ExperimentDesign
+    model_parameters: fixed keyword arguments of the model for all runs, e.g. number_of_households
+    model_cls: model class to run
+    outputs: model reporters whose final value is returned
+    max_steps: number of steps per run
+    number_processes: number of worker processes, None for all cores, 1 to run in this process
+    seed: the run of design point i uses seed + design.seed_offset(i)
+    """
+    tasks = []
+    for index in range(len(design)):
+        # only collect the outputs, and no agent data
+        kwargs = dict({'seed': seed + design.seed_offset(index), 'model_reporters': list(outputs), 'agent_reporters': []}, **(model_parameters or {}))
+        point = design.parameters(index)
+        if 'coefficients' in point:
+            point['coefficients'] = dict(kwargs.get('coefficients') or {}, **point['coefficients'])
+        kwargs.update(point)
+        tasks.append((index, model_cls, kwargs, tuple(outputs), max_steps))
+    if number_processes == 1:
+        for task in tasks:
+            yield run_design_point(task)
+        return
+    with Pool(number_processes) as pool:
+        yield from pool.imap_unordered(run_design_point, tasks)
+
+
+class SobolAnalysis:
+    """
+    Estimates the first order and total Sobol indices of a Saltelli design from streamed run outputs.
+
+    Parameters
+    ----------
+    design: ExperimentDesign made by sobol_design
+    outputs: names of the outputs to analyse
+    """
+
+    def __init__(self, design, outputs=DEFAULT_OUTPUTS):
+        if design.method != 'sobol':
+            raise ValueError("Sobol indices need a design made by sobol_design")
+        self.design = design
+        self.outputs = list(outputs)
+        self.values = np.full((len(design), len(self.outputs)), np.nan)
+        self.received = np.zeros(len(design), dtype=bool)
+
+    def add(self, index, outputs):
+        """Store the outputs of design point index."""
+        self.values[index] = [outputs[name] for name in self.outputs]
+        self.received[index] = True
+
+    @property
+    def complete(self):
+        return bool(self.received.all())
+
+    def indices(self):
+        """Return a DataFrame with the first order (S1) and total (ST) index per output and parameter."""
+        if not self.complete:
+            raise ValueError(f"{int((~self.received).sum())} of {len(self.design)} runs of the design are missing")
+        n = self.design.base_samples
+        f_a = self.values[:n]
+        f_b = self.values[n:2 * n]
+        variance = np.var(np.vstack([f_a, f_b]), axis=0)
+        rows = []
+        for i, name in enumerate(self.design.names):
+            f_ab = self.values[(2 + i) * n:(3 + i) * n]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                first_order = np.mean(f_b * (f_ab - f_a), axis=0) / variance
+                total = 0.5 * np.mean((f_a - f_ab) ** 2, axis=0) / variance
+            for j, output in enumerate(self.outputs):
+                rows.append({'output': output, 'parameter': name, 'S1': first_order[j], 'ST': total[j]})
+        return pd.DataFrame(rows)
+
+
+def rank_correlations(design, results, outputs=DEFAULT_OUTPUTS):
+    """
+    Return the Spearman rank correlation of every parameter with every output, a sensitivity measure
+    for Latin hypercube designs.
+
+    Parameters
+    ----------
+    design: ExperimentDesign
+    results: dictionary mapping design point index to its outputs
+    """
+    indices = sorted(results)
+    rows = []
+    for i, name in enumerate(design.names):
+        for output in outputs:
+            correlation = spearmanr(design.samples[indices, i], [results[index][output] for index in indices])[0]
+            rows.append({'output': output, 'parameter': name, 'rank_correlation': correlation})
+    return pd.DataFrame(rows)
+
+
+def run_sensitivity_analysis(bounds, budget, method='sobol', model_parameters=None, outputs=DEFAULT_OUTPUTS,
+                             max_steps=20, number_processes=None, seed=0, progress=None):
+    """
+    Spend budget runs on a space-filling design over bounds and return the sensitivity indices.
+
+    Parameters
+    ----------
+    bounds: dictionary mapping parameter name to (low, high), e.g.
+            {'political_situation': (0, 1), 'welfare': (0, 1), 'coefficients.policy_protest_scale': (0.5, 1.5)}
+    budget: maximum number of model runs
+    method: 'sobol' for Sobol indices, 'lhs' for rank correlations on a Latin hypercube
+    model_parameters, outputs, max_steps, number_processes, seed: see evaluate_design
+    progress: optional function called with (number of finished runs, number of runs) after every run
+
+    Returns
+    -------
+    design: the ExperimentDesign
+    results: DataFrame with the parameters and outputs of every run
+    indices: DataFrame with the sensitivity indices per output and parameter
+    """
+    if method == 'sobol':
+        design = sobol_design(bounds, budget, seed=seed)
+        analysis = SobolAnalysis(design, outputs)
+    elif method == 'lhs':
+        design = latin_hypercube_design(bounds, budget, seed=seed)
+        analysis = None
+    else:
+        raise ValueError(f"Unknown experiment design method: '{method}'. Use 'sobol' or 'lhs'")
+    results = {}
+    for index, run_outputs in evaluate_design(design, model_parameters, outputs=outputs, max_steps=max_steps,
+                                              number_processes=number_processes, seed=seed):
+        results[index] = run_outputs
+        if analysis is not None:
+            analysis.add(index, run_outputs)
+        if progress is not None:
+            progress(len(results), len(design))
+    results_df = design.to_dataframe().join(pd.DataFrame.from_dict(results, orient='index'))
+    indices = analysis.indices() if analysis is not None else rank_correlations(design, results, outputs)
+    return design, results_df, indices
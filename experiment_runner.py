@@ -0,0 +1,345 @@
+"""
+Experiment runner for the Flood Adaptation Model.
+
+Runs a mesa batch run of the AdaptationModel over a dictionary of parameters and writes the results
+to a CSV file, which is read again by results_analysis.py.
+
+With a journal, the data of every finished run is written to disk immediately and the run is recorded
+in an append-only journal. Running the same sweep again with the same journal resumes it: only the runs
+that are not in the journal are run, so a crash loses at most the runs that were in progress.
+
+With fork_server, the runs are run by workers forked from a template process that loaded the static
+inputs once, see fork_server.py.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import uuid
+from multiprocessing import Pool
+
+import mesa
+import pandas as pd
+from mesa.batchrunner import _make_model_kwargs, _model_run_func
+
+from model import AdaptationModel
+from input_providers import get_preset_input_provider
+from data_collection import FLOOD_EVENTS
+from fork_server import TemplatePool, shared_worlds
+from metrics import open_metrics_sink, publish_run_done
+
+
+def run_experiment(parameters,
+                   model_cls=AdaptationModel,
+                   iterations=5,
+                   max_steps=19,
+                   data_collection_period=None,
+                   number_processes=1,
+                   output_path="Experimental_results",
+                   memory_every=None,
+                   model_data_every=1,
+                   agent_data_every=1,
+                   journal_path=None,
+                   fork_server=False,
+                   metrics_sink=None,
+                   seed=None,
+                   world_cache_dir=None,
+                   display_progress=True):
+    """
+    Batch run the model over all parameter combinations and export the results to CSV.
+
+    Parameters
+    ----------
+    parameters: dictionary of model parameters, a list of values is swept over
+    model_cls: model class to run
+    iterations, max_steps, number_processes: passed to mesa's batch_run
+    data_collection_period: steps between the rows of the results, by default the largest period
+                            that includes all steps on which the model collects data
+    output_path: CSV file the results are written to, None to skip writing
+    memory_every: sample the memory per model component every k steps, None to disable
+    model_data_every, agent_data_every: collection cadence of the model, see AdaptationModel
+    journal_path: journal file of the sweep, see RunJournal. None to keep all results in memory until the end
+    fork_server: run the runs on a TemplatePool with preloaded inputs instead of with mesa's batch_run
+    metrics_sink: sink to which every run publishes its step metrics while it runs, see metrics.py. A Prometheus
+                  sink is served from this process, the runs send their metrics to it over UDP
+    seed: seed of the model, the same for all runs, so that all runs use the same world (network and household
+          placements) while the agents still draw their own random numbers. None for an unseeded world per run
+    world_cache_dir: directory in which the worlds are cached (see world.py), only used with a seed
+
+    Returns
+    -------
+    br_df: dataframe with the results of all runs
+    """
+    if memory_every:
+        parameters = dict(parameters, memory_sample_every=memory_every)
+    if seed is not None:
+        parameters = dict(parameters, seed=seed)
+    if world_cache_dir is not None:
+        parameters = dict(parameters, world_cache_dir=world_cache_dir)
+    if model_data_every != 1 or agent_data_every != 1:
+        parameters = dict(parameters, model_data_every=model_data_every, agent_data_every=agent_data_every)
+    if data_collection_period is None:
+        cadences = [every for every in (model_data_every, agent_data_every) if every is not None]
+        if cadences and all(isinstance(every, int) for every in cadences):
+            data_collection_period = math.gcd(*cadences)
+        else:
+            data_collection_period = 1
+
+    if metrics_sink is not None and str(metrics_sink).startswith('prometheus:'):
+        metrics_sink = open_metrics_sink(metrics_sink).udp_sink
+
+    if journal_path is not None:
+        br_df = run_journaled(RunJournal(journal_path), model_cls, parameters, iterations, max_steps,
+                              data_collection_period, number_processes, display_progress, fork_server, metrics_sink)
+    elif fork_server or metrics_sink is not None:
+        results = sorted(iterate_runs(sweep_runs(parameters, iterations), model_cls, max_steps, data_collection_period,
+                                      number_processes, fork_server, metrics_sink),
+                         key=lambda result: result[0][0])
+        br_df = pd.DataFrame([row for _, rows in results for row in rows])
+    else:
+        batch = mesa.batchrunner.batch_run(model_cls=model_cls, parameters=parameters,
+                                           number_processes=number_processes, iterations=iterations, max_steps=max_steps,
+                                           data_collection_period=data_collection_period,
+                                           display_progress=display_progress)
+        # import data from run
+        br_df = pd.DataFrame(batch)
+
+    # export to CSV value, to be opened in Excel
+    if output_path is not None:
+        br_df.to_csv(output_path)
+    return br_df
+
+
+def run_model_run(run, max_steps, data_collection_period, input_preset=None, model_cls=AdaptationModel, metrics_sink=None):
+    """
+    Run one model run and return its rows, as mesa's batch_run does. Used by the job service and the sweep workers.
+
+    Parameters
+    ----------
+    run: (run id, iteration, model keyword arguments)
+    max_steps, data_collection_period: see mesa's batch_run
+    input_preset: preset of the SyntheticInputProvider, shared by all runs of the process, None for the input data in ../input_data
+    model_cls: model class to run
+    metrics_sink: sink to which the run publishes its step metrics, see metrics.py
+    """
+    run_id, iteration, kwargs = run
+    model_kwargs = dict(kwargs)
+    if input_preset is not None:
+        model_kwargs['input_provider'] = get_preset_input_provider(input_preset)
+    if metrics_sink is not None:
+        model_kwargs.update(metrics_sink=metrics_sink, metrics_run_id=run_id)
+    rows = _model_run_func(model_cls, (run_id, iteration, model_kwargs), max_steps, data_collection_period)
+    # the input provider and the metrics sink are not part of the results
+    for row in rows:
+        row.pop('input_provider', None)
+        if metrics_sink is not None:
+            row.pop('metrics_sink', None)
+            row.pop('metrics_run_id', None)
+    if metrics_sink is not None:
+        publish_run_done(metrics_sink, run_id)
+    return rows
+
+
+def rows_to_dataframe(rows):
+    """Return the result rows as a DataFrame that can be stored in Parquet, objects such as locations are stored as text."""
+    df = pd.DataFrame(rows)
+    for column in df.columns[df.dtypes == object]:
+        if not df[column].map(lambda value: value is None or isinstance(value, str)).all():
+            df[column] = df[column].map(lambda value: None if value is None else str(value))
+    return df
+
+
+def write_results(path, rows):
+    """Write result rows to path as Parquet, atomically so that readers never see partial files."""
+    partial_path = f"{path}.{uuid.uuid4().hex}.partial"
+    rows_to_dataframe(rows).to_parquet(partial_path, index=False)
+    os.replace(partial_path, path)
+
+
+def _journal_value(value):
+    """
+    Encode a parameter value that json cannot: numpy scalars as Python numbers, and objects such as an input provider
+    by their type and cache key, so that runs with different objects get different keys.
+    """
+    if hasattr(value, 'cache_key'):
+        return f"{type(value).__name__}({value.cache_key()})"
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Parameter value {value!r} cannot be recorded in a journal, only objects with a cache_key can")
+
+
+def run_key(iteration, kwargs):
+    """
+    Return the journal key of a run: its iteration and model parameters, including the seed.
+    Parameters that are objects, such as an input provider, are identified by their cache key.
+    """
+    return json.dumps({'iteration': iteration, 'parameters': kwargs}, sort_keys=True, default=_journal_value)
+
+
+class RunJournal:
+    """
+    Append-only journal of the finished runs of a sweep.
+
+    Every line of the journal file is a JSON object with the key, run id, iteration, seed and parameters of
+    a finished run. The data of the run is written to a Parquet file in the directory <journal>.runs before
+    its journal line is appended, so every run in the journal has its data on disk.
+
+    Parameters
+    ----------
+    path: path of the journal file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.runs_directory = path + '.runs'
+        os.makedirs(self.runs_directory, exist_ok=True)
+
+    def completed(self):
+        """Return a dictionary mapping the key of every finished run to its journal entry."""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line that was cut off by a crash, its run is run again
+                    continue
+                entries[entry['key']] = entry
+        return entries
+
+    def record(self, run_id, iteration, kwargs, rows):
+        """Store the rows of a finished run and append it to the journal."""
+        data_file = f"run-{run_id:06d}-{uuid.uuid4().hex[:8]}.parquet"
+        write_results(os.path.join(self.runs_directory, data_file), rows)
+        entry = {'key': run_key(iteration, kwargs), 'run_id': run_id, 'iteration': iteration, 'seed': kwargs.get('seed'),
+                 'parameters': json.loads(json.dumps(kwargs, default=_journal_value)), 'data_file': data_file}
+        with open(self.path, 'ab+') as f:
+            # after a crash the last line may be cut off, the entry then starts on a new line
+            line = json.dumps(entry).encode() + b'\n'
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    line = b'\n' + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load_results(self, keys=None):
+        """Return the rows of the finished runs (of the runs with the given keys) as one DataFrame, ordered by run and step."""
+        entries = [entry for key, entry in self.completed().items() if keys is None or key in keys]
+        if not entries:
+            return pd.DataFrame()
+        df = pd.concat([pd.read_parquet(os.path.join(self.runs_directory, entry['data_file'])) for entry in entries],
+                       ignore_index=True)
+        return df.sort_values(['RunId', 'Step'], kind='stable', ignore_index=True)
+
+
+def sweep_runs(parameters, iterations):
+    """Return the runs of a sweep as (run id, iteration, model keyword arguments), numbered as in mesa's batch_run."""
+    return [(run_id, iteration, kwargs) for run_id, (iteration, kwargs)
+            in enumerate(itertools.product(range(iterations), _make_model_kwargs(parameters)))]
+
+
+def open_template_pool(runs, number_processes=None):
+    """
+    Return a TemplatePool that preloads the inputs of the input providers and flood maps of the runs,
+    and the worlds shared by several runs.
+    """
+    providers = {}
+    for _, _, kwargs in runs:
+        provider = kwargs.get('input_provider')
+        providers[None if provider is None else provider.cache_key()] = provider
+    flood_map_choices = sorted({kwargs.get('flood_map_choice', 'harvey') for _, _, kwargs in runs})
+    limits = [kwargs['raster_memory_limit'] for _, _, kwargs in runs if kwargs.get('raster_memory_limit') is not None]
+    return TemplatePool(number_processes, input_providers=list(providers.values()), flood_map_choices=flood_map_choices,
+                        baseline_worlds=shared_worlds(runs), raster_memory_limit=min(limits) if limits else None)
+
+
+def _run_task(task):
+    run, model_cls, max_steps, data_collection_period, metrics_sink = task
+    return run, run_model_run(run, max_steps, data_collection_period, model_cls=model_cls, metrics_sink=metrics_sink)
+
+
+def iterate_runs(runs, model_cls, max_steps, data_collection_period, number_processes=1, fork_server=False,
+                 metrics_sink=None):
+    """
+    Run the runs and yield (run, rows) in the order in which they finish: in this process if number_processes
+    is 1, otherwise on a process pool, or on a TemplatePool with fork_server.
+    """
+    if not runs:
+        return
+    tasks = [(run, model_cls, max_steps, data_collection_period, metrics_sink) for run in runs]
+    if fork_server:
+        pool = open_template_pool(runs, number_processes)
+    elif number_processes == 1:
+        pool = None
+    else:
+        pool = Pool(number_processes)
+    try:
+        yield from (pool.imap_unordered(_run_task, tasks) if pool is not None else map(_run_task, tasks))
+    except BaseException:
+        # do not wait for the remaining runs when the caller stops or fails
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def run_journaled(journal, model_cls, parameters, iterations, max_steps, data_collection_period,
+                  number_processes=1, display_progress=True, fork_server=False, metrics_sink=None):
+    """
+    Run the runs of a sweep that are not yet in the journal, recording each run as soon as it finishes.
+    The runs are numbered as in mesa's batch_run. Returns the results of all runs of the sweep.
+    """
+    runs = sweep_runs(parameters, iterations)
+    keys = {run_key(iteration, kwargs) for _, iteration, kwargs in runs}
+    completed = journal.completed()
+    missing = [run for run in runs if run_key(run[1], run[2]) not in completed]
+    if display_progress:
+        print(f"{len(runs) - len(missing)} of {len(runs)} runs found in journal {journal.path}, running {len(missing)}")
+    results = iterate_runs(missing, model_cls, max_steps, data_collection_period, number_processes, fork_server, metrics_sink)
+    for done, (run, rows) in enumerate(results, start=1):
+        journal.record(run[0], run[1], run[2], rows)
+        if display_progress:
+            print(f"run {run[0]} finished ({done}/{len(missing)})")
+    return journal.load_results(keys)
+
+
+def build_argument_parser(description="Run experiments with the flood adaptation model."):
+    """Return the argument parser with the options shared by the experiment scripts."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--scenario", type=int, default=None,
+                        help="0 for a single run, 1, 2, 3 or 4 to run the experiment of that scenario")
+    parser.add_argument("--memory-every", type=int, default=None, metavar="K",
+                        help="report the memory held per model component and the peak RSS every K steps")
+    parser.add_argument("--model-data-every", type=int, default=1, metavar="K",
+                        help="collect the model data every K steps")
+    parser.add_argument("--agent-data-every", type=collection_cadence, default=1, metavar="K",
+                        help="collect the agent data every K steps, or 'flood_events' for only the steps with a flood")
+    parser.add_argument("--journal", default=None, metavar="PATH",
+                        help="record every finished run in this journal and resume the sweep from it when run again")
+    parser.add_argument("--fork-server", action="store_true",
+                        help="run the runs on workers forked from a template process that loaded the inputs once")
+    parser.add_argument("--metrics", default=None, metavar="SINK",
+                        help="publish the step metrics of every run to 'file:PATH', 'udp://HOST:PORT' or 'prometheus://HOST:PORT'")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the model, all runs then share the same world (network and household placements)")
+    parser.add_argument("--world-cache-dir", default=None, metavar="DIR",
+                        help="cache the seeded worlds in DIR, so that later runs and sweeps load them instead of building them")
+    return parser
+
+
+def collection_cadence(value):
+    """Parse a collection cadence argument: a number of steps or 'flood_events'."""
+    if value == FLOOD_EVENTS:
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number of steps or '{FLOOD_EVENTS}', got '{value}'") from None
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Flood events for the Flood Adaptation Model.
+
+The FloodEventEngine updates the actual flood depth and damage of all households in one vectorized
+pass per step: the water recedes every step, and on the steps of a FloodEventSchedule a flood shock
+adds water. The flood map extent can be divided into zones, every zone then gets its own event
+intensity, so that floods can be local instead of global.
+"""
+import random
+
+import numpy as np
+
+from functions import calculate_basic_flood_damage_array
+
+
+class FloodEvent:
+    """
+    A flood shock at one step.
+
+    Parameters
+    ----------
+    step: model step at which the flood happens
+    intensity_range: the added depth is a uniform fraction in this range of the reference depth
+    flood_map_choice: flood map that gives the reference depth, None for the estimated depth of the households
+    zone_probability: probability that a zone is flooded by this event
+    """
+
+    def __init__(self, step, intensity_range=(0.4, 0.9), flood_map_choice=None, zone_probability=1.0):
+        self.step = step
+        self.intensity_range = intensity_range
+        self.flood_map_choice = flood_map_choice
+        self.zone_probability = zone_probability
+
+    def __repr__(self):
+        return f"FloodEvent(step={self.step}, flood_map_choice={self.flood_map_choice!r})"
+
+
+class FloodEventSchedule:
+    """
+    The flood events of a run.
+
+    Parameters
+    ----------
+    events: list of FloodEvents
+    period: if given, a flood event with the other keyword arguments happens every period steps (not at step 0)
+    """
+
+    def __init__(self, events=None, period=None, **event_kwargs):
+        self.events = {}
+        for event in events or []:
+            self.add(event)
+        self.period = period
+        self.event_kwargs = event_kwargs
+
+    def add(self, event):
+        self.events.setdefault(event.step, []).append(event)
+
+    @classmethod
+    def from_return_periods(cls, return_periods, max_steps, seed=None, **event_kwargs):
+        """
+        Draw a schedule in which the flood of every map happens each step with probability 1 / return period.
+
+        Parameters
+        ----------
+        return_periods: dictionary mapping flood map choice to return period in steps, e.g. {'100yr': 100, '500yr': 500}
+        max_steps: number of steps to draw events for
+        seed: seed of the draws
+        """
+        rng = np.random.default_rng(seed)
+        schedule = cls()
+        for flood_map_choice, return_period in return_periods.items():
+            for step in np.flatnonzero(rng.random(max_steps + 1) < 1 / return_period):
+                schedule.add(FloodEvent(int(step), flood_map_choice=flood_map_choice, **event_kwargs))
+        return schedule
+
+    def events_at(self, step):
+        """Return the list of flood events at step."""
+        events = self.events.get(step, [])
+        if self.period and step > 0 and step % self.period == 0:
+            events = events + [FloodEvent(step, **self.event_kwargs)]
+        return events
+
+
+class FloodZones:
+    """
+    Divides the flood map extent into zone_rows x zone_cols rectangular zones and stores the zone of every household.
+
+    Parameters
+    ----------
+    bounds: (left, bottom, right, top) of the flood map
+    zone_rows, zone_cols: number of zones in north-south and east-west direction
+    x, y: arrays with the household coordinates
+    """
+
+    def __init__(self, bounds, zone_rows, zone_cols, x, y):
+        left, bottom, right, top = bounds
+        self.zone_rows = zone_rows
+        self.zone_cols = zone_cols
+        self.number_of_zones = zone_rows * zone_cols
+        row = np.clip(((top - np.asarray(y)) / (top - bottom) * zone_rows).astype(np.int64), 0, zone_rows - 1)
+        col = np.clip(((np.asarray(x) - left) / (right - left) * zone_cols).astype(np.int64), 0, zone_cols - 1)
+        self.household_zone = row * zone_cols + col
+
+
+class FloodEventEngine:
+    """
+    Updates the actual flood depth and damage of all households every step.
+
+    Parameters
+    ----------
+    model: the AdaptationModel, its household_state holds the arrays that are updated
+    schedule: FloodEventSchedule, by default a flood every 5 steps
+    zones: (zone_rows, zone_cols) to flood per zone, None to draw the intensity for every household separately
+    seed: seed of the random draws, None to seed them from the random module, as the household agents drew them before
+    """
+
+    def __init__(self, model, schedule=None, zones=None, seed=None):
+        self.model = model
+        self.state = model.household_state
+        self.schedule = schedule if schedule is not None else FloodEventSchedule(period=5)
+        self.rng = np.random.default_rng(random.getrandbits(64) if seed is None else seed)
+        if zones is None:
+            self.zones = None
+        else:
+            self.zones = FloodZones(model.flood_map.bounds, zones[0], zones[1], model.world.x, model.world.y)
+        self._reference_depths = {}
+        # events that happened in the last call to step
+        self.current_events = []
+
+    def reference_depth(self, flood_map_choice):
+        """Return the depth per household that an event on flood_map_choice scales, cached per map."""
+        if flood_map_choice is None:
+            return self.state.flood_depth_estimated
+        if flood_map_choice not in self._reference_depths:
+            depth = self.model.sample_flood_depths(flood_map_choice).astype(np.float64)
+            self._reference_depths[flood_map_choice] = np.maximum(depth, 0)
+        return self._reference_depths[flood_map_choice]
+
+    def _intensity(self, event):
+        """Draw the intensity of an event per household, either per zone or per household."""
+        low, high = event.intensity_range
+        if self.zones is None:
+            intensity = self.rng.uniform(low, high, size=self.state.number_of_households)
+            if event.zone_probability < 1:
+                intensity *= self.rng.random(self.state.number_of_households) < event.zone_probability
+            return intensity
+        zone_intensity = self.rng.uniform(low, high, size=self.zones.number_of_zones)
+        if event.zone_probability < 1:
+            zone_intensity *= self.rng.random(self.zones.number_of_zones) < event.zone_probability
+        return zone_intensity[self.zones.household_zone]
+
+    def _damage(self):
+        model = self.model
+        return calculate_basic_flood_damage_array(self.state.flood_depth_actual, self.state.sandbags_placed,
+                                                  model.waterboard.adaptation_on_rivers_and_drainages,
+                                                  model.government.warning_system,
+                                                  model.policy_maker.infrastructure_government,
+                                                  damage_curve=model.damage_curve)
+
+    def step(self, step):
+        """Let the water recede and apply the flood events of this step to all households."""
+        state = self.state
+        depth_actual = state.flood_depth_actual
+        # the water recedes by a random fraction of the estimated flood depth
+        depth_actual -= self.rng.uniform(0.2, 0.5, size=state.number_of_households) * state.flood_depth_estimated
+        np.maximum(depth_actual, 0, out=depth_actual)
+        state.assign('flood_damage_actual', self._damage())
+
+        self.current_events = self.schedule.events_at(step)
+        for event in self.current_events:
+            # Calculate the actual flood depth as a random fraction of the reference flood depth
+            depth_actual += self._intensity(event) * self.reference_depth(event.flood_map_choice)
+        if self.current_events:
+            # calculate the actual flood damage given the actual flood depth
+            state.assign('flood_damage_actual', self._damage())
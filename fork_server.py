@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Fork-server worker pool for the Flood Adaptation Model.
+
+Every new model in a worker process reads the model domain and floodplain, opens and reads the flood
+map band and builds the social network and household placements. For short runs this start-up takes
+longer than the run itself. A TemplatePool starts one template process that imports the model, loads
+the static inputs once (see preload_inputs in input_providers.py) and optionally builds baseline worlds
+(see preload_world in world.py). The workers are forked from the template, so every run starts from
+the already loaded inputs in copy-on-write memory.
+
+Where processes cannot be forked (Windows), the workers are started normally and every worker loads
+the static inputs once in its initializer instead of once per run.
+"""
+import multiprocessing
+import signal
+from collections import Counter
+
+from input_providers import preload_inputs, get_default_input_provider
+from world import WORLD_PARAMETERS, preload_world
+
+
+def preload(input_providers=(), flood_map_choices=None, baseline_worlds=(), raster_memory_limit=None):
+    """
+    Load the static inputs and build the baseline worlds in this process.
+
+    Parameters
+    ----------
+    input_providers: providers of which the inputs are loaded, None in the list for the default provider
+    flood_map_choices: flood maps of which the bands are read, None for all choices of a provider
+    baseline_worlds: model keyword arguments (with a seed) of which the world is built and kept in memory
+    raster_memory_limit: bands larger than this number of bytes are not read, see AdaptationModel
+    """
+    # imported here, the model is only needed in the template process
+    from model import AdaptationModel
+    for input_provider in input_providers:
+        if input_provider is None:
+            input_provider = get_default_input_provider()
+        preload_inputs(input_provider, flood_map_choices, raster_memory_limit)
+    for kwargs in baseline_worlds:
+        preload_world(AdaptationModel(**kwargs))
+
+
+def shared_worlds(runs, minimum_runs=2):
+    """
+    Return the world keyword arguments that are shared by at least minimum_runs seeded runs, to be built as
+    baseline worlds. Worlds used by a single run are not worth building in the template process.
+
+    Parameters
+    ----------
+    runs: list of (run id, iteration, model keyword arguments)
+    """
+    worlds = {}
+    counts = Counter()
+    for _, _, kwargs in runs:
+        if kwargs.get('seed') is None:
+            continue
+        world_kwargs = {name: kwargs[name] for name in WORLD_PARAMETERS if name in kwargs}
+        key = repr(sorted((name, repr(value)) for name, value in world_kwargs.items()))
+        worlds[key] = world_kwargs
+        counts[key] += 1
+    return [worlds[key] for key, count in counts.items() if count >= minimum_runs]
+
+
+def _serve_template(connection, processes, preload_kwargs, maxtasksperchild):
+    """Main function of the template process: preload, fork the workers and run the tasks sent over connection."""
+    try:
+        preload(**preload_kwargs)
+        pool = multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=maxtasksperchild)
+    except Exception as error:
+        connection.send(('error', error))
+        return
+    connection.send(('ready', None))
+    # on terminate, leave the with block so that the forked workers are terminated as well
+    signal.signal(signal.SIGTERM, _exit_template)
+    with pool:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            function, tasks, chunksize = message
+            try:
+                for result in pool.imap_unordered(function, tasks, chunksize):
+                    connection.send(('result', result))
+            except Exception as error:
+                connection.send(('error', error))
+            else:
+                connection.send(('done', None))
+
+
+def _exit_template(signum, frame):
+    raise SystemExit(1)
+
+
+class TemplatePool:
+    """
+    Pool of worker processes forked from a template process with preloaded static inputs.
+
+    Parameters
+    ----------
+    processes: number of worker processes, None for all cores
+    input_providers, flood_map_choices, baseline_worlds, raster_memory_limit: preloaded inputs, see preload
+    maxtasksperchild: number of tasks after which a worker is replaced by a fresh fork of the template, None to keep the workers
+
+    The functions and tasks passed to the pool must be picklable, as with multiprocessing.Pool.
+    Only one imap_unordered or map call can be in progress at a time.
+    """
+
+    def __init__(self, processes=None, input_providers=(None,), flood_map_choices=None, baseline_worlds=(),
+                 raster_memory_limit=None, maxtasksperchild=None):
+        preload_kwargs = dict(input_providers=list(input_providers), flood_map_choices=flood_map_choices,
+                              baseline_worlds=list(baseline_worlds), raster_memory_limit=raster_memory_limit)
+        self._process = None
+        self._pool = None
+        self._busy = False
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            self._pool = multiprocessing.Pool(processes, initializer=_preload_kwargs, initargs=(preload_kwargs,),
+                                              maxtasksperchild=maxtasksperchild)
+            return
+        # the template is started with spawn, so that it does not inherit the threads and memory of this process
+        context = multiprocessing.get_context('spawn')
+        self._connection, template_connection = context.Pipe()
+        self._process = context.Process(target=_serve_template,
+                                        args=(template_connection, processes, preload_kwargs, maxtasksperchild))
+        self._process.start()
+        template_connection.close()
+        kind, value = self._connection.recv()
+        if kind == 'error':
+            self._process.join()
+            raise value
+
+    def imap_unordered(self, function, tasks, chunksize=1):
+        """Yield function(task) for all tasks in the order in which they finish."""
+        if self._pool is not None:
+            yield from self._pool.imap_unordered(function, tasks, chunksize)
+            return
+        self._connection.send((function, list(tasks), chunksize))
+        self._busy = True
+        while True:
+            kind, value = self._connection.recv()
+            if kind == 'result':
+                yield value
+            elif kind == 'done':
+                self._busy = False
+                return
+            else:
+                self._busy = False
+                raise value
+
+    def map(self, function, tasks, chunksize=1):
+        """Return function(task) for all tasks, in the order of the tasks."""
+        indexed = list(self.imap_unordered(_indexed_call, [(i, function, task) for i, task in enumerate(tasks)], chunksize))
+        return [result for _, result in sorted(indexed, key=lambda item: item[0])]
+
+    def close(self):
+        """Stop the workers and the template process once the running tasks are done, see join."""
+        if self._pool is not None:
+            self._pool.close()
+        elif self._process is not None:
+            if self._busy:
+                # the results of an abandoned imap_unordered are still coming in, the template cannot be stopped cleanly
+                self._process.terminate()
+            else:
+                self._connection.send(None)
+
+    def terminate(self):
+        """Stop the workers and the template process without waiting for the running tasks."""
+        if self._pool is not None:
+            self._pool.terminate()
+        elif self._process is not None:
+            self._process.terminate()
+
+    def join(self):
+        """Wait until the workers and the template process have stopped, after close."""
+        if self._pool is not None:
+            self._pool.join()
+        elif self._process is not None:
+            self._process.join()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        self.join()
+
+
+def _preload_kwargs(preload_kwargs):
+    preload(**preload_kwargs)
+
+
+def _indexed_call(item):
+    index, function, task = item
+    return index, function(task)
@@ -10,7 +10,6 @@ import numpy as np
 import math
 from shapely import contains_xy
 from shapely import prepare
-import geopandas as gpd
 
 def set_initial_values(input_data, parameter, seed):
     """
@@ -65,32 +64,53 @@ def get_flood_map_data(flood_map):
     bound_b = flood_map.bounds.bottom
     return band, bound_l, bound_r, bound_t, bound_b
 
-shapefile_path = r'../input_data/model_domain/houston_model/houston_model.shp'
-floodplain_path = r'../input_data/floodplain/floodplain_area.shp'
+def get_model_domain_data(input_provider):
+    """
+    Getting the model domain from the input provider.
 
-# Model area setup
-map_domain_gdf = gpd.GeoDataFrame.from_file(shapefile_path)
-map_domain_gdf = map_domain_gdf.to_crs(epsg=26915)
-map_domain_geoseries = map_domain_gdf['geometry']
-map_minx, map_miny, map_maxx, map_maxy = map_domain_geoseries.total_bounds
-map_domain_polygon = map_domain_geoseries[0]  # The geoseries contains only one polygon
-prepare(map_domain_polygon)
+    Parameters
+    ----------
+    input_provider: provider of the model inputs, see input_providers.py
 
-# Floodplain setup
-floodplain_gdf = gpd.GeoDataFrame.from_file(floodplain_path)
-floodplain_gdf = floodplain_gdf.to_crs(epsg=26915)
-floodplain_geoseries = floodplain_gdf['geometry']
-floodplain_multipolygon = floodplain_geoseries[0]  # The geoseries contains only one multipolygon
-prepare(floodplain_multipolygon)
+    Returns
+    -------
+    map_domain_gdf, map_domain_polygon: the model domain as GeoDataFrame and as prepared polygon
+    """
+    map_domain_gdf = input_provider.load_model_domain()
+    map_domain_polygon = map_domain_gdf['geometry'][0]  # The geoseries contains only one polygon
+    prepare(map_domain_polygon)
+    return map_domain_gdf, map_domain_polygon
 
-def generate_random_location_within_map_domain():
+def get_floodplain_data(input_provider):
+    """
+    Getting the floodplain from the input provider.
+
+    Parameters
+    ----------
+    input_provider: provider of the model inputs, see input_providers.py
+
+    Returns
+    -------
+    floodplain_gdf, floodplain_multipolygon: the floodplain as GeoDataFrame and as prepared multipolygon
+    """
+    floodplain_gdf = input_provider.load_floodplain()
+    floodplain_multipolygon = floodplain_gdf['geometry'][0]  # The geoseries contains only one multipolygon
+    prepare(floodplain_multipolygon)
+    return floodplain_gdf, floodplain_multipolygon
+
+def generate_random_location_within_map_domain(map_domain_polygon):
     """
     Generate random location coordinates within the map domain polygon.
 
+    Parameters
+    ----------
+    map_domain_polygon: (prepared) polygon of the model domain
+
     Returns
     -------
     x, y: lists of location coordinates, longitude and latitude
     """
+    map_minx, map_miny, map_maxx, map_maxy = map_domain_polygon.bounds
     while True:
         # generate random location coordinates within square area of map domain
         x = random.uniform(map_minx, map_maxx)
@@ -99,6 +119,33 @@ def generate_random_location_within_map_domain():
         if contains_xy(map_domain_polygon, x, y):
             return x, y
 
+def generate_random_locations_within_map_domain(map_domain_polygon, number_of_locations, rng):
+    """
+    Generate random location coordinates within the map domain polygon for many households at once.
+
+    Parameters
+    ----------
+    map_domain_polygon: (prepared) polygon of the model domain
+    number_of_locations: number of locations to generate
+    rng: numpy random Generator
+
+    Returns
+    -------
+    x, y: arrays of location coordinates, longitude and latitude
+    """
+    map_minx, map_miny, map_maxx, map_maxy = map_domain_polygon.bounds
+    xs, ys = [], []
+    missing = number_of_locations
+    while missing > 0:
+        # draw candidates within the square area of the map domain, keep those within the polygon
+        x = rng.uniform(map_minx, map_maxx, size=2 * missing + 16)
+        y = rng.uniform(map_miny, map_maxy, size=2 * missing + 16)
+        inside = contains_xy(map_domain_polygon, x, y)
+        xs.append(x[inside][:missing])
+        ys.append(y[inside][:missing])
+        missing -= len(xs[-1])
+    return np.concatenate(xs), np.concatenate(ys)
+
 def get_flood_depth(corresponding_map, location, band):
     """ 
     To get the flood depth of a specific location within the model domain.
@@ -140,7 +187,7 @@ def get_position_flood(bound_l, bound_r, bound_t, bound_b, img, seed):
     row, col = img.index(x, y)
     return x, y, row, col
 
-def calculate_basic_flood_damage(flood_depth, sandbags_household, waterboard_adaptation, warning_system_government, infrastructure):
+def calculate_basic_flood_damage(flood_depth, sandbags_household, waterboard_adaptation, warning_system_government, infrastructure, damage_curve=None):
     """
     To get flood damage based on flood depth of household
     from de Moer, Huizinga (2017) with logarithmic regression over it.
@@ -149,6 +196,7 @@ def calculate_basic_flood_damage(flood_depth, sandbags_household, waterboard_ada
     Parameters
     ----------
     flood_depth : flood depth as given by location within model domain
+    damage_curve : damage curve object used instead of the logarithmic regression, see damage_curves.py
 
     Returns
     -------
@@ -167,8 +215,37 @@ def calculate_basic_flood_damage(flood_depth, sandbags_household, waterboard_ada
             flood_damage = 0
             return flood_damage
             #exit()
+        if damage_curve is not None:
+            return damage_curve.scalar(input_damages)
         # see flood_damage.xlsx for function generation
         #flood_damage = 0.1746 * math.log(flood_depth) + 0.6483
         flood_damage = 0.1746 * math.log(input_damages) + 0.6483
     return flood_damage
 
+
+def calculate_basic_flood_damage_array(flood_depth, sandbags_household, waterboard_adaptation, warning_system_government, infrastructure, damage_curve=None):
+    """
+    Vectorized version of calculate_basic_flood_damage for arrays of households, giving the same results.
+
+    Parameters
+    ----------
+    flood_depth : array of flood depths
+    sandbags_household : array (or scalar) of sandbags placed by the households
+    waterboard_adaptation, warning_system_government, infrastructure : values as used by calculate_basic_flood_damage
+    damage_curve : damage curve object used instead of the logarithmic regression, see damage_curves.py
+
+    Returns
+    -------
+    flood_damage : array of damage factors between 0 and 1
+    """
+    flood_depth = np.asarray(flood_depth, dtype=np.float64)
+    # as in calculate_basic_flood_damage, only the sandbags and the waterboard adaptation lower the input
+    input_damages = flood_depth - (0.05 * np.asarray(sandbags_household)) - (0.15 * waterboard_adaptation)
+    flood_damage = np.zeros_like(flood_depth)
+    valid = (flood_depth >= 0.025) & (flood_depth < 6) & (input_damages > 0.025)
+    if damage_curve is not None:
+        flood_damage[valid] = damage_curve.array(input_damages[valid])
+    else:
+        flood_damage[valid] = 0.1746 * np.log(input_damages[valid]) + 0.6483
+    flood_damage[flood_depth >= 6] = 1
+    return flood_damage
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Delta-encoded agent history for the Flood Adaptation Model.
+
+Most agent variables collected every step are constant (location, estimated flood depth, number of
+friends) or change for few agents per step (adaptation, insurance). The DeltaDataCollector stores
+static variables once per agent, and dynamic variables as the indices and new values of the agents
+whose value changed since the previous collection, with a full keyframe every keyframe_every
+collections. Full frames are reconstructed on read, in the same format as the Mesa DataCollector,
+so get_agent_vars_dataframe and the Mesa batch_run work unchanged.
+"""
+import bisect
+import itertools
+from collections.abc import Mapping
+
+import pandas as pd
+
+from data_collection import StepDataCollector
+
+
+class AgentHistory(Mapping):
+    """
+    Delta-encoded agent records, a read-only mapping from step to the list of records
+    (step, agent id, value per reporter) of the Mesa DataCollector.
+
+    Parameters
+    ----------
+    names: names of the agent reporters, in record order
+    static_names: names of the reporters that are constant per agent
+    keyframe_every: store all dynamic values every k collections, so a frame is rebuilt from at most k - 1 deltas
+    """
+
+    def __init__(self, names, static_names=(), keyframe_every=50):
+        self.names = list(names)
+        self.static_names = [name for name in self.names if name in set(static_names)]
+        self.dynamic_names = [name for name in self.names if name not in set(static_names)]
+        self.keyframe_every = keyframe_every
+        # per reporter: whether it is static and its position among the static or dynamic reporters
+        self._positions = [(True, self.static_names.index(name)) if name in self.static_names
+                           else (False, self.dynamic_names.index(name)) for name in self.names]
+        # static values per agent id, in the order of static_names
+        self.static_values = {}
+        # recorded steps, and per step either ('keyframe', ids, columns) or ('delta', changes)
+        # where changes holds (indices, values) per dynamic column
+        self.steps = []
+        self._entries = {}
+        self._keyframe_steps = []
+        # agent ids and dynamic values of the last collection, the base of the next delta
+        self._ids = None
+        self._columns = None
+        self._since_keyframe = 0
+
+    def record(self, step, ids, columns):
+        """
+        Store the dynamic values of one collection.
+
+        Parameters
+        ----------
+        step: model step of the collection, must be larger than the previously recorded step
+        ids: tuple with the unique ids of the agents
+        columns: list with the values of every agent per dynamic reporter
+        """
+        if self.steps and step <= self.steps[-1]:
+            raise ValueError(f"Agent history recorded step {self.steps[-1]}, cannot record step {step} after it")
+        if self._ids != ids or self._since_keyframe >= self.keyframe_every - 1:
+            # a keyframe when the agents changed or keyframe_every collections have passed
+            self._entries[step] = ('keyframe', ids, columns)
+            self._keyframe_steps.append(step)
+            self._since_keyframe = 0
+        else:
+            changes = []
+            for previous, current in zip(self._columns, columns):
+                indices = [i for i, (a, b) in enumerate(zip(previous, current)) if a is not b and a != b]
+                changes.append((indices, [current[i] for i in indices]) if indices else None)
+            self._entries[step] = ('delta', changes)
+            self._since_keyframe += 1
+        self.steps.append(step)
+        self._ids = ids
+        self._columns = columns
+
+    def _frames(self, start=0):
+        """Yield (step, ids, dynamic columns) for the recorded steps from index start on, applying the deltas."""
+        if start >= len(self.steps):
+            return
+        # rebuild from the last keyframe at or before the first requested step
+        keyframe = self._keyframe_steps[bisect.bisect_right(self._keyframe_steps, self.steps[start]) - 1]
+        ids = columns = None
+        for step in self.steps[bisect.bisect_left(self.steps, keyframe):]:
+            entry = self._entries[step]
+            if entry[0] == 'keyframe':
+                ids = entry[1]
+                columns = [list(column) for column in entry[2]]
+            else:
+                for column, change in zip(columns, entry[1]):
+                    if change is not None:
+                        for i, value in zip(*change):
+                            column[i] = value
+            if step >= self.steps[start]:
+                yield step, ids, columns
+
+    def _records(self, step, ids, columns):
+        """Return the Mesa DataCollector records of one frame."""
+        static = [self.static_values[agent_id] for agent_id in ids]
+        return [(step, agent_id) + tuple(static[i][j] if is_static else columns[j][i] for is_static, j in self._positions)
+                for i, agent_id in enumerate(ids)]
+
+    def __getitem__(self, step):
+        index = bisect.bisect_left(self.steps, step)
+        if index == len(self.steps) or self.steps[index] != step:
+            raise KeyError(step)
+        for frame in self._frames(index):
+            return self._records(*frame)
+
+    def __contains__(self, step):
+        # without rebuilding the frame, as Mapping.__contains__ would
+        index = bisect.bisect_left(self.steps, step)
+        return index < len(self.steps) and self.steps[index] == step
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def replay(self, step, source):
+        """Record the dynamic values of the recorded step source again for step, for a fast-forwarded model."""
+        for _, ids, columns in self._frames(bisect.bisect_left(self.steps, source)):
+            self.record(step, ids, [list(column) for column in columns])
+            return
+
+    def values(self):
+        # rebuild the frames in one pass instead of from the keyframe for every step
+        return [self._records(*frame) for frame in self._frames()]
+
+    def items(self):
+        return list(zip(self.steps, self.values()))
+
+    def to_columns(self):
+        """Return the steps, agent ids and the values per reporter of all frames as flat lists."""
+        steps, agent_ids = [], []
+        values = {name: [] for name in self.names}
+        for step, ids, columns in self._frames():
+            steps.extend(itertools.repeat(step, len(ids)))
+            agent_ids.extend(ids)
+            for name, column in zip(self.dynamic_names, columns):
+                values[name].extend(column)
+            for j, name in enumerate(self.static_names):
+                values[name].extend(self.static_values[agent_id][j] for agent_id in ids)
+        return steps, agent_ids, values
+
+    def number_of_stored_values(self):
+        """Return the number of values held, to compare with len(steps) x agents x reporters of a full history."""
+        stored = len(self.static_values) * len(self.static_names)
+        for entry in self._entries.values():
+            if entry[0] == 'keyframe':
+                stored += sum(len(column) for column in entry[2])
+            else:
+                stored += sum(len(change[0]) for change in entry[1] if change is not None)
+        return stored
+
+
+class DeltaDataCollector(StepDataCollector):
+    """
+    StepDataCollector that stores the agent variables delta-encoded in an AgentHistory.
+
+    Parameters
+    ----------
+    model_reporters, agent_reporters, tables: as for the Mesa DataCollector
+    static_reporters: names of agent reporters that are constant per agent, they are evaluated only
+                      the first time an agent is collected
+    keyframe_every: see AgentHistory
+    """
+
+    def __init__(self, model_reporters=None, agent_reporters=None, tables=None, static_reporters=(), keyframe_every=50):
+        super().__init__(model_reporters=model_reporters, agent_reporters=agent_reporters, tables=tables)
+        self._agent_records = AgentHistory(self.agent_reporters, static_reporters, keyframe_every)
+
+    def _record_agents(self, model):
+        """Record the static variables of new agents and the dynamic variables of all agents."""
+        history = self._agent_records
+        agents = model.schedule.agents
+        static_reporters = [self.agent_reporters[name] for name in history.static_names]
+        for agent in agents:
+            if agent.unique_id not in history.static_values:
+                history.static_values[agent.unique_id] = tuple(reporter(agent) for reporter in static_reporters)
+        columns = [[reporter(agent) for agent in agents]
+                   for reporter in (self.agent_reporters[name] for name in history.dynamic_names)]
+        history.record(model.schedule.steps, tuple(agent.unique_id for agent in agents), columns)
+
+    def collect_agent_vars(self, model):
+        if self.agent_reporters:
+            self._record_agents(model)
+
+    def _replay_agent_vars(self, step, source):
+        self._agent_records.replay(step, source)
+
+    def get_agent_vars_dataframe(self):
+        """Create the DataFrame of the agent variables, with the same layout as the Mesa DataCollector."""
+        if not self.agent_reporters:
+            raise UserWarning(
+                "No agent reporters have been defined in the DataCollector, returning empty DataFrame."
+            )
+        steps, agent_ids, values = self._agent_records.to_columns()
+        index = pd.MultiIndex.from_arrays([steps, agent_ids], names=["Step", "AgentID"])
+        return pd.DataFrame(values, index=index, columns=list(self.agent_reporters))
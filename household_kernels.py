@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Array update of the households for the Flood Adaptation Model.
+
+The ArrayHouseholdUpdate replaces the step and advance of the household agents by vectorized kernels
+on the arrays of the household_state (see household_state.py), so that a single model with a very large
+number of households does not loop over its agents in Python. The households are split into chunks of
+chunk_size consecutive nodes, small enough that the columns a kernel reads and writes stay in the cache
+of a core, and the chunks are updated on a thread pool. NumPy releases the GIL in its array operations,
+so the chunks run in parallel.
+
+Within a phase every household only writes its own elements and reads arrays that are not written
+in that phase, so the result does not depend on the chunk size or the number of threads:
+
+    step: every household averages the political perceptions of its neighbours at the start of the
+          step, as simultaneous activation intends. The step of the household agents reads the
+          perceptions that neighbours earlier in the order already updated, so the array update
+          gives different (but equally valid) perceptions
+    advance: the same decisions as the advance of the household agents, with the values of the other
+             agents from the HouseholdContext. The uncertainty of the estimated flood damage is drawn
+             for all households at once from the random generator of the update instead of from the
+             random module
+
+The update keeps the last three past flood damages of every household in its own arrays. The
+past_flood_damages of the household agents are replaced by read-only views of these arrays, so they
+only hold the last three past flood damages, the oldest first.
+
+The thread pool belongs to the update and is shut down by close, or when the update is garbage collected.
+"""
+import os
+import random
+import weakref
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from functions import calculate_basic_flood_damage_array
+
+# households per chunk, the ten or so float64 columns of a chunk take about 1 MB
+DEFAULT_CHUNK_SIZE = 16384
+
+# savings of every household, as set in the step of the household agents
+SAVINGS_HOUSEHOLD = 1
+
+
+class PastFloodDamages(Sequence):
+    """Read-only view of the last three past flood damages of a household in an ArrayHouseholdUpdate, the oldest first."""
+
+    __slots__ = ('past_damages', 'node')
+
+    def __init__(self, past_damages, node):
+        self.past_damages = past_damages
+        self.node = node
+
+    def __len__(self):
+        return len(self.past_damages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if not -len(self) <= index < len(self):
+            raise IndexError("past flood damages index out of range")
+        # the arrays hold the last past flood damage first
+        return self.past_damages[-1 - index % len(self), self.node].item()
+
+    def __repr__(self):
+        return f"PastFloodDamages({list(self)})"
+
+
+class ArrayHouseholdUpdate:
+    """
+    Updates all households on their arrays, as the step and advance phase functions of the households
+    (see PhasedActivation.set_phase_function).
+
+    Parameters
+    ----------
+    model: the AdaptationModel
+    threads: number of threads that update the chunks, None for the number of cores
+    chunk_size: number of households per chunk, None for DEFAULT_CHUNK_SIZE
+    seed: seed of the uncertainty of the estimated flood damage, None to seed it from the random module
+    """
+
+    def __init__(self, model, threads=None, chunk_size=None, seed=None):
+        self.model = model
+        self.state = model.household_state
+        self.threads = threads or os.cpu_count() or 1
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        number_of_households = self.state.number_of_households
+        self.chunks = [(start, min(start + chunk_size, number_of_households))
+                       for start in range(0, number_of_households, chunk_size)]
+        self.rng = np.random.default_rng(random.getrandbits(64) if seed is None else seed)
+        network = model.social_network
+        self.indptr = network.indptr
+        self.indices = network.indices
+        # last three past flood damages of every household, the last one first
+        self.past_damages = np.array([[household.past_flood_damages[-k] for household in model.households]
+                                      for k in (1, 2, 3)], dtype=np.float64)
+        for household in model.households:
+            household.past_flood_damages = PastFloodDamages(self.past_damages, household.node)
+        # political perceptions at the start of the step phase and the perceptions written in it
+        self._perception = None
+        self._new_perception = np.empty(number_of_households)
+        # thread pool of the chunks, started on the first update with several chunks
+        self._executor = None
+        self._finalizer = None
+
+    def close(self):
+        """Shut down the thread pool, a later update starts a new one."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._executor = None
+        self._finalizer = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='households')
+            # the finalizer holds the pool but not the update, so that the update can still be collected
+            self._finalizer = weakref.finalize(self, self._executor.shutdown, wait=False)
+        return self._executor
+
+    def _run(self, kernel, *args):
+        """Run kernel(start, stop, *args) on all chunks, on the thread pool when there are several threads."""
+        if self.threads == 1 or len(self.chunks) == 1:
+            for start, stop in self.chunks:
+                kernel(start, stop, *args)
+            return
+        executor = self._get_executor()
+        futures = [executor.submit(kernel, start, stop, *args) for start, stop in self.chunks]
+        for future in futures:
+            # re-raises the exception of a failed chunk
+            future.result()
+
+    def step_households(self, households):
+        """Update the political perception of all households from those of their neighbours at the start of the step."""
+        self._perception = self.state.political_perception.copy()
+        self._run(self._step_chunk)
+        self.state.assign('political_perception', self._new_perception)
+
+    def _step_chunk(self, start, stop):
+        indptr, perception = self.indptr, self._perception
+        neighbours = perception[self.indices[indptr[start]:indptr[stop]]]
+        degree = np.diff(indptr[start:stop + 1])
+        offsets = indptr[start:stop] - indptr[start]
+        has_neighbours = degree > 0
+        # households without neighbours keep their own perception as the average of their neighbours
+        average = perception[start:stop].copy()
+        if neighbours.size:
+            average[has_neighbours] = np.add.reduceat(neighbours, offsets[has_neighbours]) / degree[has_neighbours]
+        self._new_perception[start:stop] = 0.3*perception[start:stop] + 0.7*average
+
+    def advance_households(self, households):
+        """Let all households decide on insurance and sandbags, as the advance of the household agents."""
+        context = self.model.household_context()
+        # drawn for all households at once, so that it does not depend on the chunks
+        noise = self.rng.integers(-10, 10, size=self.state.number_of_households)
+        self._run(self._advance_chunk, context, noise)
+        self.state.refresh_sum('is_adapted')
+
+    def _advance_chunk(self, start, stop, context, noise):
+        columns = self.state.columns
+        past = self.past_damages
+        chunk = slice(start, stop)
+        # attitude of the step: the average of the last three past flood damages
+        attitude = (past[2, chunk] + past[1, chunk] + past[0, chunk]) / 3
+
+        # calculate the estimated flood damage given the actual flood depth, with its uncertainty
+        expected = calculate_basic_flood_damage_array(columns['flood_depth_actual'][chunk], columns['sandbags_placed'][chunk],
+                                                      context.waterboard_adaptation, context.warning_system_government,
+                                                      context.infrastructure, damage_curve=self.model.damage_curve)
+        estimated = expected + noise[chunk]/100
+        willingness = ((estimated < 0.6) & (context.total_policy_value > 2)).astype(np.int64)
+
+        #determine if the households take an insurance of this time period
+        insurance_taken = (0.3*context.subsidies + 0.3*willingness + 0.3*context.media_platform_usage
+                           + 0.5*context.infrastructure_government + 0.1*SAVINGS_HOUSEHOLD/1000 + 0.3*attitude)
+        insurance_taken = np.where(insurance_taken < 1.5, 0, 1)
+
+        # append the actual flood damage to the past flood damages and compute the new attitude
+        damage = columns['flood_damage_actual'][chunk]
+        attitude = (past[1, chunk] + past[0, chunk] + damage) / 3
+        past[2, chunk] = past[1, chunk]
+        past[1, chunk] = past[0, chunk]
+        past[0, chunk] = damage
+
+        #determine sandbags placed by the households, and whether they adapted
+        sandbags = (2*context.provide_information + 3*context.subsidies + 2*context.regulation
+                    - 5*context.infrastructure_government - 3*insurance_taken + 1*SAVINGS_HOUSEHOLD/1000 + 3*attitude)
+        np.maximum(sandbags, 0, out=sandbags)
+
+        columns['flood_damage_estimated'][chunk] = estimated
+        columns['insurance_taken_by_household'][chunk] = insurance_taken
+        columns['household_attitude'][chunk] = attitude
+        columns['sandbags_placed'][chunk] = sandbags
+        columns['is_adapted'][chunk] = sandbags > 6
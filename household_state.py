@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Array storage of household attributes for the Flood Adaptation Model.
+
+Attributes that model wide code updates for all households at once (e.g. the flood depths in the
+flood event engine) are stored in one NumPy array per attribute instead of on the agent objects.
+The Households class exposes them as normal attributes through StateColumn descriptors, so agent
+code reads and writes them as before while the model can update them in vectorized passes.
+
+For the tracked columns the HouseholdState keeps the sum over all households up to date on every
+write, so that model wide totals and averages are O(1) reads instead of passes over all agents.
+Adding every change to a running sum accumulates rounding errors, so the model recomputes the sums
+from the arrays once per step with refresh_sums, one vectorized pass per tracked column.
+"""
+import numpy as np
+
+
+class StateColumn:
+    """Descriptor exposing element agent.node of a HouseholdState column as an agent attribute."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        return agent.state_columns[self.name].item(agent.node)
+
+    def __set__(self, agent, value):
+        agent.state_columns[self.name][agent.node] = value
+
+
+class TrackedStateColumn(StateColumn):
+    """StateColumn that also updates the running sum of the column in the HouseholdState."""
+
+    def __set__(self, agent, value):
+        column = agent.state_columns[self.name]
+        old = column.item(agent.node)
+        column[agent.node] = value
+        agent.state_sums[self.name] += column.item(agent.node) - old
+
+
+class HouseholdState:
+    """
+    One array per household attribute, indexed by the node of the household in the social network.
+
+    Parameters
+    ----------
+    number_of_households: length of the arrays
+    """
+
+    # attribute name and dtype of every column
+    COLUMNS = {
+        'flood_depth_estimated': np.float64,
+        'flood_depth_actual': np.float64,
+        'flood_damage_actual': np.float64,
+        'flood_damage_estimated': np.float64,
+        'household_attitude': np.float64,
+        'insurance_taken_by_household': np.int64,
+        'sandbags_placed': np.float64,
+        'is_adapted': np.bool_,
+        'political_perception': np.float64,
+    }
+
+    # columns of which the sum over all households is maintained incrementally
+    TRACKED_COLUMNS = ('flood_damage_actual', 'is_adapted', 'political_perception')
+
+    def __init__(self, number_of_households):
+        self.number_of_households = number_of_households
+        self.columns = {name: np.zeros(number_of_households, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.sums = {name: 0 for name in self.TRACKED_COLUMNS}
+
+    def assign(self, name, values):
+        """Overwrite a whole column, e.g. with the result of a vectorized update, and update its sum."""
+        self.columns[name][:] = values
+        if name in self.sums:
+            self.sums[name] = self.columns[name].sum().item()
+
+    def refresh_sum(self, name):
+        """Recompute the sum of a tracked column after it was written in place, e.g. in chunks."""
+        self.sums[name] = self.columns[name].sum().item()
+
+    def refresh_sums(self):
+        """Recompute the sums of all tracked columns, discarding the rounding errors of the running sums."""
+        for name in self.TRACKED_COLUMNS:
+            self.refresh_sum(name)
+
+    def recompute_sums(self):
+        """Return the sums of the tracked columns recomputed from the arrays, used to verify the running sums."""
+        return {name: self.columns[name].sum().item() for name in self.TRACKED_COLUMNS}
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name) from None
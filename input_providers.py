@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Input providers for the Flood Adaptation Model.
+
+An input provider hands the model its static spatial inputs: the model domain polygon,
+the floodplain multipolygon and the flood depth rasters. The FileInputProvider reads the
+Houston shapefiles and tif-files from ../input_data, the SyntheticInputProvider generates
+inputs of configurable size and resolution so that the model can be run and benchmarked
+on any machine.
+"""
+import hashlib
+import math
+import os
+import tempfile
+
+import numpy as np
+import geopandas as gpd
+import rasterio as rs
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import Polygon, MultiPolygon, LineString
+
+from functions import get_model_domain_data, get_floodplain_data, get_flood_map_data
+
+# coordinate reference system used throughout the model (NAD83 / UTM zone 15N)
+MODEL_CRS = "EPSG:26915"
+
+
+class FileInputProvider:
+    """
+    Reads the model inputs from shapefiles and tif-files on disk.
+    The loaded geometries are kept on the provider, so several models sharing one provider only read them once.
+    """
+
+    def __init__(self,
+                 model_domain_path=r'../input_data/model_domain/houston_model/houston_model.shp',
+                 floodplain_path=r'../input_data/floodplain/floodplain_area.shp',
+                 flood_map_paths=None):
+        self.model_domain_path = model_domain_path
+        self.floodplain_path = floodplain_path
+        if flood_map_paths is None:
+            flood_map_paths = {
+                'harvey': r'../input_data/floodmaps/Harvey_depth_meters.tif',
+                '100yr': r'../input_data/floodmaps/100yr_storm_depth_meters.tif',
+                '500yr': r'../input_data/floodmaps/500yr_storm_depth_meters.tif'
+            }
+        self.flood_map_paths = flood_map_paths
+        self._model_domain_gdf = None
+        self._floodplain_gdf = None
+
+    def __repr__(self):
+        return f"FileInputProvider('{self.model_domain_path}')"
+
+    def __getstate__(self):
+        # do not ship loaded geometries to worker processes, they are cheaper to re-read
+        state = self.__dict__.copy()
+        state['_model_domain_gdf'] = None
+        state['_floodplain_gdf'] = None
+        return state
+
+    def cache_key(self):
+        """Return a string that changes whenever the inputs of this provider change, used to cache derived data."""
+        paths = [self.model_domain_path, self.floodplain_path] + [self.flood_map_paths[choice] for choice in sorted(self.flood_map_paths)]
+        return repr([(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in paths])
+
+    def flood_map_choices(self):
+        """Return the flood map choices this provider can open."""
+        return list(self.flood_map_paths.keys())
+
+    def load_model_domain(self):
+        """Return the model domain as a GeoDataFrame in the model crs."""
+        if self._model_domain_gdf is None:
+            self._model_domain_gdf = gpd.GeoDataFrame.from_file(self.model_domain_path).to_crs(MODEL_CRS)
+        return self._model_domain_gdf
+
+    def load_floodplain(self):
+        """Return the floodplain as a GeoDataFrame in the model crs."""
+        if self._floodplain_gdf is None:
+            self._floodplain_gdf = gpd.GeoDataFrame.from_file(self.floodplain_path).to_crs(MODEL_CRS)
+        return self._floodplain_gdf
+
+    def flood_map_path(self, flood_map_choice):
+        """Return the path of the tif-file belonging to the flood map choice."""
+        return self.flood_map_paths[flood_map_choice]
+
+    def open_flood_map(self, flood_map_choice):
+        """Open the flood map belonging to the flood map choice as a rasterio dataset."""
+        return rs.open(self.flood_map_path(flood_map_choice))
+
+
+class SyntheticInputProvider(FileInputProvider):
+    """
+    Generates a synthetic model domain, floodplain and flood depth rasters.
+
+    The domain is an irregular polygon inside the raster extent, the floodplain is a band around
+    one or more meandering rivers and the flood depth decays with the distance to the nearest river.
+    Rasters are written block by block as tiled GeoTIFFs, so also rasters that do not fit in memory
+    can be generated. Generated files are reused when a provider with the same settings asks for them again.
+
+    Parameters
+    ----------
+    raster_width, raster_height: size of the flood depth rasters in cells
+    resolution: cell size in meters
+    number_of_rivers: number of rivers, each river adds one polygon to the floodplain multipolygon
+    floodplain_width: width of the floodplain band around a river in meters
+    max_depth: flood depth at the river for the 'harvey' map in meters
+    seed: seed used for the geometry and the depth noise
+    directory: directory in which the rasters are written. None for a directory per cache key in the temporary
+               directory of the system, so that all processes with the same settings share the rasters
+    block_size: tile size of the written GeoTIFFs
+    compress: GeoTIFF compression, e.g. 'deflate' for very large rasters
+    """
+
+    # size presets, the 'huge' preset writes a raster of several GB and is meant for scaling runs
+    PRESETS = {
+        'small': dict(raster_width=500, raster_height=400, resolution=60.0),
+        'medium': dict(raster_width=4000, raster_height=3200, resolution=15.0),
+        'large': dict(raster_width=16000, raster_height=12800, resolution=4.0),
+        'huge': dict(raster_width=60000, raster_height=48000, resolution=1.0, compress='deflate'),
+    }
+
+    # depth multiplier per flood map choice
+    FLOOD_MAP_SCALES = {'harvey': 1.0, '100yr': 0.6, '500yr': 0.8}
+
+    def __init__(self,
+                 raster_width=1000,
+                 raster_height=800,
+                 resolution=30.0,
+                 number_of_rivers=2,
+                 floodplain_width=None,
+                 max_depth=4.0,
+                 seed=0,
+                 directory=None,
+                 block_size=512,
+                 compress=None):
+        self.raster_width = int(raster_width)
+        self.raster_height = int(raster_height)
+        self.resolution = float(resolution)
+        self.number_of_rivers = int(number_of_rivers)
+        self.max_depth = float(max_depth)
+        self.seed = seed
+        self.block_size = int(block_size)
+        self.compress = compress
+        # lower left corner roughly at Houston in UTM 15N
+        self.origin_x = 250000.0
+        self.origin_y = 3280000.0
+        self.extent_x = self.raster_width * self.resolution
+        self.extent_y = self.raster_height * self.resolution
+        if floodplain_width is None:
+            floodplain_width = 0.04 * self.extent_y
+        self.floodplain_width = float(floodplain_width)
+        if directory is None:
+            # chosen here and not on the first use, so that pickled copies in worker processes use the same rasters
+            directory = os.path.join(tempfile.gettempdir(), f"synthetic_input_{self.cache_key()}")
+        self.directory = directory
+        self._model_domain_gdf = None
+        self._floodplain_gdf = None
+        self._rivers = self._generate_rivers()
+
+    @classmethod
+    def from_preset(cls, preset, **kwargs):
+        """Create a provider from one of the PRESETS, keyword arguments override the preset values."""
+        if preset not in cls.PRESETS:
+            raise ValueError(f"Unknown synthetic input preset: '{preset}'. "
+                             f"Currently implemented presets are: {list(cls.PRESETS.keys())}")
+        settings = dict(cls.PRESETS[preset])
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def __repr__(self):
+        return (f"SyntheticInputProvider({self.raster_width}x{self.raster_height}, "
+                f"resolution={self.resolution}, seed={self.seed})")
+
+    def _generate_rivers(self):
+        #each river is a sine wave crossing the domain from west to east: (centre_y, amplitude, wavelength, phase)
+        rng = np.random.default_rng(self.seed)
+        rivers = []
+        for i in range(self.number_of_rivers):
+            centre_y = self.origin_y + self.extent_y * (i + 1) / (self.number_of_rivers + 1)
+            amplitude = rng.uniform(0.03, 0.08) * self.extent_y
+            wavelength = rng.uniform(0.3, 0.7) * self.extent_x
+            phase = rng.uniform(0, 2 * math.pi)
+            rivers.append((centre_y, amplitude, wavelength, phase))
+        return rivers
+
+    def _distance_to_rivers(self, x, y):
+        #vertical distance to the nearest river, a cheap stand-in for the euclidean distance
+        distance = np.full(np.broadcast(x, y).shape, np.inf)
+        for centre_y, amplitude, wavelength, phase in self._rivers:
+            river_y = centre_y + amplitude * np.sin(2 * math.pi * (x - self.origin_x) / wavelength + phase)
+            distance = np.minimum(distance, np.abs(y - river_y))
+        return distance
+
+    def cache_key(self):
+        return self._settings_key(None)
+
+    def flood_map_choices(self):
+        return list(self.FLOOD_MAP_SCALES.keys())
+
+    def load_model_domain(self):
+        if self._model_domain_gdf is None:
+            #irregular polygon around the centre of the raster extent with a noisy radius
+            rng = np.random.default_rng([self.seed, 1])
+            angles = np.linspace(0, 2 * math.pi, 64, endpoint=False)
+            radius = 0.45 * rng.uniform(0.8, 1.0, size=angles.size)
+            centre_x = self.origin_x + 0.5 * self.extent_x
+            centre_y = self.origin_y + 0.5 * self.extent_y
+            polygon = Polygon(zip(centre_x + radius * self.extent_x * np.cos(angles),
+                                  centre_y + radius * self.extent_y * np.sin(angles)))
+            self._model_domain_gdf = gpd.GeoDataFrame(geometry=[polygon], crs=MODEL_CRS)
+        return self._model_domain_gdf
+
+    def load_floodplain(self):
+        if self._floodplain_gdf is None:
+            domain = self.load_model_domain()['geometry'][0]
+            x = np.linspace(self.origin_x, self.origin_x + self.extent_x, 256)
+            polygons = []
+            for centre_y, amplitude, wavelength, phase in self._rivers:
+                river_y = centre_y + amplitude * np.sin(2 * math.pi * (x - self.origin_x) / wavelength + phase)
+                band = LineString(zip(x, river_y)).buffer(self.floodplain_width / 2).intersection(domain)
+                if not band.is_empty:
+                    polygons.extend(getattr(band, 'geoms', [band]))
+            self._floodplain_gdf = gpd.GeoDataFrame(geometry=[MultiPolygon(polygons)], crs=MODEL_CRS)
+        return self._floodplain_gdf
+
+    def _settings_key(self, flood_map_choice):
+        settings = (self.raster_width, self.raster_height, self.resolution, self.number_of_rivers,
+                    self.floodplain_width, self.max_depth, self.seed, self.block_size, self.compress, flood_map_choice)
+        return hashlib.sha1(repr(settings).encode()).hexdigest()[:16]
+
+    def flood_map_path(self, flood_map_choice):
+        if flood_map_choice not in self.FLOOD_MAP_SCALES:
+            raise KeyError(flood_map_choice)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"synthetic_{flood_map_choice}_{self._settings_key(flood_map_choice)}.tif")
+        if not os.path.exists(path):
+            self._write_flood_map(path, flood_map_choice)
+        return path
+
+    def _write_flood_map(self, path, flood_map_choice):
+        """Write the depth raster block by block so that the full band is never held in memory."""
+        scale = self.FLOOD_MAP_SCALES[flood_map_choice] * self.max_depth
+        decay = 2.0 * self.floodplain_width
+        profile = dict(driver='GTiff', dtype='float32', count=1,
+                       width=self.raster_width, height=self.raster_height,
+                       crs=MODEL_CRS, nodata=None,
+                       transform=from_origin(self.origin_x, self.origin_y + self.extent_y, self.resolution, self.resolution),
+                       tiled=True, blockxsize=self.block_size, blockysize=self.block_size,
+                       BIGTIFF='IF_SAFER')
+        if self.compress is not None:
+            profile.update(compress=self.compress, predictor=3)
+        #write to a temporary name first, so an interrupted run never leaves a half written raster behind.
+        #The name is per process, processes that generate the same raster at the same time each replace it with an equal file
+        partial_path = f"{path}.{os.getpid()}.partial"
+        with rs.open(partial_path, 'w', **profile) as dst:
+            for block_row in range(0, self.raster_height, self.block_size):
+                for block_col in range(0, self.raster_width, self.block_size):
+                    window = Window(block_col, block_row,
+                                    min(self.block_size, self.raster_width - block_col),
+                                    min(self.block_size, self.raster_height - block_row))
+                    cols = block_col + np.arange(window.width) + 0.5
+                    rows = block_row + np.arange(window.height) + 0.5
+                    x = self.origin_x + cols[np.newaxis, :] * self.resolution
+                    y = self.origin_y + self.extent_y - rows[:, np.newaxis] * self.resolution
+                    # depth decays with distance to the river and turns negative on higher grounds
+                    depth = scale * (1.25 * np.exp(-self._distance_to_rivers(x, y) / decay) - 0.25)
+                    rng = np.random.default_rng([self.seed, block_row, block_col])
+                    depth += rng.normal(0, 0.05 * scale, size=depth.shape)
+                    dst.write(depth.astype('float32'), 1, window=window)
+        os.replace(partial_path, path)
+
+
+def preload_inputs(input_provider, flood_map_choices=None, raster_memory_limit=None):
+    """
+    Load the model domain, floodplain and flood map bands of a provider once for all models created in this
+    process, and in processes forked from it (see fork_server.py). The inputs are looked up by the cache key
+    of the provider, so they are also found through copies of the provider, e.g. unpickled in a worker.
+
+    Parameters
+    ----------
+    input_provider: provider of the model inputs
+    flood_map_choices: flood maps of which the band is read, None for all choices of the provider
+    raster_memory_limit: bands larger than this number of bytes are not read, see AdaptationModel
+    """
+    if flood_map_choices is None:
+        flood_map_choices = input_provider.flood_map_choices()
+    bands = {}
+    for flood_map_choice in flood_map_choices:
+        with input_provider.open_flood_map(flood_map_choice) as flood_map:
+            band_bytes = flood_map.width * flood_map.height * np.dtype(flood_map.dtypes[0]).itemsize
+            if raster_memory_limit is None or band_bytes <= raster_memory_limit:
+                bands[flood_map_choice] = get_flood_map_data(flood_map)[0]
+    _preloaded_inputs[input_provider.cache_key()] = {'model_domain': get_model_domain_data(input_provider),
+                                                     'floodplain': get_floodplain_data(input_provider),
+                                                     'bands': bands}
+
+
+def get_preloaded_inputs(input_provider):
+    """Return the inputs of a provider loaded by preload_inputs, None if they were not preloaded in this process."""
+    if not _preloaded_inputs:
+        return None
+    return _preloaded_inputs.get(input_provider.cache_key())
+
+
+def get_default_input_provider():
+    """Return the process wide FileInputProvider used when a model is created without an input provider."""
+    global _default_input_provider
+    if _default_input_provider is None:
+        _default_input_provider = FileInputProvider()
+    return _default_input_provider
+
+
+def get_preset_input_provider(preset):
+    """
+    Return the process wide SyntheticInputProvider of a preset, used by the runs of the sweeps and the job service.
+    The provider is created once, so all runs of the process share its geometries and its rasters on disk.
+    """
+    if preset not in _preset_input_providers:
+        _preset_input_providers[preset] = SyntheticInputProvider.from_preset(preset)
+    return _preset_input_providers[preset]
+
+
+_default_input_provider = None
+
+# providers returned by get_preset_input_provider, by preset
+_preset_input_providers = {}
+
+# inputs loaded by preload_inputs, by the cache key of their provider
+_preloaded_inputs = {}
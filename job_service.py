@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Local experiment job service for the Flood Adaptation Model.
+
+The JobService listens on a local TCP port. It accepts experiment specifications and runs them on
+one shared process pool. A specification holds the same parameters as run_experiment. The runs of
+all queued jobs are dispatched round robin, so a large sweep does not block the jobs submitted
+after it. Clients poll the progress and throughput of a job, and fetch its result rows while the
+job is still running. The service keeps the rows of a job until the job is deleted, so clients
+delete a job once they fetched its results.
+
+The protocol is one JSON object per line. Every request is answered with one JSON object:
+    {"command": "submit", "spec": {...}}                -> {"job_id": ...}
+    {"command": "status", "job_id": ...}                -> progress of the job
+    {"command": "list"}                                 -> progress of all jobs
+    {"command": "results", "job_id": ..., "offset": n}  -> result rows from row n on, and whether the job is done
+    {"command": "cancel", "job_id": ...}                -> the job runs no new model runs
+    {"command": "delete", "job_id": ...}                -> a done or cancelled job and its rows are removed
+
+Example spec: {"parameters": {"political_situation": [0.05, 0.95], "scenarioNO": 1},
+               "iterations": 5, "max_steps": 19, "input_preset": "small"}
+
+Start the service with `python job_service.py serve --workers 8` and use JobClient, or the
+submit, status and results commands of this script, to talk to it.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from mesa.batchrunner import _make_model_kwargs
+
+from experiment_runner import run_model_run
+
+DEFAULT_PORT = 8765
+
+
+def _to_json(value):
+    """Convert values that json cannot encode: numpy scalars to Python numbers, everything else to text."""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class Job:
+    """An experiment submitted to the JobService, with its pending runs and the result rows received so far."""
+
+    def __init__(self, job_id, spec):
+        self.job_id = job_id
+        self.spec = spec
+        parameters = spec.get('parameters', {})
+        iterations = spec.get('iterations', 1)
+        runs = [(run_id, iteration, kwargs) for run_id, (iteration, kwargs)
+                in enumerate(itertools.product(range(iterations), _make_model_kwargs(parameters)))]
+        self.pending = deque(runs)
+        self.number_of_runs = len(runs)
+        self.max_steps = spec.get('max_steps', 19)
+        self.data_collection_period = spec.get('data_collection_period', 1)
+        self.input_preset = spec.get('input_preset')
+        self.rows = []
+        self.runs_done = 0
+        self.runs_failed = 0
+        self.running = 0
+        self.errors = []
+        self.cancelled = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def state(self):
+        if self.finished is not None:
+            return 'cancelled' if self.cancelled else 'done'
+        return 'running' if self.started is not None else 'queued'
+
+    def status(self):
+        """Return the progress of the job as a dictionary."""
+        end = self.finished if self.finished is not None else time.time()
+        elapsed = end - self.started if self.started is not None else 0
+        runs_per_second = self.runs_done / elapsed if elapsed > 0 else 0
+        return {'job_id': self.job_id, 'state': self.state, 'runs': self.number_of_runs, 'runs_done': self.runs_done,
+                'runs_failed': self.runs_failed, 'runs_running': self.running, 'rows': len(self.rows),
+                'elapsed_seconds': elapsed, 'runs_per_second': runs_per_second,
+                # batch_run steps from step 0 up to and including max_steps
+                'steps_per_second': runs_per_second * (self.max_steps + 1), 'errors': self.errors[-5:]}
+
+    def _finish_if_done(self):
+        if not self.pending and not self.running and self.finished is None:
+            self.finished = time.time()
+
+
+class JobService:
+    """
+    Queues experiment jobs and runs their model runs on a shared process pool.
+
+    Parameters
+    ----------
+    workers: number of worker processes, None for all cores
+    host, port: address the service listens on, by default only reachable from this machine
+    """
+
+    def __init__(self, workers=None, host='127.0.0.1', port=DEFAULT_PORT):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._executor = None
+        self._work_available = None
+
+    def submit(self, spec):
+        """Queue a job and return its id."""
+        job = Job(next(self._job_ids), spec)
+        self.jobs[job.job_id] = job
+        job._finish_if_done()
+        self._work_available.set()
+        return job.job_id
+
+    def _next_run(self):
+        """Return (job, run) of the next run to start, taking the jobs round robin, or None if no run is pending."""
+        for job_id, job in list(self.jobs.items()):
+            if job.pending and not job.cancelled:
+                # move the job to the end, so that the next run is taken from the next job
+                self.jobs.move_to_end(job_id)
+                return job, job.pending.popleft()
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            next_run = self._next_run()
+            if next_run is None:
+                self._work_available.clear()
+                await self._work_available.wait()
+                continue
+            job, run = next_run
+            if job.started is None:
+                job.started = time.time()
+            job.running += 1
+            try:
+                rows = await loop.run_in_executor(self._executor, run_model_run, run, job.max_steps,
+                                                  job.data_collection_period, job.input_preset)
+                job.rows.extend(rows)
+                job.runs_done += 1
+            except Exception as error:
+                job.runs_failed += 1
+                job.errors.append(f"run {run[0]}: {error!r}")
+            finally:
+                job.running -= 1
+                job._finish_if_done()
+
+    def handle(self, request):
+        """Answer one request of the protocol in the module docstring."""
+        command = request.get('command')
+        if command == 'submit':
+            return {'job_id': self.submit(request['spec'])}
+        if command == 'list':
+            return {'jobs': [job.status() for job in sorted(self.jobs.values(), key=lambda job: job.job_id)]}
+        job = self.jobs.get(request.get('job_id'))
+        if command not in ('status', 'results', 'cancel', 'delete'):
+            return {'error': f"Unknown command: {command!r}"}
+        if job is None:
+            return {'error': f"Unknown job: {request.get('job_id')!r}"}
+        if command == 'status':
+            return job.status()
+        if command == 'results':
+            offset = request.get('offset', 0)
+            limit = request.get('limit', 10000)
+            rows = job.rows[offset:offset + limit]
+            return {'job_id': job.job_id, 'offset': offset, 'rows': rows,
+                    'done': job.finished is not None and offset + len(rows) >= len(job.rows)}
+        if command == 'delete':
+            if job.finished is None:
+                return {'error': f"Job {job.job_id} is still {job.state}, cancel it before deleting it"}
+            del self.jobs[job.job_id]
+            return {'job_id': job.job_id, 'deleted': True}
+        job.cancelled = True
+        job.pending.clear()
+        job._finish_if_done()
+        return job.status()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.handle(json.loads(line))
+                except (ValueError, KeyError, TypeError) as error:
+                    response = {'error': repr(error)}
+                writer.write(json.dumps(response, default=_to_json).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Run the service until it is cancelled."""
+        self._work_available = asyncio.Event()
+        with ProcessPoolExecutor(self.workers) as executor:
+            self._executor = executor
+            workers = [asyncio.create_task(self._worker()) for _ in range(self.workers or os.cpu_count() or 1)]
+            server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+
+class JobClient:
+    """Blocking client of the JobService."""
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+
+    def request(self, command, **arguments):
+        """Send one request and return the response, raise a RuntimeError when the service answers with an error."""
+        import socket
+        with socket.create_connection((self.host, self.port)) as connection:
+            connection.sendall(json.dumps(dict(arguments, command=command)).encode() + b'\n')
+            with connection.makefile('rb') as f:
+                response = json.loads(f.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def submit(self, spec):
+        return self.request('submit', spec=spec)['job_id']
+
+    def status(self, job_id):
+        return self.request('status', job_id=job_id)
+
+    def stream_results(self, job_id, poll_interval=1.0):
+        """Yield the result rows of a job as they come in, until the job is done."""
+        offset = 0
+        while True:
+            response = self.request('results', job_id=job_id, offset=offset)
+            yield from response['rows']
+            offset += len(response['rows'])
+            if response['done']:
+                return
+            if not response['rows']:
+                time.sleep(poll_interval)
+
+    def results_dataframe(self, job_id, poll_interval=1.0):
+        """Wait for a job and return all its rows as a DataFrame, in the format of run_experiment."""
+        import pandas as pd
+        return pd.DataFrame(list(self.stream_results(job_id, poll_interval)))
+
+    def delete(self, job_id):
+        """Remove a done or cancelled job and its rows from the service."""
+        return self.request('delete', job_id=job_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local job service for flood adaptation model experiments.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the service")
+    serve.add_argument("--workers", type=int, default=None, help="number of worker processes, by default all cores")
+    submit = commands.add_parser("submit", help="submit the experiment spec in a JSON file")
+    submit.add_argument("spec")
+    status = commands.add_parser("status", help="show the progress of a job, or of all jobs")
+    status.add_argument("job_id", type=int, nargs="?")
+    results = commands.add_parser("results", help="write the results of a job to a CSV file when it is done")
+    results.add_argument("job_id", type=int)
+    results.add_argument("output_path")
+    results.add_argument("--keep", action="store_true", help="keep the job in the service, by default it is deleted")
+    delete = commands.add_parser("delete", help="remove a done or cancelled job and its rows from the service")
+    delete.add_argument("job_id", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        try:
+            asyncio.run(JobService(args.workers, args.host, args.port).serve())
+        except KeyboardInterrupt:
+            pass
+        return
+    client = JobClient(args.host, args.port)
+    if args.command == "submit":
+        with open(args.spec) as f:
+            print(client.submit(json.load(f)))
+    elif args.command == "status":
+        response = client.status(args.job_id) if args.job_id is not None else client.request('list')
+        print(json.dumps(response, indent=2))
+    elif args.command == "results":
+        client.results_dataframe(args.job_id).to_csv(args.output_path)
+        if not args.keep:
+            client.delete(args.job_id)
+    elif args.command == "delete":
+        print(json.dumps(client.delete(args.job_id), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Memory accounting for the Flood Adaptation Model.
+
+The MemoryMonitor uses tracemalloc snapshots to attribute the memory held by a model to its
+components (flood map band, social network, network grid, DataCollector, agents) and records the
+current resident set size and the peak resident set size of the process. The peak is the peak since
+the process started, so in a worker that runs several models it is the peak of all runs so far.
+Snapshots are grouped by the line that made the allocation and attributed by its file, which is cheap
+enough to sample every few steps. The network grid lives in the same file as the network, so the lines
+of its class are attributed to the network grid before the files are looked at.
+
+Tracing slows down every allocation. A monitor that started tracing stops it when stop is called or
+when the monitor is garbage collected together with its model, so later models in the process do
+not pay for it.
+"""
+import inspect
+import sys
+import tracemalloc
+import weakref
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from network import CSRNetworkGrid
+
+# classes of which the allocations made in their methods belong to a model component, before SUBSYSTEMS
+SUBSYSTEM_CLASSES = [
+    ('network_grid', CSRNetworkGrid),
+]
+
+# file name fragments per model component, the first matching component is used
+SUBSYSTEMS = [
+    ('network_graph', ('networkx', 'network.py')),
+    ('network_grid', ('mesa/space.py',)),
+    ('datacollector', ('mesa/datacollection.py', 'data_collection.py', 'history.py', 'pandas')),
+    ('flood_map', ('rasterio', 'functions.py', 'input_providers.py')),
+    ('world', ('world.py',)),
+    ('agents', ('agents.py', 'mesa/agent.py', 'shapely')),
+    ('model', ('model.py', 'mesa/time.py')),
+]
+
+
+def _class_lines():
+    """Return a dictionary mapping the file of every class in SUBSYSTEM_CLASSES to (first line, last line, component)."""
+    class_lines = {}
+    for subsystem, cls in SUBSYSTEM_CLASSES:
+        lines, first = inspect.getsourcelines(cls)
+        class_lines.setdefault(inspect.getsourcefile(cls), []).append((first, first + len(lines) - 1, subsystem))
+    return class_lines
+
+
+def classify_filename(filename, lineno=None):
+    """Return the model component an allocation made in filename (on line lineno) belongs to."""
+    if lineno is not None:
+        for first, last, subsystem in _CLASS_LINES.get(filename, ()):
+            if first <= lineno <= last:
+                return subsystem
+    filename = filename.replace('\\', '/')
+    for subsystem, fragments in SUBSYSTEMS:
+        for fragment in fragments:
+            if fragment in filename:
+                return subsystem
+    return 'other'
+
+
+_CLASS_LINES = _class_lines()
+
+
+def process_peak_rss_bytes():
+    """
+    Return the peak resident set size of this process in bytes since it started, None if it cannot be determined.
+    This is not the peak of one run when the process runs several models.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """Return the current resident set size of this process in bytes, None if it cannot be determined (only on Linux)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() if resource is not None else None
+
+
+class MemoryMonitor:
+    """
+    Tracks the memory held by the components of a model.
+
+    Parameters
+    ----------
+    sample_every: take a sample every k steps when sample is called, None to only report on request
+    traceback_limit: number of frames tracemalloc stores per allocation
+    """
+
+    def __init__(self, sample_every=None, traceback_limit=1):
+        self.sample_every = sample_every
+        self.samples = []
+        self.traceback_limit = traceback_limit
+        self.started_tracing = False
+        self._finalizer = None
+        self._start_tracing()
+        tracemalloc.reset_peak()
+
+    def _start_tracing(self):
+        # only stop tracing at the end if this monitor started it
+        if tracemalloc.is_tracing():
+            return
+        tracemalloc.start(self.traceback_limit)
+        self.started_tracing = True
+        self._finalizer = weakref.finalize(self, _stop_tracing)
+
+    def report(self, model=None):
+        """
+        Return the bytes held per model component.
+
+        Parameters
+        ----------
+        model: if given, the exact size of the flood map bands in memory is added as 'flood_band_nbytes'
+
+        Returns
+        -------
+        report: dictionary with bytes per component, the traced total and peak, the current RSS and the peak RSS
+                of the process. After stop, tracing starts again and only later allocations are attributed
+        """
+        self._start_tracing()
+        snapshot = tracemalloc.take_snapshot()
+        report = {subsystem: 0 for subsystem, fragments in SUBSYSTEMS}
+        report['other'] = 0
+        for statistic in snapshot.statistics('lineno'):
+            frame = statistic.traceback[0]
+            report[classify_filename(frame.filename, frame.lineno)] += statistic.size
+        current, peak = tracemalloc.get_traced_memory()
+        report['traced_total'] = current
+        report['traced_peak'] = peak
+        report['rss'] = current_rss_bytes()
+        report['process_peak_rss'] = process_peak_rss_bytes()
+        # the bands are read lazily, do not trigger the read from here. Tiled flood maps count their cached tiles
+        if model is not None:
+            bands = {id(band): band for band in getattr(model, '_flood_bands', {}).values()}
+            if getattr(model, '_band_flood_img', None) is not None:
+                bands[id(model._band_flood_img)] = model._band_flood_img
+            report['flood_band_nbytes'] = sum(band.nbytes for band in bands.values())
+        return report
+
+    def sample(self, step, model=None):
+        """Store a report for this step if the step is a multiple of sample_every."""
+        if self.sample_every and step % self.sample_every == 0:
+            report = self.report(model)
+            report['Step'] = step
+            self.samples.append(report)
+
+    def last_sample(self, key):
+        """Return the value of key in the last sample, None before the first sample."""
+        if not self.samples:
+            return None
+        return self.samples[-1].get(key)
+
+    def to_dataframe(self):
+        """Return the samples as a pandas DataFrame with one row per sampled step."""
+        import pandas as pd
+        return pd.DataFrame(self.samples)
+
+    def stop(self):
+        """Stop tracing if this monitor started it, e.g. at the end of the run."""
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self.started_tracing = False
+
+
+def _stop_tracing():
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
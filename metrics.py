@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Live metrics of running simulations of the Flood Adaptation Model.
+
+A model with a metrics sink publishes a small record every metrics_every steps: the step, the step
+rate, the number of adapted households, the mean flood damage, the policy values of the policy maker
+and the memory of the process. Publishing a record is one JSON encoding and one write or datagram,
+cheap enough to leave on during long sweeps. A sink is given as a string, so that it can be passed to
+worker processes and other machines:
+
+    'file:<path>' or a path ending in .ndjson or .jsonl: append one JSON line per record, e.g. for tail -f
+    'udp://host:port': send every record as one JSON datagram, records are dropped when nobody listens
+    'prometheus://host:port': serve the latest record of every run in the Prometheus text format on
+                              http://host:port/metrics, see MetricsServer
+
+Runs publish a final record with done set when they finish, so that a run whose last record is old and
+not done points to a stalled worker.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from memory_report import current_rss_bytes, process_peak_rss_bytes
+
+# prefix of the names of the Prometheus metrics
+METRIC_PREFIX = 'abm_'
+
+# fields of a record that identify the run, used as Prometheus labels
+LABEL_FIELDS = ('run', 'host', 'pid')
+
+# sinks opened in this process, by their specification
+_open_sinks = {}
+
+
+class JsonLinesSink:
+    """Appends every record as one JSON line to a file. Every line is written with one append, so several processes can share the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def send(self, record):
+        os.write(self._fd, json.dumps(record, default=float).encode() + b'\n')
+
+    def close(self):
+        os.close(self._fd)
+
+
+class UDPSink:
+    """Sends every record as one JSON datagram. Sending never blocks the model, records are lost when nobody listens."""
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def send(self, record):
+        try:
+            self._socket.sendto(json.dumps(record, default=float).encode(), self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self._socket.close()
+
+
+class MetricsServer:
+    """
+    Serves the latest record of every run in the Prometheus text format.
+
+    Records are sent to the server directly with send, or as JSON datagrams to its UDP port, which is how
+    worker processes publish to a server in the main process. For every run the server also reports the
+    seconds since its last record.
+
+    Parameters
+    ----------
+    host, port: address of the HTTP endpoint, the metrics are served on /metrics
+    udp_port: UDP port on which records are received, 0 for a free port
+    """
+
+    def __init__(self, host='127.0.0.1', port=9100, udp_port=0):
+        self.latest = {}
+        self.received = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._http = ThreadingHTTPServer((host, port), Handler)
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((host, udp_port))
+        self._udp.settimeout(0.5)
+        self._closed = False
+        self._threads = [threading.Thread(target=self._http.serve_forever, daemon=True),
+                         threading.Thread(target=self._receive, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def url(self):
+        host, port = self._http.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    @property
+    def udp_sink(self):
+        """Specification of the UDP sink that sends records to this server."""
+        host, port = self._udp.getsockname()[:2]
+        return f"udp://{host}:{port}"
+
+    def _receive(self):
+        while not self._closed:
+            try:
+                datagram = self._udp.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                self.send(json.loads(datagram))
+            except ValueError:
+                continue
+
+    def send(self, record):
+        """Store a record as the latest record of its run."""
+        key = tuple(str(record.get(field, '')) for field in LABEL_FIELDS)
+        with self._lock:
+            self.latest[key] = dict(self.latest.get(key, {}), **record)
+            self.received[key] = time.time()
+
+    def render(self):
+        """Return the latest records in the Prometheus text format."""
+        now = time.time()
+        with self._lock:
+            runs = list(self.latest.items())
+            received = dict(self.received)
+        metrics = {}
+        for key, record in runs:
+            labels = ','.join(f'{field}="{value}"' for field, value in zip(LABEL_FIELDS, key) if value != '')
+            for name, value in record.items():
+                if name in LABEL_FIELDS or name == 'time' or isinstance(value, str) or value is None:
+                    continue
+                metrics.setdefault(name, []).append(f"{METRIC_PREFIX}{name}{{{labels}}} {float(value)!r}")
+            metrics.setdefault('seconds_since_update', []).append(
+                f"{METRIC_PREFIX}seconds_since_update{{{labels}}} {now - received[key]!r}")
+        lines = []
+        for name, samples in metrics.items():
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self._closed = True
+        self._http.shutdown()
+        self._http.server_close()
+        self._udp.close()
+
+
+def open_metrics_sink(sink):
+    """
+    Return the sink of a specification (see the module docstring), opening it once per process.
+    Objects with a send method, such as a MetricsServer, are returned as they are.
+    """
+    if hasattr(sink, 'send'):
+        return sink
+    if sink not in _open_sinks:
+        parts = urlsplit(sink)
+        if parts.scheme == 'udp':
+            _open_sinks[sink] = UDPSink(parts.hostname, parts.port)
+        elif parts.scheme == 'prometheus':
+            _open_sinks[sink] = MetricsServer(parts.hostname or '127.0.0.1', parts.port or 9100)
+        elif parts.scheme == 'file':
+            _open_sinks[sink] = JsonLinesSink(sink[len('file:'):])
+        elif sink.endswith(('.ndjson', '.jsonl')):
+            _open_sinks[sink] = JsonLinesSink(sink)
+        else:
+            raise ValueError(f"Unknown metrics sink: '{sink}'. Use 'file:<path>', 'udp://host:port' or 'prometheus://host:port'")
+    return _open_sinks[sink]
+
+
+class MetricsPublisher:
+    """
+    Publishes the metrics of a model to a sink every publish_every steps.
+
+    Parameters
+    ----------
+    sink: sink specification or object, see open_metrics_sink
+    run_id: identifier of the run in the records, e.g. the RunId of a batch run
+    publish_every: publish every k steps
+    """
+
+    def __init__(self, sink, run_id=None, publish_every=1):
+        self.sink = open_metrics_sink(sink)
+        self.run_id = run_id
+        self.publish_every = publish_every
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self._last_time = time.perf_counter()
+        self._last_step = 0
+
+    def record(self, **fields):
+        """Return a record with the run labels and the given fields."""
+        return dict({'time': time.time(), 'run': self.run_id, 'host': self.host, 'pid': self.pid}, **fields)
+
+    def publish(self, model):
+        """Publish the metrics of the model if its step is a multiple of publish_every."""
+        step = model.schedule.steps
+        if step % self.publish_every:
+            return
+        now = time.perf_counter()
+        elapsed = now - self._last_time
+        steps_per_second = (step - self._last_step) / elapsed if elapsed > 0 else None
+        self._last_time = now
+        self._last_step = step
+        policy_maker = model.policy_maker
+        record = self.record(step=step, steps_per_second=steps_per_second,
+                             adapted_households=model.total_adapted_households(),
+                             mean_flood_damage=model.average_flood_damage_households(),
+                             provide_information=policy_maker.provide_information, subsidies=policy_maker.subsidies,
+                             regulation=policy_maker.regulation, infrastructure_government=policy_maker.infrastructure_government,
+                             political_situation=model.political_situation, rss=current_rss_bytes(),
+                             process_peak_rss=process_peak_rss_bytes())
+        if model.memory_monitor is not None:
+            record['traced_memory'] = model.memory_monitor.last_sample('traced_total')
+        self.sink.send(record)
+
+    def publish_done(self):
+        """Publish that the run finished."""
+        self.sink.send(self.record(done=1))
+
+
+def publish_run_done(sink, run_id):
+    """Publish that run run_id finished, used by the experiment runner after a run of a batch."""
+    MetricsPublisher(sink, run_id).publish_done()
@@ -1,20 +1,63 @@
 # Importing necessary libraries
-import networkx as nx
 from mesa import Model, Agent
-from mesa.time import SimultaneousActivation
-from mesa.space import NetworkGrid
-from mesa.datacollection import DataCollector
-import geopandas as gpd
-import rasterio as rs
 import matplotlib.pyplot as plt
+import math
 import random
+import numpy as np
 
 # Import the agent class(es) from agents.py
-from agents import Households, Government, Waterboard, Insurance_company, Policy_maker
+from agents import Households, Government, Waterboard, Insurance_company, Policy_maker, DEFAULT_COEFFICIENTS, HouseholdContext
 
 # Import functions from functions.py
 from functions import get_flood_map_data, calculate_basic_flood_damage
-from functions import map_domain_gdf, floodplain_gdf
+from functions import get_model_domain_data, get_floodplain_data
+
+# Import the input providers from input_providers.py
+from input_providers import get_default_input_provider, get_preloaded_inputs
+
+# Import the step profiler from profiling.py
+from profiling import StepProfiler, NullProfiler, ProfiledSimultaneousActivation
+
+# Import the scheduler that keeps the agents partitioned by type
+from scheduler import PhasedActivation
+
+# Import the array based social network from network.py
+from network import generate_network, CSRNetworkGrid
+
+# Import the world initialisation from world.py
+from world import load_or_build_world
+
+# Import the household attribute arrays and the flood events
+from household_state import HouseholdState
+from flood_events import FloodEventEngine
+
+# Import the tiled access to flood maps that are larger than memory
+from raster_tiles import TiledRaster
+
+# Import the depth-damage curves
+from damage_curves import get_damage_curve
+
+# Import the data collection with a configurable cadence and the delta-encoded agent history
+from data_collection import StepDataCollector, select_reporters, collects_at
+from history import DeltaDataCollector
+
+# Import the fast plots of the households
+from plotting import plot_households, NetworkPlot
+
+# Import the memory monitor from memory_report.py
+from memory_report import MemoryMonitor
+
+# Import the live metrics publisher from metrics.py
+from metrics import MetricsPublisher
+
+# Import the steady-state detection from convergence.py
+from convergence import ConvergenceMonitor, FAST_FORWARD
+
+# Import the change tracking of the household updates from change_tracking.py
+from change_tracking import HouseholdChangeTracker
+
+# Import the chunked array update of the households from household_kernels.py
+from household_kernels import ArrayHouseholdUpdate
 
 #from run_tests import ScenarioNO
 
@@ -25,6 +68,9 @@ class AdaptationModel(Model):
     simulates their behavior, and collects data. The network type can be adjusted based on study requirements.
     """
 
+    # order in which the agent types are activated in every step: households first, then the institutions
+    DEFAULT_PHASE_ORDER = [Households, Government, Waterboard, Insurance_company, Policy_maker]
+
     def __init__(self, 
                  seed = None,
                  number_of_households = 25, # number of household agents
@@ -43,10 +89,83 @@ class AdaptationModel(Model):
                  political_situation = 5,
                  welfare = 5,
                  scenarioNO = 0,
+                 # provider of the model domain, floodplain and flood maps, see input_providers.py.
+                 # None reads the Houston input data from ../input_data
+                 input_provider = None,
+                 # step profiling: False to disable, True for a new StepProfiler, or a StepProfiler instance
+                 profiler = False,
+                 # add the step timings of the profiler as model reporters
+                 profile_reporters = False,
+                 # sample the memory held per model component every k steps, None to disable
+                 memory_sample_every = None,
+                 # directory in which the world (network and household placements) is cached per seed, None to disable
+                 world_cache_dir = None,
+                 # schedule of the flood shocks (see flood_events.py), None for a flood every 5 steps
+                 flood_event_schedule = None,
+                 # (rows, columns) of flood zones with their own flood intensity, None to draw the intensity per household
+                 flood_zones = None,
+                 # bytes of flood map data kept in memory. Flood maps with a larger band are read per tile,
+                 # only where households live. None always reads the full band
+                 raster_memory_limit = None,
+                 # depth-damage curve: None for the logarithmic regression, 'lookup' for its interpolated lookup table,
+                 # or a damage curve object from damage_curves.py
+                 damage_curve = None,
+                 # check the running household totals against a full recomputation every time they are read
+                 verify_aggregates = False,
+                 # order in which the agent types are activated, None for DEFAULT_PHASE_ORDER
+                 phase_order = None,
+                 # store the agent variables delta-encoded (see history.py) instead of in full every step
+                 delta_history = False,
+                 # names of the model and agent reporters to collect, None for all of them
+                 model_reporters = None,
+                 agent_reporters = None,
+                 # collect model and agent data every k steps, 'flood_events' for only the steps with a flood event
+                 # (see data_collection.py), or None to not collect that data
+                 model_data_every = 1,
+                 agent_data_every = 1,
+                 # dictionary overriding coefficients of the government and policy maker, see DEFAULT_COEFFICIENTS in agents.py
+                 coefficients = None,
+                 # sink to which the step metrics are published while the model runs, e.g. 'udp://127.0.0.1:9125'
+                 # or 'file:metrics.ndjson' (see metrics.py), None to not publish them
+                 metrics_sink = None,
+                 # publish the metrics every k steps
+                 metrics_every = 1,
+                 # identifier of the run in the published metrics
+                 metrics_run_id = None,
+                 # 'stop' to end the run or 'fast_forward' to extrapolate its periodic steady state until the last step
+                 # once the monitored state changes less than convergence_tolerance per flood cycle (see convergence.py),
+                 # None to always simulate all steps
+                 convergence_action = None,
+                 convergence_tolerance = 1e-2,
+                 # number of consecutive flood cycles within the tolerance before the run counts as converged
+                 convergence_windows = 2,
+                 # length of the flood cycle in steps, None for the period of the flood event schedule (5 by default)
+                 convergence_period = None,
+                 # names of the monitored state quantities, None for DEFAULT_QUANTITIES in convergence.py
+                 convergence_quantities = None,
+                 # only update the households of which an input changed (see change_tracking.py): False to update all
+                 # households, True to skip the others, or 'verify' to also update the skipped households and check
+                 # that this changes nothing
+                 skip_unchanged_households = False,
+                 # changes of the political perceptions and policy values up to this value do not count as changes,
+                 # 0 keeps the results exactly those of updating all households
+                 change_tolerance = 0.0,
+                 # update the households with vectorized kernels on their arrays instead of calling the step and advance
+                 # of every household agent (see household_kernels.py), for models with very many households
+                 array_households = False,
+                 # number of threads of the array update, None for all cores
+                 household_threads = None,
+                 # number of households per chunk of the array update, None for DEFAULT_CHUNK_SIZE in household_kernels.py
+                 household_chunk_size = None,
                  ):
         
         super().__init__(seed = seed)
 
+        # start memory tracing before anything is built, so that all model components are accounted for
+        self.memory_monitor = None
+        if memory_sample_every:
+            self.memory_monitor = MemoryMonitor(sample_every=memory_sample_every)
+
         #unique id counter to ensure unique id for each agent
         self.unique_id_counter = 0
 
@@ -60,16 +179,38 @@ class AdaptationModel(Model):
         self.number_of_edges = number_of_edges
         self.number_of_nearest_neighbours = number_of_nearest_neighbours
 
-        # generating the graph according to the network used and the network parameters specified
-        self.G = self.initialize_network()
-        # create grid out of network graph
-        self.grid = NetworkGrid(self.G)
+        # set the provider of the spatial input data
+        if input_provider is None:
+            input_provider = get_default_input_provider()
+        self.input_provider = input_provider
 
         # Initialize maps
+        self.raster_memory_limit = raster_memory_limit
         self.initialize_maps(flood_map_choice)
 
-        # set schedule for agents
-        self.schedule = SimultaneousActivation(self)  # Schedule for activating agents
+        # generating the graph and the household placements according to the network and maps used,
+        # or reusing them from the world cache
+        self.world = load_or_build_world(self, flood_map_choice, world_cache_dir)
+        self.social_network = self.world.network
+        # the networkx version of the graph is only built when it is used, e.g. for plotting
+        self._G = None
+        # create grid out of network graph
+        self.grid = CSRNetworkGrid(self.social_network)
+
+        # set up the step profiler, the NullProfiler makes all profiling calls no-ops when profiling is disabled
+        if profiler is True:
+            profiler = StepProfiler()
+        elif not profiler:
+            profiler = NullProfiler()
+        self.profiler = profiler
+
+        # set schedule for agents, it keeps the agents partitioned by type and activates the types in phase order
+        if phase_order is None:
+            phase_order = self.DEFAULT_PHASE_ORDER
+        if self.profiler.enabled:
+            self.schedule = ProfiledSimultaneousActivation(self, self.profiler, phase_order)  # Schedule that times step and advance per agent type
+        else:
+            self.schedule = PhasedActivation(self, phase_order)  # Schedule for activating agents
 
         # check if political_situation has correct value (between 0 and 1) as input
         if political_situation > 1 or political_situation < 0:
@@ -90,13 +231,34 @@ class AdaptationModel(Model):
         # give scenario number as value to model
         self.scenarioNO = scenarioNO
 
+        # coefficients of the government and policy maker
+        unknown = set(coefficients or {}) - set(DEFAULT_COEFFICIENTS)
+        if unknown:
+            raise ValueError(f"Unknown coefficients: {sorted(unknown)}. Available are {list(DEFAULT_COEFFICIENTS)}")
+        self.coefficients = dict(DEFAULT_COEFFICIENTS, **(coefficients or {}))
+
+        # depth-damage curve used in all flood damage calculations
+        self.damage_curve = get_damage_curve(damage_curve)
+
+        # arrays holding the household attributes that are updated for all households at once
+        self.household_state = HouseholdState(self.number_of_households)
+        self.verify_aggregates = verify_aggregates
+
         # create households through initiating a household on each node of the network graph
-        for i, node in enumerate(self.G.nodes()):
-            household = Households(unique_id=self.unique_id_counter, model=self, political_situation=self.political_situation, welfare = self.welfare)
+        for node in range(self.number_of_households):
+            household = Households(unique_id=self.unique_id_counter, model=self, political_situation=self.political_situation, welfare = self.welfare, node=node)
             # unique id counter +1 to ensure unique id for next agent created
             self.unique_id_counter = self.unique_id_counter + 1
             self.schedule.add(household)
             self.grid.place_agent(agent=household, node_id=node)
+        # all households in order of their node, without the other agent types
+        self.households = self.schedule.agents_of_type(Households)
+        # determine the friends of every household, the social network does not change during a run.
+        # The households use their friends in their step, also on steps on which no agent data is collected
+        for household in self.households:
+            household.count_friends(radius=1)
+        # values of the other agents used by the households in their advance, determined once per step
+        self._household_context = None
 
         # initialise government agent
         self.government = Government(unique_id=self.unique_id_counter, model=self, welfare=self.welfare, political_situation=self.political_situation)
@@ -121,6 +283,34 @@ class AdaptationModel(Model):
         self.policy_maker = Policy_maker(unique_id=self.unique_id_counter, model=self)
         self.schedule.add(self.policy_maker)
 
+        # update only the households of which an input changed, or all households on their arrays
+        if skip_unchanged_households and array_households:
+            raise ValueError("skip_unchanged_households and array_households cannot be combined")
+        self.change_tracker = None
+        self.array_update = None
+        if array_households:
+            self.array_update = ArrayHouseholdUpdate(self, threads=household_threads, chunk_size=household_chunk_size,
+                                                     seed=None if seed is None else [seed, 3])
+            self.schedule.set_phase_function(Households, 'step', self.array_update.step_households)
+            self.schedule.set_phase_function(Households, 'advance', self.array_update.advance_households)
+        elif skip_unchanged_households:
+            self.change_tracker = HouseholdChangeTracker(self, tolerance=change_tolerance,
+                                                         verify=skip_unchanged_households == 'verify')
+            self.schedule.set_phase_function(Households, 'step', self.change_tracker.step_households)
+            self.schedule.set_phase_function(Households, 'advance', self.change_tracker.advance_households)
+
+        # set up the flood events, which update the actual flood depths of all households every step
+        self.flood_events = FloodEventEngine(self, schedule=flood_event_schedule, zones=flood_zones,
+                                             seed=None if seed is None else [seed, 2])
+
+        # set up the steady-state detection
+        self.convergence = None
+        if convergence_action is not None:
+            if convergence_period is None:
+                convergence_period = self.flood_events.schedule.period or 5
+            self.convergence = ConvergenceMonitor(convergence_action, period=convergence_period, tolerance=convergence_tolerance,
+                                                  windows=convergence_windows, quantities=convergence_quantities)
+
         # Data collection setup to collect data
         model_metrics = {
                         "total_adapted_households": self.total_adapted_households,
@@ -131,7 +321,16 @@ class AdaptationModel(Model):
                         "PoliticalSituation": self.determine_political_situation
                         # ... other reporters ...
                         }
-        
+        if profile_reporters and self.profiler.enabled:
+            # wall time of the previous step, the data is collected before the agents of the current step run
+            model_metrics["StepWallTime"] = self.profiler.last_step_time
+        if self.memory_monitor is not None:
+            # memory of the last sample, taken every memory_sample_every steps
+            model_metrics["TracedMemory"] = lambda m: m.memory_monitor.last_sample("traced_total")
+            model_metrics["RSS"] = lambda m: m.memory_monitor.last_sample("rss")
+            # peak of the process since it started, also over the earlier runs in the same worker
+            model_metrics["ProcessPeakRSS"] = lambda m: m.memory_monitor.last_sample("process_peak_rss")
+
         agent_metrics = {
                         "FloodDepthEstimated": "flood_depth_estimated",
                         "FloodDamageEstimated" : "flood_damage_estimated",
@@ -145,66 +344,155 @@ class AdaptationModel(Model):
                         "HouseholdAttitude":"household_attitude"
                         # ... other reporters ...
                         }
+        # keep only the reporters that are used in the analysis of this run
+        model_metrics = select_reporters(model_metrics, model_reporters, 'model')
+        agent_metrics = select_reporters(agent_metrics, agent_reporters, 'agent')
+        if self.convergence is not None:
+            # the step on which the run converged, None before, always collected as it tells how the run ended
+            model_metrics["ConvergedAtStep"] = lambda m: m.convergence.converged_at
+        self.model_data_every = model_data_every
+        self.agent_data_every = agent_data_every
+
         #set up the data collector 
-        self.datacollector = DataCollector(model_reporters=model_metrics, agent_reporters=agent_metrics)
+        if delta_history:
+            # location, estimated flood depth and number of friends do not change during a run, they are stored once per agent
+            self.datacollector = DeltaDataCollector(model_reporters=model_metrics, agent_reporters=agent_metrics,
+                                                    static_reporters=["FloodDepthEstimated", "FriendsCount", "location"])
+        else:
+            self.datacollector = StepDataCollector(model_reporters=model_metrics, agent_reporters=agent_metrics)
+
+        # publisher of the live metrics
+        self.metrics = None
+        if metrics_sink is not None:
+            self.metrics = MetricsPublisher(metrics_sink, run_id=metrics_run_id, publish_every=metrics_every)
 
     def initialize_network(self):
         """
-        Initialize and return the social network graph based on the provided network type using pattern matching.
+        Initialize and return the social network based on the provided network type.
+        The edges are generated as arrays seeded with the model seed, see network.py.
         """
-        if self.network == 'erdos_renyi':
-            return nx.erdos_renyi_graph(n=self.number_of_households,
-                                        p=self.number_of_nearest_neighbours / self.number_of_households,
-                                        seed=self.seed)
-        elif self.network == 'barabasi_albert':
-            return nx.barabasi_albert_graph(n=self.number_of_households,
-                                            m=self.number_of_edges,
-                                            seed=self.seed)
-        elif self.network == 'watts_strogatz':
-            return nx.watts_strogatz_graph(n=self.number_of_households,
-                                        k=self.number_of_nearest_neighbours,
-                                        p=self.probability_of_network_connection,
-                                        seed=self.seed)
-        elif self.network == 'no_network':
-            G = nx.Graph()
-            G.add_nodes_from(range(self.number_of_households))
-            return G
-        else:
-            raise ValueError(f"Unknown network type: '{self.network}'. "
-                            f"Currently implemented network types are: "
-                            f"'erdos_renyi', 'barabasi_albert', 'watts_strogatz', and 'no_network'")
-
+        return generate_network(network=self.network,
+                                number_of_households=self.number_of_households,
+                                seed=self.seed,
+                                probability_of_network_connection=self.probability_of_network_connection,
+                                number_of_edges=self.number_of_edges,
+                                number_of_nearest_neighbours=self.number_of_nearest_neighbours)
+
+    @property
+    def G(self):
+        """The social network as networkx graph, built on first use."""
+        if self._G is None:
+            self._G = self.social_network.to_networkx()
+        return self._G
 
     def initialize_maps(self, flood_map_choice):
         """
         Initialize and set up the flood map related data based on the provided flood map choice.
         """
-        # Define paths to flood maps
-        flood_map_paths = {
-            'harvey': r'../input_data/floodmaps/Harvey_depth_meters.tif',
-            '100yr': r'../input_data/floodmaps/100yr_storm_depth_meters.tif',
-            '500yr': r'../input_data/floodmaps/500yr_storm_depth_meters.tif'  # Example path for 500yr flood map
-        }
-
-        # Throw a ValueError if the flood map choice is not in the dictionary
-        if flood_map_choice not in flood_map_paths.keys():
+        # Throw a ValueError if the flood map choice is not offered by the input provider
+        if flood_map_choice not in self.input_provider.flood_map_choices():
             raise ValueError(f"Unknown flood map choice: '{flood_map_choice}'. "
-                             f"Currently implemented choices are: {list(flood_map_paths.keys())}")
+                             f"Currently implemented choices are: {self.input_provider.flood_map_choices()}")
 
-        # Choose the appropriate flood map based on the input choice
-        flood_map_path = flood_map_paths[flood_map_choice]
+        # Loading the model domain and the floodplain, unless they were preloaded in this process (see fork_server.py)
+        self.preloaded_inputs = get_preloaded_inputs(self.input_provider)
+        if self.preloaded_inputs is not None:
+            self.map_domain_gdf, self.map_domain_polygon = self.preloaded_inputs['model_domain']
+            self.floodplain_gdf, self.floodplain_multipolygon = self.preloaded_inputs['floodplain']
+        else:
+            self.map_domain_gdf, self.map_domain_polygon = get_model_domain_data(self.input_provider)
+            self.floodplain_gdf, self.floodplain_multipolygon = get_floodplain_data(self.input_provider)
+
+        # Loading and setting up the flood map, the band itself is only read when it is used
+        self.flood_map_choice = flood_map_choice
+        self.flood_map = self.input_provider.open_flood_map(flood_map_choice)
+        self._band_flood_img = None
+        # other flood maps and their bands, opened when depths are sampled from them
+        self.flood_maps = {flood_map_choice: self.flood_map}
+        self._flood_bands = {}
+        self.bound_left, self.bound_bottom, self.bound_right, self.bound_top = self.flood_map.bounds
+
+    @property
+    def band_flood_img(self):
+        """The band of the flood map, read from the raster on first use."""
+        if self._band_flood_img is None:
+            if self.preloaded_inputs is not None and self.flood_map_choice in self.preloaded_inputs['bands']:
+                self._band_flood_img = self.preloaded_inputs['bands'][self.flood_map_choice]
+            else:
+                self._band_flood_img, self.bound_left, self.bound_right, self.bound_top, self.bound_bottom = get_flood_map_data(
+                    self.flood_map)
+        return self._band_flood_img
+
+    def open_flood_map(self, flood_map_choice):
+        """Return the opened flood map of flood_map_choice, opening it on first use."""
+        if flood_map_choice not in self.flood_maps:
+            self.flood_maps[flood_map_choice] = self.input_provider.open_flood_map(flood_map_choice)
+        return self.flood_maps[flood_map_choice]
+
+    def get_flood_band(self, flood_map_choice):
+        """
+        Return the band of a flood map. Above raster_memory_limit this is a TiledRaster that only reads
+        the tiles in which households are sampled, otherwise the full band as array.
+        """
+        if flood_map_choice not in self._flood_bands:
+            flood_map = self.open_flood_map(flood_map_choice)
+            band_bytes = flood_map.width * flood_map.height * np.dtype(flood_map.dtypes[0]).itemsize
+            if self.raster_memory_limit is not None and band_bytes > self.raster_memory_limit:
+                self._flood_bands[flood_map_choice] = TiledRaster(flood_map, cache_bytes=self.raster_memory_limit)
+            elif flood_map_choice == self.flood_map_choice:
+                self._flood_bands[flood_map_choice] = self.band_flood_img
+            elif self.preloaded_inputs is not None and flood_map_choice in self.preloaded_inputs['bands']:
+                self._flood_bands[flood_map_choice] = self.preloaded_inputs['bands'][flood_map_choice]
+            else:
+                self._flood_bands[flood_map_choice] = get_flood_map_data(flood_map)[0]
+        return self._flood_bands[flood_map_choice]
+
+    def sample_flood_depths(self, flood_map_choice=None):
+        """
+        Return the flood depth of every household in a flood map, by default the flood map of the model.
+        The raster (row, col) of the households is computed once per grid and reused for all maps on that grid.
+        """
+        if flood_map_choice is None:
+            flood_map_choice = self.flood_map_choice
+        return self.world.raster_indices.sample(self.open_flood_map(flood_map_choice), self.get_flood_band(flood_map_choice))
 
-        # Loading and setting up the flood map
-        self.flood_map = rs.open(flood_map_path)
-        self.band_flood_img, self.bound_left, self.bound_right, self.bound_top, self.bound_bottom = get_flood_map_data(
-            self.flood_map)
+    def aggregate(self, name):
+        """
+        Return the sum of a tracked household attribute over all households (see household_state.py).
+        The sum is kept up to date on every write, so reading it does not loop over the agents.
+        With verify_aggregates the sum is checked against a full recomputation.
+        """
+        total = self.household_state.sums[name]
+        if self.verify_aggregates:
+            recomputed = self.household_state.recompute_sums()[name]
+            if not math.isclose(total, recomputed, rel_tol=1e-9, abs_tol=1e-9):
+                raise AssertionError(f"Running sum of {name} is {total}, recomputed sum is {recomputed}")
+        return total
 
     def total_adapted_households(self):
         """Return the total number of households that have adapted."""
-        #BE CAREFUL THAT YOU MAY HAVE DIFFERENT AGENT TYPES SO YOU NEED TO FIRST CHECK IF THE AGENT IS ACTUALLY A HOUSEHOLD AGENT USING "ISINSTANCE"
-        adapted_count = sum([1 for agent in self.schedule.agents if isinstance(agent, Households) and agent.is_adapted])
+        adapted_count = int(self.aggregate('is_adapted'))
+        if self.verify_aggregates:
+            counted = sum([1 for agent in self.households if agent.is_adapted])
+            if counted != adapted_count:
+                raise AssertionError(f"Running count of adapted households is {adapted_count}, counted {counted}")
         return adapted_count
 
+    def average_flood_damage_households(self):
+        """Return the average actual flood damage of the households."""
+        average = self.aggregate('flood_damage_actual') / self.number_of_households
+        if self.verify_aggregates:
+            # the damage as the waterboard calculated it for every household before the running sums
+            recomputed = sum(calculate_basic_flood_damage(agent.flood_depth_actual, agent.sandbags_placed,
+                                                          self.waterboard.adaptation_on_rivers_and_drainages,
+                                                          self.government.warning_system,
+                                                          self.policy_maker.infrastructure_government,
+                                                          damage_curve=self.damage_curve)
+                             for agent in self.households) / self.number_of_households
+            if not math.isclose(average, recomputed, rel_tol=1e-9, abs_tol=1e-9):
+                raise AssertionError(f"Average flood damage from the running sum is {average}, recomputed {recomputed}")
+        return average
+
     #here, the policy maker is called to determine the new value of provide_information
     def provide_information(self):
         return self.policy_maker.provide_information
@@ -225,83 +513,142 @@ class AdaptationModel(Model):
     def determine_political_situation(self):
         return self.political_situation
     
-    def plot_model_domain_with_agents(self):
-        fig, ax = plt.subplots()
-        # Plot the model domain
-        map_domain_gdf.plot(ax=ax, color='lightgrey')
-        # Plot the floodplain
-        floodplain_gdf.plot(ax=ax, color='lightblue', edgecolor='k', alpha=0.5)
-
-        # Collect agent locations and statuses
-        for agent in self.schedule.agents:
-            #only execute code for households
-            if type(agent) == Households:
-                color = 'blue' if agent.is_adapted else 'red'
-                ax.scatter(agent.location.x, agent.location.y, color=color, s=10, label=color.capitalize() if not ax.collections else "")
-                ax.annotate(str(agent.unique_id), (agent.location.x, agent.location.y), textcoords="offset points", xytext=(0,1), ha='center', fontsize=9)
-        # Create legend with unique entries
-        handles, labels = ax.get_legend_handles_labels()
-        by_label = dict(zip(labels, handles))
-        ax.legend(by_label.values(), by_label.keys(), title="Red: not adapted, Blue: adapted")
+    def plot_model_domain_with_agents(self, ax=None, mode='auto', labels=False, show=True):
+        """
+        Plot the model domain with the households, red when not adapted and blue when adapted, see plotting.py.
+
+        Parameters
+        ----------
+        ax: matplotlib axes to plot on, None for a new figure
+        mode: 'scatter', 'density' for the share of adapted households per histogram cell, or 'auto'
+              for density with many households
+        labels: annotate every household with its unique id
+        show: show the figure
+        """
+        ax = plot_households(self, ax=ax, mode=mode, labels=labels)
 
         # Customize plot with titles and labels
-        plt.title(f'Model Domain with Agents at Step {self.schedule.steps}')
-        plt.xlabel('Longitude')
-        plt.ylabel('Latitude')
-        plt.show()
+        ax.set_title(f'Model Domain with Agents at Step {self.schedule.steps}')
+        ax.set_xlabel('Longitude')
+        ax.set_ylabel('Latitude')
+        if show:
+            plt.show()
+        return ax
+
+    def plot_social_network(self, ax=None, mode='auto', labels=False, show=True):
+        """
+        Plot the social network, red when not adapted and blue when adapted, and return the NetworkPlot.
+        The layout is cached per network, call update on the returned plot to recolour it in later steps.
+
+        Parameters
+        ----------
+        ax: matplotlib axes to plot on, None for a new figure
+        mode: 'nodes', 'communities' for the share of adapted households per community, or 'auto'
+              for communities in large networks
+        labels: label every household with its node
+        show: show the figure
+        """
+        network_plot = NetworkPlot(self, ax=ax, mode=mode, labels=labels)
+        if show:
+            plt.show()
+        return network_plot
+
+    def memory_report(self):
+        """
+        Return the bytes held per model component and the peak RSS of the process, see memory_report.py.
+        If the model was created without memory_sample_every, tracing starts now and only later allocations are attributed.
+        """
+        if self.memory_monitor is None:
+            self.memory_monitor = MemoryMonitor()
+        return self.memory_monitor.report(self)
+
+    def household_context(self):
+        """
+        Return the values of the other agents that the households use in their advance in the current step,
+        see HouseholdContext in agents.py. They are the same for all households, so they are determined once per step.
+        """
+        step = self.schedule.steps
+        if self._household_context is None or self._household_context[0] != step:
+            self._household_context = (step, HouseholdContext.determine(self))
+        return self._household_context[1]
 
     def determine_average_political_perception_households(self):
         #function used to determine the average political perception of the households
         #this function is called in the step of government to be used to determine the government their new political perception
 
-        #reset value
-        self.average_political_perception_households = 0
-
-        # loop through all agents
-        for agent in self.schedule.agents:
-            #only execute code for households
-            if type(agent) == Households:
-                #sum all political perceptions
-                self.average_political_perception_households = self.average_political_perception_households + agent.political_perception
-        #return the average political perception by dividing by the total number of households
+        #the sum of the political perceptions of all households is kept up to date by the households themselves
+        self.average_political_perception_households = self.aggregate('political_perception')
         return self.average_political_perception_households/self.number_of_households
 
     def step(self):
         """
         introducing a shock: 
-        at time step 5, there will be a global flooding.
+        every 5 time steps (or as set by flood_event_schedule), there will be a flooding.
         This will result in actual flood depth. Here, we assume it is a random number
-        between 0.5 and 1.2 of the estimated flood depth. In your model, you can replace this
-        with a more sound procedure (e.g., you can devide the floop map into zones and 
-        assume local flooding instead of global flooding). The actual flood depth can be 
-        estimated differently
+        between 0.4 and 0.9 of the estimated flood depth, drawn per household or per flood zone.
+        Between floods the water recedes. The flood event engine in flood_events.py updates
+        all households at once.
+
+        With a convergence_action, the state is first compared with the state one flood cycle earlier.
+        A converged run with 'stop' completes this step and sets running to False, a converged run with
+        'fast_forward' is advanced without simulating it, see fast_forward_step.
         """
+        if self.convergence is not None and self.convergence.observe(self) and self.convergence.action == FAST_FORWARD:
+            self.fast_forward_step()
+            return
+
+        self.profiler.start_step(self.schedule.steps)
 
+        # re-sync the running household sums with the arrays, so that their rounding errors do not add up over a long run
+        self.household_state.refresh_sums()
 
-        for agent in self.schedule.agents:
-            # only execute code for households
-            if type(agent) == Households:
-                agent.flood_depth_actual = agent.flood_depth_actual - random.uniform(0.2,
-                                                                                     0.5) * agent.flood_depth_estimated
-                if agent.flood_depth_actual < 0:
-                    agent.flood_depth_actual = 0
-                agent.flood_damage_actual = calculate_basic_flood_damage(agent.flood_depth_actual,
-                                                                         agent.sandbags_placed,
-                                                                         self.waterboard.adaptation_on_rivers_and_drainages,
-                                                                         self.government.warning_system,
-                                                                         self.policy_maker.infrastructure_government)
-                if self.schedule.steps > 0 and (self.schedule.steps % 5) == 0:
-                    # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
-                    agent.flood_depth_actual = agent.flood_depth_actual + random.uniform(0.4, 0.9) * agent.flood_depth_estimated
-                    # calculate the actual flood damage given the actual flood depth
-                    agent.flood_damage_actual = calculate_basic_flood_damage(agent.flood_depth_actual, agent.sandbags_placed, self.waterboard.adaptation_on_rivers_and_drainages,
-                                                                             self.government.warning_system, self.policy_maker.infrastructure_government)
+        if self.memory_monitor is not None:
+            self.memory_monitor.sample(self.schedule.steps, self)
+
+        with self.profiler.phase("households", calls=self.number_of_households):
+            self.flood_events.step(self.schedule.steps)
 
         # randomly determine if a protest takes place this step, value 0 or 1
         self.protest = random.randint(0,1)
 
         # Collect data and advance the model by one step
-        self.datacollector.collect(self)
+        step = self.schedule.steps
+        flood_event = bool(self.flood_events.current_events)
+        with self.profiler.phase("datacollector.collect"):
+            self.datacollector.collect(self,
+                                       model_vars=collects_at(self.model_data_every, step, flood_event),
+                                       agent_vars=collects_at(self.agent_data_every, step, flood_event))
         self.schedule.step()
 
+        if self.metrics is not None:
+            self.metrics.publish(self)
+
+        if self.convergence is not None and self.convergence.converged:
+            # the Mesa batch_run stops running the model, the data of this step is the last row of the run
+            self.running = False
+
+        self.profiler.end_step()
+
+    def fast_forward_step(self):
+        """
+        Advance a converged model by one step without simulating it. The state of the model stays as it was
+        on convergence, the data of this step is the data of the same step in an earlier flood cycle
+        (see StepDataCollector.replay).
+        """
+        self.profiler.start_step(self.schedule.steps)
+        step = self.schedule.steps
+        flood_event = bool(self.flood_events.schedule.events_at(step))
+        with self.profiler.phase("datacollector.collect"):
+            self.datacollector.replay(self, self.convergence.period,
+                                      model_vars=collects_at(self.model_data_every, step, flood_event),
+                                      agent_vars=collects_at(self.agent_data_every, step, flood_event),
+                                      current=("ConvergedAtStep",))
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+        if self.metrics is not None:
+            self.metrics.publish(self)
+
+        self.profiler.end_step()
+
 
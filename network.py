@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Array based social networks for the Flood Adaptation Model.
+
+The generators in this file produce the edges of the supported network types directly as NumPy
+arrays and store them in compressed sparse row (CSR) form, which scales to millions of households.
+A networkx graph is only built on request, e.g. for plotting.
+"""
+import random
+
+import numpy as np
+import networkx as nx
+
+
+class CSRNetwork:
+    """
+    Undirected graph stored as compressed sparse row arrays.
+    The neighbours of node i are indices[indptr[i]:indptr[i + 1]], sorted in ascending order.
+    """
+
+    def __init__(self, number_of_nodes, indptr, indices):
+        self.number_of_nodes = number_of_nodes
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_edges(cls, number_of_nodes, sources, targets):
+        """
+        Build the network from edge arrays. Self-loops and duplicate edges are dropped,
+        every remaining edge is stored in both directions.
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        # store every edge once as (low, high) and drop self-loops and duplicates
+        low = np.minimum(sources, targets)
+        high = np.maximum(sources, targets)
+        keep = low != high
+        keys = np.unique(low[keep] * number_of_nodes + high[keep])
+        low = keys // number_of_nodes
+        high = keys % number_of_nodes
+        # both directions, sorted by source and then by target
+        keys = np.sort(np.concatenate([keys, high * number_of_nodes + low]))
+        src = keys // number_of_nodes
+        dst = keys % number_of_nodes
+        index_dtype = np.int32 if number_of_nodes < np.iinfo(np.int32).max else np.int64
+        indptr = np.zeros(number_of_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=number_of_nodes), out=indptr[1:])
+        return cls(number_of_nodes, indptr, dst.astype(index_dtype))
+
+    @property
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def neighbors(self, node):
+        """Return the array of neighbours of node."""
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def degree(self):
+        """Return the array with the degree of every node."""
+        return np.diff(self.indptr)
+
+    def edges(self):
+        """Return the edges as two arrays (sources, targets) with every edge listed once."""
+        sources = np.repeat(np.arange(self.number_of_nodes), self.degree())
+        once = sources < self.indices
+        return sources[once], self.indices[once]
+
+    def to_networkx(self):
+        """Materialise the network as a networkx graph."""
+        G = nx.Graph()
+        G.add_nodes_from(range(self.number_of_nodes))
+        G.add_edges_from(zip(*(array.tolist() for array in self.edges())))
+        return G
+
+
+def label_propagation_communities(network, max_iterations=20, seed=0):
+    """
+    Detect communities by label propagation on the CSR arrays: every node repeatedly takes the label that
+    is most frequent among its neighbours, with ties broken at random. In every iteration a random half of
+    the nodes is updated, which keeps the labels of neighbouring nodes from oscillating.
+
+    Returns
+    -------
+    communities: array with the community of every node, numbered from 0
+    """
+    n = network.number_of_nodes
+    sources = np.repeat(np.arange(n), network.degree())
+    labels = np.arange(n)
+    rng = np.random.default_rng(seed)
+    for _ in range(max_iterations):
+        if len(sources) == 0:
+            break
+        # count the neighbour labels of every node as (node, label) pairs
+        neighbour_labels = labels[network.indices]
+        order = np.lexsort((neighbour_labels, sources))
+        pair_sources = sources[order]
+        pair_labels = neighbour_labels[order]
+        starts = np.flatnonzero(np.concatenate(([True], (pair_sources[1:] != pair_sources[:-1]) |
+                                                (pair_labels[1:] != pair_labels[:-1]))))
+        counts = np.diff(np.append(starts, len(pair_sources)))
+        pair_sources = pair_sources[starts]
+        pair_labels = pair_labels[starts]
+        # the most frequent label per node, the random fraction breaks ties
+        order = np.lexsort((-(counts + rng.random(len(counts))), pair_sources))
+        first = np.concatenate(([True], pair_sources[order][1:] != pair_sources[order][:-1]))
+        new_labels = labels.copy()
+        new_labels[pair_sources[order][first]] = pair_labels[order][first]
+        if np.mean(new_labels != labels) < 0.001:
+            break
+        labels = np.where(rng.random(n) < 0.5, new_labels, labels)
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def contract_communities(network, communities, weights=None):
+    """
+    Return the network between communities: one node per community and an edge between two communities
+    with as weight the (summed weight of the) edges between their members.
+
+    Returns
+    -------
+    contracted: CSRNetwork of the communities
+    contracted_weights: weight of every entry of contracted.indices
+    """
+    k = int(communities.max()) + 1 if len(communities) else 0
+    if weights is None:
+        weights = np.ones(len(network.indices), dtype=np.int64)
+    sources = communities[np.repeat(np.arange(network.number_of_nodes), network.degree())]
+    targets = communities[network.indices]
+    between = sources != targets
+    # every edge is stored in both directions, so the contracted edges are as well
+    keys, inverse = np.unique(sources[between] * k + targets[between], return_inverse=True)
+    contracted_weights = np.bincount(inverse, weights=weights[between], minlength=len(keys)).astype(np.int64)
+    indptr = np.zeros(k + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // k, minlength=k), out=indptr[1:])
+    return CSRNetwork(k, indptr, keys % k), contracted_weights
+
+
+def coarse_communities(network, max_communities=500, seed=0):
+    """
+    Return at most about max_communities communities of a network, for plots of large networks.
+
+    The communities found by label propagation are merged pairwise until few enough remain. In every round
+    each community picks the neighbour with the most edges between them relative to their sizes, and
+    communities that pick each other are merged (heavy edge matching, as in multilevel graph partitioning).
+    Communities without edges to other communities are never merged.
+
+    Returns
+    -------
+    communities: array with the community of every node, numbered from 0
+    """
+    rng = np.random.default_rng(seed)
+    communities = label_propagation_communities(network, seed=seed)
+    graph, weights = contract_communities(network, communities)
+    sizes = np.bincount(communities).astype(np.float64)
+    while graph.number_of_nodes > max_communities:
+        k = graph.number_of_nodes
+        sources = np.repeat(np.arange(k), graph.degree())
+        score = weights / (sizes[sources] * sizes[graph.indices]) * (1 + 1e-6 * rng.random(len(weights)))
+        order = np.lexsort((-score, sources))
+        first = np.concatenate(([True], sources[order][1:] != sources[order][:-1]))[:len(order)]
+        choice = np.arange(k)
+        choice[sources[order][first]] = graph.indices[order][first]
+        # merge the communities that chose each other into the one with the lowest number
+        mutual = (choice != np.arange(k)) & (choice[choice] == np.arange(k))
+        if not mutual.any():
+            break
+        merge = np.where(mutual, np.minimum(np.arange(k), choice), np.arange(k))
+        merge = np.unique(merge, return_inverse=True)[1]
+        communities = merge[communities]
+        sizes = np.bincount(merge, weights=sizes)
+        graph, weights = contract_communities(graph, merge, weights)
+    return communities
+
+
+def _pair_from_index(k):
+    """Map linear indices of the lower triangle (j < i) back to the node pairs (i, j)."""
+    i = np.floor((1 + np.sqrt(1 + 8 * k.astype(np.float64))) / 2).astype(np.int64)
+    # correct floating point rounding for very large indices
+    i -= (i * (i - 1) // 2) > k
+    i += ((i + 1) * i // 2) <= k
+    j = k - i * (i - 1) // 2
+    return i, j
+
+
+def erdos_renyi_edges(n, p, rng):
+    """
+    Edges of a G(n, p) random graph, using the geometric skipping method of Batagelj and Brandes (2005).
+    The expected run time is linear in the number of edges instead of in the number of node pairs.
+    """
+    number_of_pairs = n * (n - 1) // 2
+    if p <= 0 or number_of_pairs == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if p >= 1:
+        pair_indices = np.arange(number_of_pairs, dtype=np.int64)
+    else:
+        # draw the gaps between consecutive edges in batches until all node pairs are passed
+        batch = int(number_of_pairs * p + 5 * np.sqrt(number_of_pairs * p) + 16)
+        chunks = []
+        last = -1
+        while last < number_of_pairs:
+            positions = last + np.cumsum(rng.geometric(p, size=batch))
+            chunks.append(positions)
+            last = positions[-1]
+        pair_indices = np.concatenate(chunks)
+        pair_indices = pair_indices[pair_indices < number_of_pairs]
+    return _pair_from_index(pair_indices)
+
+
+def barabasi_albert_edges(n, m, rng):
+    """
+    Edges of a Barabasi-Albert preferential attachment graph, following the linear time algorithm of
+    Batagelj and Brandes (2005): every new node picks m endpoints of earlier edges uniformly at random.
+    The pointer chains of that algorithm are resolved for all edges at once.
+    Self-loops and duplicate edges are dropped, so a few nodes end up with less than m edges.
+    """
+    if m < 1 or m >= n:
+        raise ValueError(f"Barabasi-Albert network must have m >= 1 and m < n, m = {m}, n = {n}")
+    number_of_edges = n * m
+    edge = np.arange(number_of_edges, dtype=np.int64)
+    sources = edge // m
+    # slot 2e holds the source of edge e, slot 2e + 1 a copy of a uniformly chosen earlier slot
+    pointers = np.floor(rng.random(number_of_edges) * (2 * edge + 1)).astype(np.int64)
+    odd = pointers % 2 == 1
+    while odd.any():
+        pointers[odd] = pointers[(pointers[odd] - 1) // 2]
+        odd = pointers % 2 == 1
+    return sources, sources[pointers // 2]
+
+
+def watts_strogatz_edges(n, k, p, rng):
+    """
+    Edges of a Watts-Strogatz small world graph: a ring lattice in which every node is joined to its
+    k // 2 nearest neighbours on each side, after which each edge is rewired to a random node with probability p.
+    """
+    if k >= n:
+        return erdos_renyi_edges(n, 1, rng)
+    nodes = np.arange(n, dtype=np.int64)
+    sources = np.tile(nodes, k // 2)
+    targets = (sources + np.repeat(np.arange(1, k // 2 + 1), n)) % n
+    rewire = rng.random(len(targets)) < p
+    targets[rewire] = rng.integers(0, n, size=int(rewire.sum()))
+    return sources, targets
+
+
+def generate_network(network, number_of_households, seed, probability_of_network_connection,
+                     number_of_edges, number_of_nearest_neighbours):
+    """
+    Generate the social network of the model as a CSRNetwork.
+
+    Parameters
+    ----------
+    network: "erdos_renyi", "barabasi_albert", "watts_strogatz", or "no_network"
+    number_of_households: number of nodes
+    seed: seed of the random number generator, e.g. the model seed. None to seed it from the random module,
+          which the networkx generators drew from, so that random.seed fixes the network
+    probability_of_network_connection, number_of_edges, number_of_nearest_neighbours: network parameters of the model
+
+    Returns
+    -------
+    network: the generated CSRNetwork
+    """
+    rng = np.random.default_rng(random.getrandbits(64) if seed is None else seed)
+    n = number_of_households
+    if network == 'erdos_renyi':
+        sources, targets = erdos_renyi_edges(n, number_of_nearest_neighbours / n, rng)
+    elif network == 'barabasi_albert':
+        sources, targets = barabasi_albert_edges(n, number_of_edges, rng)
+    elif network == 'watts_strogatz':
+        sources, targets = watts_strogatz_edges(n, number_of_nearest_neighbours, probability_of_network_connection, rng)
+    elif network == 'no_network':
+        sources, targets = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    else:
+        raise ValueError(f"Unknown network type: '{network}'. "
+                         f"Currently implemented network types are: "
+                         f"'erdos_renyi', 'barabasi_albert', 'watts_strogatz', and 'no_network'")
+    return CSRNetwork.from_edges(n, sources, targets)
+
+
+class CSRNetworkGrid:
+    """
+    Light-weight replacement of mesa's NetworkGrid on top of a CSRNetwork.
+    Every node holds at most one agent, which is the case for the households of this model.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.node_agents = [None] * network.number_of_nodes
+
+    def place_agent(self, agent, node_id):
+        """Place an agent on a node."""
+        if self.node_agents[node_id] is not None:
+            raise ValueError(f"Node {node_id} already holds agent {self.node_agents[node_id].unique_id}")
+        self.node_agents[node_id] = agent
+        agent.pos = node_id
+
+    def get_neighborhood(self, node_id, include_center=False):
+        """Return the list of neighbouring nodes, optionally including node_id itself."""
+        neighborhood = self.network.neighbors(node_id).tolist()
+        if include_center:
+            neighborhood.append(node_id)
+        return neighborhood
+
+    def get_neighbors(self, node_id, include_center=False):
+        """Return the agents on the neighbouring nodes."""
+        node_agents = self.node_agents
+        return [node_agents[node] for node in self.get_neighborhood(node_id, include_center)
+                if node_agents[node] is not None]
+
+    def is_cell_empty(self, node_id):
+        return self.node_agents[node_id] is None
+
+    def get_all_cell_contents(self):
+        return [agent for agent in self.node_agents if agent is not None]
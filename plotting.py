@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Plots of the Flood Adaptation Model that stay fast for large numbers of households.
+
+The model domain and floodplain are rendered once per input provider into an image, which is reused
+as the basemap of every later plot instead of plotting the GeoDataFrames again. All households are
+drawn in one scatter, with the coordinates and adaptation status taken from the world and household
+arrays. For large numbers of households the plot shows the share of adapted households per cell of
+a 2D histogram instead of one marker per household.
+
+The social network is laid out once per network, with a spring layout for small networks and a
+spectral layout refined by a grid based force layout for large ones, and the positions are cached. A NetworkPlot draws the edges and nodes
+once and only recolours the nodes on update. Networks that are too large to draw node by node are
+shown as communities, coloured by the share of adapted households in each community.
+"""
+import hashlib
+
+import numpy as np
+import networkx as nx
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+from scipy.ndimage import gaussian_filter
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import eigsh
+
+from network import coarse_communities, contract_communities
+
+# colours of households that are not adapted and adapted, as in the original plots
+NOT_ADAPTED_COLOR = 'red'
+ADAPTED_COLOR = 'blue'
+
+# above this number of households the 'auto' mode plots a 2D histogram instead of a scatter
+DENSITY_THRESHOLD = 5000
+
+# networks up to this number of nodes are laid out with the spring layout of networkx, larger ones with spectral_layout
+SPRING_LAYOUT_LIMIT = 1000
+
+# above this number of households the 'auto' mode of a NetworkPlot draws communities instead of nodes
+NETWORK_NODE_LIMIT = 5000
+
+# number of the edges between communities with the most household connections that is drawn
+MAX_COMMUNITY_EDGES = 2000
+
+# colormap of the share of adapted households, from red (none adapted) to blue (all adapted)
+ADAPTED_SHARE_CMAP = ListedColormap(np.linspace([1, 0, 0, 1], [0, 0, 1, 1], 256))
+
+# rendered basemaps, by the cache key of the input provider and the size of the image
+_basemaps = {}
+
+# network layouts and communities, by the hash of the network arrays and their settings
+_layouts = {}
+_communities = {}
+
+
+def render_basemap(map_domain_gdf, floodplain_gdf, pixels=1000):
+    """
+    Render the model domain and the floodplain into an RGBA image.
+
+    Parameters
+    ----------
+    map_domain_gdf, floodplain_gdf: GeoDataFrames of the model domain and the floodplain
+    pixels: size of the longest side of the image
+
+    Returns
+    -------
+    image: RGBA array of the rendered basemap
+    extent: (left, right, bottom, top) of the image in map coordinates, as used by imshow
+    """
+    domain_bounds = map_domain_gdf.total_bounds
+    floodplain_bounds = floodplain_gdf.total_bounds
+    left, bottom = np.minimum(domain_bounds[:2], floodplain_bounds[:2])
+    right, top = np.maximum(domain_bounds[2:], floodplain_bounds[2:])
+    aspect = (top - bottom) / (right - left)
+    width, height = (pixels, max(1, round(pixels * aspect))) if aspect <= 1 else (max(1, round(pixels / aspect)), pixels)
+    # render off screen, without the figure manager of pyplot
+    fig = Figure(figsize=(width / 100, height / 100), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    map_domain_gdf.plot(ax=ax, color='lightgrey')
+    floodplain_gdf.plot(ax=ax, color='lightblue', edgecolor='k', alpha=0.5)
+    ax.set_xlim(left, right)
+    ax.set_ylim(bottom, top)
+    canvas.draw()
+    image = np.asarray(canvas.buffer_rgba()).copy()
+    return image, (left, right, bottom, top)
+
+
+def get_basemap(model, pixels=1000):
+    """Return the rendered basemap (image, extent) of a model, rendering it only once per input provider."""
+    key = (model.input_provider.cache_key(), pixels)
+    if key not in _basemaps:
+        _basemaps[key] = render_basemap(model.map_domain_gdf, model.floodplain_gdf, pixels)
+    return _basemaps[key]
+
+
+def plot_households(model, ax=None, mode='auto', labels=False, bins=100, basemap_pixels=1000):
+    """
+    Plot the model domain with all households coloured by their adaptation status.
+
+    Parameters
+    ----------
+    model: AdaptationModel
+    ax: matplotlib axes to plot on, None for a new figure
+    mode: 'scatter' for one marker per household, 'density' for the share of adapted households
+          per cell of a bins x bins histogram, 'auto' for density above DENSITY_THRESHOLD households
+    labels: annotate every household with its unique id, only in scatter mode
+    bins: number of histogram cells along each axis in density mode
+    basemap_pixels: size of the longest side of the cached basemap image
+
+    Returns
+    -------
+    ax: the axes of the plot
+    """
+    if mode == 'auto':
+        mode = 'density' if model.number_of_households > DENSITY_THRESHOLD else 'scatter'
+    if mode not in ('scatter', 'density'):
+        raise ValueError(f"Unknown plot mode: '{mode}'. Use 'scatter', 'density' or 'auto'")
+    if ax is None:
+        _, ax = plt.subplots()
+    image, extent = get_basemap(model, basemap_pixels)
+    ax.imshow(image, extent=extent, origin='upper', interpolation='bilinear', zorder=0)
+
+    # coordinates and status of all households, in the order of their node
+    x = model.world.x
+    y = model.world.y
+    is_adapted = model.household_state.is_adapted
+    if mode == 'scatter':
+        colors = np.where(is_adapted, ADAPTED_COLOR, NOT_ADAPTED_COLOR)
+        ax.scatter(x, y, c=colors, s=10, zorder=2)
+        if labels:
+            for household in model.households:
+                ax.annotate(str(household.unique_id), (household.location.x, household.location.y),
+                            textcoords="offset points", xytext=(0, 1), ha='center', fontsize=9)
+        handles = [Line2D([], [], marker='o', linestyle='', color=color, label=color.capitalize())
+                   for color in (NOT_ADAPTED_COLOR, ADAPTED_COLOR)]
+        ax.legend(handles=handles, title="Red: not adapted, Blue: adapted")
+    else:
+        cell_range = [extent[:2], extent[2:]]
+        households, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=cell_range)
+        adapted, _, _ = np.histogram2d(x, y, bins=bins, range=cell_range, weights=is_adapted.astype(np.float64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.ma.masked_invalid(adapted / households)
+        mesh = ax.pcolormesh(x_edges, y_edges, share.T, cmap=ADAPTED_SHARE_CMAP, vmin=0, vmax=1, alpha=0.8, zorder=1)
+        ax.figure.colorbar(mesh, ax=ax, label='Share of households adapted')
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    return ax
+
+
+def network_key(network):
+    """Return a hash of the arrays of a CSRNetwork, used to cache layouts per network."""
+    digest = hashlib.sha1(np.ascontiguousarray(network.indptr).tobytes())
+    digest.update(np.ascontiguousarray(network.indices).tobytes())
+    return digest.hexdigest()
+
+
+def spectral_layout(network, seed=0):
+    """
+    Return the positions of the nodes from the two leading non-trivial eigenvectors of the random walk matrix
+    of the network. The eigenvectors are computed on the sparse CSR arrays, which scales to large networks.
+    """
+    n = network.number_of_nodes
+    if n < 4:
+        return np.column_stack([np.cos(2 * np.pi * np.arange(n) / max(n, 1)), np.sin(2 * np.pi * np.arange(n) / max(n, 1))])
+    scale = 1 / np.sqrt(np.maximum(network.degree(), 1))
+    adjacency = csr_matrix((np.ones(len(network.indices)), network.indices, network.indptr), shape=(n, n))
+    normalised = diags(scale) @ adjacency @ diags(scale)
+    v0 = np.random.default_rng(seed).random(n)
+    values, vectors = eigsh(normalised, k=3, which='LA', v0=v0)
+    order = np.argsort(values)[::-1]
+    positions = vectors[:, order[1:3]] * scale[:, np.newaxis]
+    positions -= positions.mean(axis=0)
+    return positions / max(np.abs(positions).max(), 1e-12)
+
+
+def refine_layout(network, positions, iterations=100, grid=64, seed=0):
+    """
+    Spread a layout with an approximate force layout in O(nodes + edges) per iteration: every node is
+    attracted to the mean position of its neighbours and pushed away from dense areas, using the gradient
+    of the smoothed node density on a grid x grid histogram instead of the repulsion between all pairs.
+    """
+    n = network.number_of_nodes
+    adjacency = csr_matrix((np.ones(len(network.indices)), network.indices, network.indptr), shape=(n, n))
+    degree = np.maximum(network.degree(), 1)[:, np.newaxis]
+    positions = positions + np.random.default_rng(seed).normal(0, 0.01, positions.shape)
+    step = 0.1
+    for _ in range(iterations):
+        attraction = adjacency @ positions / degree - positions
+        density = np.histogram2d(positions[:, 0], positions[:, 1], bins=grid, range=[[-1, 1], [-1, 1]])[0]
+        # density relative to a uniform spread of the nodes over a disc
+        density = gaussian_filter(density * grid * grid / (np.pi * n), sigma=2)
+        gradient_x, gradient_y = np.gradient(density)
+        cells = np.clip(((positions + 1) / 2 * grid).astype(int), 0, grid - 1)
+        repulsion = -np.column_stack([gradient_x[cells[:, 0], cells[:, 1]], gradient_y[cells[:, 0], cells[:, 1]]])
+        positions = np.clip(positions + step * (attraction + 0.5 * repulsion), -1, 1)
+        step *= 0.98
+    return positions
+
+
+def get_layout(network, seed=0):
+    """Return the cached positions (n x 2 array) of the nodes of a network, computing them on first use."""
+    key = (network_key(network), seed)
+    if key not in _layouts:
+        if network.number_of_nodes <= SPRING_LAYOUT_LIMIT:
+            layout = nx.spring_layout(network.to_networkx(), seed=seed)
+            _layouts[key] = np.array([layout[node] for node in range(network.number_of_nodes)]).reshape(-1, 2)
+        else:
+            _layouts[key] = refine_layout(network, spectral_layout(network, seed), seed=seed)
+    return _layouts[key]
+
+
+def get_communities(network, max_communities=500, seed=0):
+    """Return the cached communities of a network, see coarse_communities in network.py."""
+    key = (network_key(network), max_communities, seed)
+    if key not in _communities:
+        _communities[key] = coarse_communities(network, max_communities, seed)
+    return _communities[key]
+
+
+class NetworkPlot:
+    """
+    Plot of the social network of a model, coloured by the adaptation status of the households.
+
+    The layout is computed once per network and cached. The edges and nodes are drawn once, update only
+    recolours the nodes, so the plot can be redrawn cheaply while the model runs.
+
+    Parameters
+    ----------
+    model: AdaptationModel
+    ax: matplotlib axes to plot on, None for a new figure
+    mode: 'nodes' to draw every household, 'communities' to draw one node per community, sized by the
+          number of households and coloured by the share of adapted households, with the MAX_COMMUNITY_EDGES
+          strongest edges between communities, or 'auto' for communities above NETWORK_NODE_LIMIT households
+    labels: label every household with its node, only in nodes mode
+    max_communities: number of communities to aim for in communities mode
+    seed: seed of the layout and the community detection
+    """
+
+    def __init__(self, model, ax=None, mode='auto', labels=False, max_communities=500, seed=0):
+        if mode == 'auto':
+            mode = 'communities' if model.number_of_households > NETWORK_NODE_LIMIT else 'nodes'
+        if mode not in ('nodes', 'communities'):
+            raise ValueError(f"Unknown network plot mode: '{mode}'. Use 'nodes', 'communities' or 'auto'")
+        if ax is None:
+            _, ax = plt.subplots(figsize=(7, 7))
+        self.model = model
+        self.ax = ax
+        self.mode = mode
+        network = model.social_network
+        positions = get_layout(network, seed)
+        if mode == 'nodes':
+            sources, targets = network.edges()
+            ax.add_collection(LineCollection(np.stack([positions[sources], positions[targets]], axis=1),
+                                             colors='k', linewidths=0.5, alpha=0.5, zorder=1))
+            self.nodes = ax.scatter(positions[:, 0], positions[:, 1], s=300 if labels else 30, zorder=2)
+            if labels:
+                for node, (x, y) in enumerate(positions):
+                    ax.text(x, y, str(node), ha='center', va='center', fontsize=8, zorder=3)
+        else:
+            self.communities = get_communities(network, max_communities, seed)
+            self.sizes = np.bincount(self.communities)
+            centres = np.column_stack([np.bincount(self.communities, weights=positions[:, i]) / self.sizes for i in range(2)])
+            graph, weights = contract_communities(network, self.communities)
+            sources = np.repeat(np.arange(graph.number_of_nodes), graph.degree())
+            once = np.flatnonzero(sources < graph.indices)
+            once = once[np.argsort(-weights[once], kind='stable')[:MAX_COMMUNITY_EDGES]]
+            ax.add_collection(LineCollection(np.stack([centres[sources[once]], centres[graph.indices[once]]], axis=1),
+                                             colors='k', linewidths=0.2 + np.log1p(weights[once]) / 2, alpha=0.3, zorder=1))
+            self.nodes = ax.scatter(centres[:, 0], centres[:, 1], c=np.zeros(len(self.sizes)),
+                                    s=10 + 200 * np.sqrt(self.sizes / self.sizes.max()), cmap=ADAPTED_SHARE_CMAP, vmin=0, vmax=1, zorder=2)
+            ax.figure.colorbar(self.nodes, ax=ax, label='Share of households adapted')
+        ax.set_axis_off()
+        ax.autoscale_view()
+        self.update()
+
+    def update(self):
+        """Recolour the nodes with the current adaptation status and update the title."""
+        is_adapted = self.model.household_state.is_adapted
+        if self.mode == 'nodes':
+            self.nodes.set_facecolor(np.where(is_adapted, ADAPTED_COLOR, NOT_ADAPTED_COLOR))
+        else:
+            self.nodes.set_array(np.bincount(self.communities, weights=is_adapted, minlength=len(self.sizes)) / self.sizes)
+        self.ax.set_title(f"Social Network State at Step {self.model.schedule.steps}", fontsize=12)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Step profiling for the Flood Adaptation Model.
+
+The StepProfiler records wall time and call counts per phase of AdaptationModel.step
+(household flood loop, schedule step/advance per agent class, data collection) for every step.
+A run can be written to a Chrome trace file, which can be opened in chrome://tracing,
+Perfetto or speedscope.
+"""
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+from scheduler import PhasedActivation
+
+
+class NullProfiler:
+    """Stand-in used when profiling is disabled, every call is a no-op."""
+    enabled = False
+
+    @contextmanager
+    def phase(self, name, calls=1):
+        yield
+
+    def start_step(self, step):
+        pass
+
+    def end_step(self):
+        pass
+
+
+class StepProfiler:
+    """
+    Records wall time and call counts per phase for each model step.
+
+    Parameters
+    ----------
+    trace: if True, keep the individual timed events so that they can be written with write_trace
+
+    Attributes
+    ----------
+    steps: list with one dictionary per finished step, mapping phase name to (seconds, calls)
+    """
+    enabled = True
+
+    def __init__(self, trace=True):
+        self.trace = trace
+        self.steps = []
+        self.trace_events = []
+        self._origin = perf_counter()
+        self._current = None
+        self._current_step = None
+        self._step_start = None
+
+    def start_step(self, step):
+        """Start recording a new model step."""
+        self._current = defaultdict(lambda: [0.0, 0])
+        self._current_step = step
+        self._step_start = perf_counter()
+
+    def end_step(self):
+        """Finish the current model step and store its phase timings."""
+        end = perf_counter()
+        self.record('step', self._step_start, end)
+        self.steps.append({name: (seconds, calls) for name, (seconds, calls) in self._current.items()})
+        self._current = None
+
+    def record(self, name, start, end, calls=1):
+        """Add a timed phase of the current step, start and end are perf_counter values."""
+        if self._current is None:
+            return
+        timing = self._current[name]
+        timing[0] += end - start
+        timing[1] += calls
+        if self.trace:
+            self.trace_events.append({'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                                      'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+                                      'pid': os.getpid(), 'tid': 0,
+                                      'args': {'step': self._current_step, 'calls': calls}})
+
+    @contextmanager
+    def phase(self, name, calls=1):
+        """Time the enclosed block as one phase of the current step."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, perf_counter(), calls)
+
+    def last_step_time(self):
+        """Return the wall time of the last finished step in seconds, 0 before the first step."""
+        if not self.steps:
+            return 0
+        return self.steps[-1]['step'][0]
+
+    def totals(self):
+        """Return a dictionary mapping phase name to (total seconds, total calls) over all finished steps."""
+        totals = defaultdict(lambda: [0.0, 0])
+        for step in self.steps:
+            for name, (seconds, calls) in step.items():
+                totals[name][0] += seconds
+                totals[name][1] += calls
+        return {name: tuple(timing) for name, timing in totals.items()}
+
+    def to_dataframe(self):
+        """Return the timings as a pandas DataFrame with one row per step and phase."""
+        import pandas as pd
+        rows = [{'Step': i, 'Phase': name, 'Seconds': seconds, 'Calls': calls}
+                for i, step in enumerate(self.steps) for name, (seconds, calls) in step.items()]
+        return pd.DataFrame(rows, columns=['Step', 'Phase', 'Seconds', 'Calls'])
+
+    def write_trace(self, path):
+        """Write the recorded events as a Chrome trace file (also readable by speedscope)."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+class ProfiledSimultaneousActivation(PhasedActivation):
+    """
+    PhasedActivation that reports the time spent in step and advance per agent class to a StepProfiler.
+    Every agent class is activated as one block, so the overhead is a few timer calls per class.
+    """
+
+    def __init__(self, model, profiler, phase_order=None):
+        super().__init__(model, phase_order)
+        self.profiler = profiler
+
+    def do_each_phase(self, method):
+        with self.profiler.phase(f'schedule.{method}'):
+            for agent_type in self.phase_order:
+                start = perf_counter()
+                agents = self.activate(agent_type, method)
+                if agents:
+                    self.profiler.record(f'schedule.{method}.{agent_type.__name__}', start, perf_counter(), len(agents))
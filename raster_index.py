@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Household to raster index table for the Flood Adaptation Model.
+
+The (row, col) of every household in a flood map only depends on the grid of the map (transform, size
+and crs), not on the depths it holds. The RasterIndexTable computes the indices once per grid, so that
+depths can be sampled from every flood map on the same grid (e.g. 'harvey', '100yr' and '500yr') by
+directly gathering from the band. Maps on another grid get their own indices.
+"""
+import numpy as np
+from rasterio.transform import rowcol
+
+
+def grid_signature(flood_map):
+    """Return a hashable description of the grid of a flood map."""
+    return tuple(flood_map.transform)[:6], flood_map.width, flood_map.height, str(flood_map.crs)
+
+
+class RasterIndexTable:
+    """
+    Cache of the raster (row, col) of every household per flood map grid.
+
+    Parameters
+    ----------
+    x, y: arrays with the household coordinates
+    """
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self._indices = {}
+
+    def index(self, flood_map):
+        """Return the arrays (row, col) of all households in the grid of flood_map."""
+        signature = grid_signature(flood_map)
+        if signature not in self._indices:
+            row, col = rowcol(flood_map.transform, self.x, self.y)
+            # same offset as get_flood_depth
+            self._indices[signature] = (np.asarray(row, dtype=np.int64) - 1, np.asarray(col, dtype=np.int64) - 1)
+        return self._indices[signature]
+
+    def sample(self, flood_map, band):
+        """Return the depth of every household in band, the band read from flood_map."""
+        row, col = self.index(flood_map)
+        return band[row, col]
+
+    def __len__(self):
+        return len(self._indices)
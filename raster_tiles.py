@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled access to flood maps that are larger than memory.
+
+A TiledRaster reads a flood map in tiles, only for the tiles that contain household locations, and
+keeps the decoded tiles in a least recently used cache with a memory limit. Sampling groups the
+requested cells by tile, so each tile is read at most once per call.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.windows import Window
+
+
+class TiledRaster:
+    """
+    Band 1 of a flood map, read per tile.
+
+    Parameters
+    ----------
+    flood_map: opened rasterio dataset
+    tile_shape: (rows, cols) of a tile, by default the block shape of the file (512 x 512 for striped files)
+    cache_bytes: maximum number of bytes of decoded tiles kept in the cache
+    """
+
+    def __init__(self, flood_map, tile_shape=None, cache_bytes=256 * 2 ** 20):
+        self.flood_map = flood_map
+        self.height = flood_map.height
+        self.width = flood_map.width
+        if tile_shape is None:
+            block_rows, block_cols = flood_map.block_shapes[0]
+            # striped files have blocks as wide as the raster, read those in square windows instead
+            tile_shape = (block_rows, block_cols) if block_cols < self.width else (512, 512)
+        self.tile_rows, self.tile_cols = tile_shape
+        self.tiles_per_row = -(-self.width // self.tile_cols)
+        self.cache_bytes = cache_bytes
+        self._tiles = OrderedDict()
+        self.nbytes = 0
+        # number of tiles read from file and number of tile requests served from the cache
+        self.tiles_read = 0
+        self.cache_hits = 0
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def read_tile(self, tile):
+        """Return the decoded tile with linear index tile, reading it from file if it is not cached."""
+        if tile in self._tiles:
+            self._tiles.move_to_end(tile)
+            self.cache_hits += 1
+            return self._tiles[tile]
+        tile_row, tile_col = divmod(tile, self.tiles_per_row)
+        row_off = tile_row * self.tile_rows
+        col_off = tile_col * self.tile_cols
+        window = Window(col_off, row_off, min(self.tile_cols, self.width - col_off), min(self.tile_rows, self.height - row_off))
+        data = self.flood_map.read(1, window=window)
+        self.tiles_read += 1
+        self._tiles[tile] = data
+        self.nbytes += data.nbytes
+        # evict the least recently used tiles, but always keep the tile that was just read
+        while self.nbytes > self.cache_bytes and len(self._tiles) > 1:
+            evicted_tile, evicted = self._tiles.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return data
+
+    def sample(self, rows, cols):
+        """
+        Return the values at the cells (rows, cols), with the same indexing rules as a numpy band
+        (negative indices count from the end).
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        rows = np.where(rows < 0, rows + self.height, rows)
+        cols = np.where(cols < 0, cols + self.width, cols)
+        if ((rows < 0) | (rows >= self.height) | (cols < 0) | (cols >= self.width)).any():
+            raise IndexError("Location outside of the flood map")
+        tiles = (rows // self.tile_rows) * self.tiles_per_row + cols // self.tile_cols
+        # visit the cells grouped by tile, so every tile is read once
+        order = np.argsort(tiles, kind='stable')
+        sorted_tiles = tiles[order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_tiles[1:] != sorted_tiles[:-1])))
+        ends = np.append(starts[1:], len(order))
+        values = np.empty(len(rows), dtype=self.flood_map.dtypes[0])
+        for start, end in zip(starts, ends):
+            tile = int(sorted_tiles[start])
+            data = self.read_tile(tile)
+            cells = order[start:end]
+            tile_row, tile_col = divmod(tile, self.tiles_per_row)
+            values[cells] = data[rows[cells] - tile_row * self.tile_rows, cols[cells] - tile_col * self.tile_cols]
+        return values
+
+    def __getitem__(self, index):
+        """Support band[rows, cols] for arrays of rows and cols."""
+        rows, cols = index
+        return self.sample(rows, cols)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler for the Flood Adaptation Model that keeps the agents partitioned by type.
+
+The PhasedActivation activates the agent types in a fixed phase order: first the step of all
+agents, type by type, then their advance, like SimultaneousActivation. Every type has its own list
+of agents in the order they were added, so the households form one contiguous list indexed by their
+node, and code that only needs one type of agent iterates over that list instead of filtering the
+mixed list of all agents.
+
+A phase function replaces calling step or advance on every agent of a type by one call with the list
+of these agents, e.g. to skip the households whose inputs did not change (see change_tracking.py).
+"""
+from mesa.time import SimultaneousActivation
+
+
+class PhasedActivation(SimultaneousActivation):
+    """
+    SimultaneousActivation that activates the agents per type in phase order.
+
+    Parameters
+    ----------
+    model: the model of the agents
+    phase_order: list of agent classes in the order in which they are activated. Types that are not
+                 in the list are activated after them, in the order their first agent was added.
+                 By default all types are activated in the order their first agent was added, which
+                 is the same order as SimultaneousActivation.
+    """
+
+    def __init__(self, model, phase_order=None):
+        super().__init__(model)
+        self.phase_order = list(phase_order or [])
+        self.agents_by_type = {agent_type: [] for agent_type in self.phase_order}
+        # phase functions by (agent type, method), see set_phase_function
+        self.phase_functions = {}
+
+    def add(self, agent):
+        super().add(agent)
+        agent_type = type(agent)
+        if agent_type not in self.agents_by_type:
+            self.agents_by_type[agent_type] = []
+            self.phase_order.append(agent_type)
+        self.agents_by_type[agent_type].append(agent)
+
+    def remove(self, agent):
+        super().remove(agent)
+        self.agents_by_type[type(agent)].remove(agent)
+
+    def agents_of_type(self, agent_type):
+        """Return the list of agents of agent_type in the order they were added, do not modify it."""
+        return self.agents_by_type.get(agent_type, [])
+
+    def get_type_count(self, agent_type):
+        """Return the number of agents of agent_type."""
+        return len(self.agents_of_type(agent_type))
+
+    def set_phase_function(self, agent_type, method, function):
+        """
+        Activate the agents of agent_type in phase method ('step' or 'advance') with one call function(agents),
+        with the list of the agents in the order they were added, instead of calling method on every agent.
+        """
+        self.phase_functions[(agent_type, method)] = function
+
+    def activate(self, agent_type, method):
+        """Call method on all agents of agent_type, or their phase function, and return the activated agents."""
+        # copy, so that agents can be added or removed during the phase
+        agents = list(self.agents_by_type[agent_type])
+        function = self.phase_functions.get((agent_type, method))
+        if function is not None:
+            function(agents)
+        else:
+            for agent in agents:
+                getattr(agent, method)()
+        return agents
+
+    def do_each_phase(self, method):
+        """Call method on all agents, type by type in phase order."""
+        for agent_type in self.phase_order:
+            self.activate(agent_type, method)
+
+    def step(self):
+        """Step all agents, then advance them, both in phase order."""
+        self.do_each_phase('step')
+        self.do_each_phase('advance')
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Surrogate emulator of the Flood Adaptation Model.
+
+A Surrogate is trained on stored sweep results (e.g. the CSV written by run_experiment) and predicts
+model outputs per step, with an uncertainty estimate, for new combinations of parameters such as
+political_situation, welfare and scenarioNO in milliseconds. The step is an input of the emulator,
+so a query can return a whole trajectory. Outputs are model reporters, or agent reporters averaged
+over the households (e.g. the mean FloodDamageActual). Where the uncertainty of the emulator is too
+high, refine runs the real model for those points and retrains on the new results.
+"""
+import random
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, RBF, WhiteKernel
+from sklearn.preprocessing import StandardScaler
+
+from model import AdaptationModel
+
+
+def training_data_from_sweep(results, parameters, outputs):
+    """
+    Reduce batch run results, with one row per agent and step, to one row per run and step.
+
+    Parameters
+    ----------
+    results: DataFrame as returned by run_experiment or read from its CSV file
+    parameters: names of the parameter columns that are the inputs of the emulator
+    outputs: names of the output columns. Model reporters have the same value on all rows of a step,
+             agent reporters are averaged over the agents that report them (the households)
+
+    Returns
+    -------
+    data: DataFrame with the columns RunId, Step, the parameters and the outputs
+    """
+    grouped = results.groupby(['RunId', 'Step'])
+    data = grouped[list(parameters)].first()
+    for output in outputs:
+        data[output] = grouped[output].mean()
+    return data.reset_index()
+
+
+def run_point(task):
+    """
+    Run the model for one parameter combination and return its rows in the format of training_data_from_sweep.
+
+    Parameters
+    ----------
+    task: (run id, model class, model keyword arguments, parameter names, output names, max_steps, seed)
+    """
+    run_id, model_cls, kwargs, parameters, outputs, max_steps, seed = task
+    # the agents also draw from the random module, seed it so that every run is reproducible
+    random.seed(seed)
+    model = model_cls(seed=seed, **kwargs)
+    for _ in range(max_steps):
+        model.step()
+    datacollector = model.datacollector
+    data = pd.DataFrame({'Step': datacollector.model_steps})
+    model_data = datacollector.get_model_vars_dataframe()
+    agent_data = datacollector.get_agent_vars_dataframe()
+    for output in outputs:
+        if output in datacollector.model_reporters:
+            data[output] = model_data[output].to_numpy()
+        else:
+            means = pd.to_numeric(agent_data[output], errors='coerce').groupby(level='Step').mean()
+            data[output] = means.reindex(data['Step']).to_numpy()
+    data.insert(0, 'RunId', run_id)
+    for name in parameters:
+        data[name] = kwargs[name]
+    return data
+
+
+class Surrogate:
+    """
+    Emulator of model outputs per step as a function of the parameters.
+
+    Parameters
+    ----------
+    parameters: names of the parameters that are inputs of the emulator
+    outputs: names of the outputs, see training_data_from_sweep
+    method: 'gp' for a Gaussian process per output, with the predictive standard deviation as uncertainty,
+            or 'gbr' for gradient boosting with the half width of the 16-84% quantile range as uncertainty
+    max_training_rows: the Gaussian process is trained on a random subset of at most this many rows
+    seed: seed of the subsampling and the regressors
+    """
+
+    def __init__(self, parameters, outputs, method='gp', max_training_rows=2000, seed=0):
+        if method not in ('gp', 'gbr'):
+            raise ValueError(f"Unknown surrogate method: '{method}'. Use 'gp' or 'gbr'")
+        self.parameters = list(parameters)
+        self.outputs = list(outputs)
+        self.method = method
+        self.max_training_rows = max_training_rows
+        self.seed = seed
+        self.data = None
+        self._scaler = None
+        self._regressors = {}
+
+    @property
+    def features(self):
+        return self.parameters + ['Step']
+
+    def fit(self, data):
+        """Train the emulator on data in the format of training_data_from_sweep, replacing earlier training data."""
+        self.data = data.reset_index(drop=True)
+        self._scaler = StandardScaler().fit(self.data[self.features].to_numpy(dtype=np.float64))
+        rng = np.random.default_rng(self.seed)
+        for output in self.outputs:
+            rows = self.data[self.data[output].notna()]
+            if self.method == 'gp' and len(rows) > self.max_training_rows:
+                rows = rows.iloc[np.sort(rng.choice(len(rows), self.max_training_rows, replace=False))]
+            x = self._scaler.transform(rows[self.features].to_numpy(dtype=np.float64))
+            y = rows[output].to_numpy(dtype=np.float64)
+            if self.method == 'gp':
+                kernel = ConstantKernel() * RBF(length_scale=np.ones(len(self.features))) + WhiteKernel()
+                regressor = GaussianProcessRegressor(kernel, normalize_y=True, random_state=self.seed).fit(x, y)
+                self._regressors[output] = regressor
+            else:
+                self._regressors[output] = [GradientBoostingRegressor(loss='quantile', alpha=alpha, random_state=self.seed).fit(x, y)
+                                            for alpha in (0.16, 0.5, 0.84)]
+        return self
+
+    @classmethod
+    def from_sweep(cls, results, parameters, outputs, **kwargs):
+        """Train an emulator on batch run results, a DataFrame or the path of the CSV file written by run_experiment."""
+        if isinstance(results, str):
+            results = pd.read_csv(results)
+        return cls(parameters, outputs, **kwargs).fit(training_data_from_sweep(results, parameters, outputs))
+
+    def predict(self, points):
+        """
+        Return the predicted mean and uncertainty of every output.
+
+        Parameters
+        ----------
+        points: DataFrame (or list of dictionaries) with a column per parameter and the column Step
+
+        Returns
+        -------
+        prediction: DataFrame with the points and per output the columns <output> and <output>_std
+        """
+        points = pd.DataFrame(points).reset_index(drop=True)
+        x = self._scaler.transform(points[self.features].to_numpy(dtype=np.float64))
+        prediction = points.copy()
+        for output in self.outputs:
+            if self.method == 'gp':
+                mean, std = self._regressors[output].predict(x, return_std=True)
+            else:
+                low, mean, high = (regressor.predict(x) for regressor in self._regressors[output])
+                std = np.abs(high - low) / 2
+            prediction[output] = mean
+            prediction[output + '_std'] = std
+        return prediction
+
+    def trajectory(self, steps, **parameters):
+        """Return the predicted outputs at steps for one combination of parameters, e.g. trajectory(range(20), welfare=0.3, ...)."""
+        return self.predict([dict(parameters, Step=step) for step in steps])
+
+    def uncertain(self, prediction, max_std):
+        """Return a boolean array marking the rows of a prediction of which the uncertainty of any output exceeds max_std."""
+        if not isinstance(max_std, dict):
+            max_std = {output: max_std for output in self.outputs}
+        mask = np.zeros(len(prediction), dtype=bool)
+        for output, limit in max_std.items():
+            mask |= prediction[output + '_std'].to_numpy() > limit
+        return mask
+
+    def refine(self, points, max_std, model_parameters=None, model_cls=AdaptationModel, max_steps=20,
+               number_processes=None, seed=0):
+        """
+        Predict the outputs at points and run the real model for the parameter combinations whose uncertainty
+        exceeds max_std. The new runs are added to the training data and the emulator is retrained.
+
+        Parameters
+        ----------
+        points: DataFrame or list of dictionaries with the parameters and Step
+        max_std: uncertainty limit, for all outputs or a dictionary per output
+        model_parameters: fixed keyword arguments of the model, e.g. number_of_households
+        model_cls, max_steps: model class and number of steps of the real runs
+        number_processes: number of worker processes, None for all cores, 1 to run in this process
+        seed: run i of this call uses seed + i
+
+        Returns
+        -------
+        prediction: the prediction at points after retraining
+        runs: DataFrame with the results of the real runs, empty if the emulator was certain enough
+        """
+        prediction = self.predict(points)
+        combinations = prediction.loc[self.uncertain(prediction, max_std), self.parameters].drop_duplicates()
+        if combinations.empty:
+            return prediction, combinations
+        first_run_id = int(self.data['RunId'].max()) + 1 if self.data is not None and len(self.data) else 0
+        tasks = []
+        for i, values in enumerate(combinations.to_dict('records')):
+            kwargs = dict(model_parameters or {}, **values)
+            tasks.append((first_run_id + i, model_cls, kwargs, self.parameters, self.outputs, max_steps, seed + i))
+        if number_processes == 1:
+            runs = [run_point(task) for task in tasks]
+        else:
+            with Pool(number_processes) as pool:
+                runs = pool.map(run_point, tasks)
+        runs = pd.concat(runs, ignore_index=True)
+        self.fit(pd.concat([self.data, runs], ignore_index=True) if self.data is not None else runs)
+        return self.predict(points), runs
+
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-node sweeps of the Flood Adaptation Model through a shared work queue.
+
+A coordinator shards the parameter grid of a sweep into work units of a few runs each. Workers on any
+number of machines claim units atomically, run them, and write the results of every unit as a Parquet
+file to the results directory of the queue. Claimed units are kept alive by a heartbeat; units whose
+worker stopped sending heartbeats are put back in the queue by the next worker that looks for work.
+A worker whose heartbeat finds that its claim was lost abandons the unit after its current run, and
+only the worker that holds the claim of a unit stores its results.
+
+Two queues are available, with the same interface:
+- DirectoryWorkQueue: a directory on a shared file system. A unit is a JSON file that moves between the
+  subdirectories pending, claimed and done by atomic renames, the modification time of a claimed unit is its heartbeat.
+- SQLiteWorkQueue: a SQLite database, for sweeps on one machine or as a stand-in for a broker.
+  It stores its results next to the database.
+
+Usage:
+    python sweep_queue.py create QUEUE spec.json   (spec as for the job service, plus "runs_per_unit")
+    python sweep_queue.py work QUEUE               (on every worker node)
+    python sweep_queue.py status QUEUE
+    python sweep_queue.py collect QUEUE results.csv
+QUEUE is a directory, or a file ending in .sqlite or .db for the SQLiteWorkQueue.
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from mesa.batchrunner import _make_model_kwargs
+
+from experiment_runner import run_model_run, write_results
+
+
+def shard_sweep(spec):
+    """
+    Return the work units of a sweep.
+
+    Parameters
+    ----------
+    spec: dictionary with the batch_run 'parameters', 'iterations', 'max_steps', 'data_collection_period',
+          'input_preset' (see the job service) and 'runs_per_unit'
+
+    Returns
+    -------
+    units: list of dictionaries with the unit id, the runs (run id, iteration, model keyword arguments) and the run settings
+    """
+    runs = [(run_id, iteration, kwargs) for run_id, (iteration, kwargs)
+            in enumerate(itertools.product(range(spec.get('iterations', 1)), _make_model_kwargs(spec.get('parameters', {}))))]
+    runs_per_unit = spec.get('runs_per_unit', 1)
+    settings = {'max_steps': spec.get('max_steps', 19), 'data_collection_period': spec.get('data_collection_period', 1),
+                'input_preset': spec.get('input_preset')}
+    return [dict(settings, unit_id=f"unit-{i:06d}", runs=runs[start:start + runs_per_unit])
+            for i, start in enumerate(range(0, len(runs), runs_per_unit))]
+
+
+class DirectoryWorkQueue:
+    """
+    Work queue in a directory on a shared file system, see the module docstring.
+
+    Parameters
+    ----------
+    directory: root directory of the queue
+    heartbeat_timeout: seconds without heartbeat after which a claimed unit is put back in the queue
+    """
+
+    def __init__(self, directory, heartbeat_timeout=300):
+        self.directory = directory
+        self.heartbeat_timeout = heartbeat_timeout
+        for name in ('pending', 'claimed', 'done', 'results'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def _path(self, state, name):
+        return os.path.join(self.directory, state, name)
+
+    def create(self, units):
+        """Add the units to the queue."""
+        for unit in units:
+            path = self._path('pending', unit['unit_id'] + '.json')
+            with open(path + '.partial', 'w') as f:
+                json.dump(unit, f)
+            os.replace(path + '.partial', path)
+
+    def claim(self, worker_id):
+        """Claim a pending unit and return it, None if no unit is pending."""
+        for name in sorted(os.listdir(self._path('pending', ''))):
+            if not name.endswith('.json'):
+                continue
+            unit_id = name[:-len('.json')]
+            claimed = self._path('claimed', f"{unit_id}@{worker_id}.json")
+            try:
+                # the claim time is the first heartbeat, set it before the rename so that a claimed unit is never
+                # seen as stale. The rename succeeds for exactly one worker
+                os.utime(self._path('pending', name))
+                os.rename(self._path('pending', name), claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed) as f:
+                return json.load(f)
+        return None
+
+    def heartbeat(self, unit_id, worker_id):
+        """Mark a claimed unit as alive, return False if the claim was lost."""
+        try:
+            os.utime(self._path('claimed', f"{unit_id}@{worker_id}.json"))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, unit_id, worker_id, rows):
+        """Store the results of a claimed unit and mark it as done, return False if the claim was lost."""
+        claimed = self._path('claimed', f"{unit_id}@{worker_id}.json")
+        if not os.path.exists(claimed):
+            return False
+        write_results(self._path('results', unit_id + '.parquet'), rows)
+        try:
+            os.rename(claimed, self._path('done', unit_id + '.json'))
+        except FileNotFoundError:
+            # the claim was re-issued after the check, the results are the same whichever worker stores them
+            return False
+        return True
+
+    def requeue_stale(self):
+        """Put claimed units without a recent heartbeat back in the queue, return how many."""
+        requeued = 0
+        now = time.time()
+        for name in os.listdir(self._path('claimed', '')):
+            path = self._path('claimed', name)
+            try:
+                stale = now - os.path.getmtime(path) > self.heartbeat_timeout
+                if stale:
+                    os.rename(path, self._path('pending', name.split('@')[0] + '.json'))
+                    requeued += 1
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def counts(self):
+        """Return the number of pending, claimed and done units."""
+        return {state: sum(name.endswith('.json') for name in os.listdir(self._path(state, '')))
+                for state in ('pending', 'claimed', 'done')}
+
+    def result_paths(self):
+        return sorted(glob.glob(self._path('results', '*.parquet')))
+
+
+class SQLiteWorkQueue:
+    """
+    Work queue in a SQLite database, see the module docstring. The results are written to the
+    directory <database>_results.
+
+    Parameters
+    ----------
+    path: path of the database file
+    heartbeat_timeout: seconds without heartbeat after which a claimed unit is put back in the queue
+    """
+
+    def __init__(self, path, heartbeat_timeout=300):
+        self.path = path
+        self.heartbeat_timeout = heartbeat_timeout
+        self.results_directory = os.path.splitext(path)[0] + '_results'
+        os.makedirs(self.results_directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS units (unit_id TEXT PRIMARY KEY, unit TEXT NOT NULL, "
+                               "state TEXT NOT NULL DEFAULT 'pending', worker TEXT, heartbeat REAL)")
+
+    @contextmanager
+    def _connect(self):
+        # autocommit mode, transactions are started explicitly with BEGIN IMMEDIATE
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def create(self, units):
+        with self._connect() as connection:
+            connection.executemany("INSERT OR IGNORE INTO units (unit_id, unit) VALUES (?, ?)",
+                                   [(unit['unit_id'], json.dumps(unit)) for unit in units])
+
+    def claim(self, worker_id):
+        with self._connect() as connection:
+            # take the write lock before reading, so that no other worker claims the same unit
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT unit_id, unit FROM units WHERE state = 'pending' ORDER BY unit_id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE units SET state = 'claimed', worker = ?, heartbeat = ? WHERE unit_id = ?",
+                                   (worker_id, time.time(), row[0]))
+            connection.execute("COMMIT")
+        return None if row is None else json.loads(row[1])
+
+    def heartbeat(self, unit_id, worker_id):
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE units SET heartbeat = ? WHERE unit_id = ? AND state = 'claimed' AND worker = ?",
+                                        (time.time(), unit_id, worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, worker_id, rows):
+        with self._connect() as connection:
+            # hold the write lock while the results are stored, so that the claim cannot be re-issued in the meantime
+            connection.execute("BEGIN IMMEDIATE")
+            claimed = connection.execute("SELECT 1 FROM units WHERE unit_id = ? AND state = 'claimed' AND worker = ?",
+                                         (unit_id, worker_id)).fetchone() is not None
+            if claimed:
+                write_results(os.path.join(self.results_directory, unit_id + '.parquet'), rows)
+                connection.execute("UPDATE units SET state = 'done', heartbeat = ? WHERE unit_id = ? AND worker = ?",
+                                   (time.time(), unit_id, worker_id))
+            connection.execute("COMMIT")
+        return claimed
+
+    def requeue_stale(self):
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE units SET state = 'pending', worker = NULL WHERE state = 'claimed' AND heartbeat < ?",
+                                        (time.time() - self.heartbeat_timeout,))
+        return cursor.rowcount
+
+    def counts(self):
+        with self._connect() as connection:
+            counts = dict(connection.execute("SELECT state, COUNT(*) FROM units GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ('pending', 'claimed', 'done')}
+
+    def result_paths(self):
+        return sorted(glob.glob(os.path.join(self.results_directory, '*.parquet')))
+
+
+def open_queue(location, heartbeat_timeout=300):
+    """Return the SQLiteWorkQueue for a .sqlite or .db file, otherwise the DirectoryWorkQueue of the directory."""
+    if location.endswith(('.sqlite', '.db')):
+        return SQLiteWorkQueue(location, heartbeat_timeout)
+    return DirectoryWorkQueue(location, heartbeat_timeout)
+
+
+def run_worker(queue, worker_id=None, heartbeat_interval=30, wait=False, poll_interval=10, metrics_sink=None):
+    """
+    Claim and run units until the queue is empty, return the number of units this worker completed.
+
+    Parameters
+    ----------
+    queue: DirectoryWorkQueue or SQLiteWorkQueue
+    worker_id: name of this worker, by default the host name and process id
+    heartbeat_interval: seconds between the heartbeats of the claimed unit, must be well below the heartbeat timeout
+    wait: keep waiting for units while other workers still have claimed units (which may be re-issued)
+    poll_interval: seconds between looks at the queue while waiting
+    metrics_sink: sink to which the runs publish their step metrics, see metrics.py
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    completed = 0
+    while True:
+        unit = queue.claim(worker_id)
+        if unit is None and queue.requeue_stale():
+            unit = queue.claim(worker_id)
+        if unit is None:
+            if wait and queue.counts()['claimed']:
+                time.sleep(poll_interval)
+                continue
+            return completed
+
+        # send heartbeats from a thread, so that long runs keep their claim. The thread stops when the claim was lost
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def send_heartbeats(unit_id=unit['unit_id']):
+            while not stop.wait(heartbeat_interval):
+                if not queue.heartbeat(unit_id, worker_id):
+                    lost.set()
+                    return
+
+        heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+        try:
+            rows = []
+            for run in unit['runs']:
+                if lost.is_set():
+                    # another worker claimed the unit again, leave it to that worker
+                    break
+                rows.extend(run_model_run(run, unit['max_steps'], unit['data_collection_period'], unit['input_preset'],
+                                          metrics_sink=metrics_sink))
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+        if not lost.is_set() and queue.complete(unit['unit_id'], worker_id, rows):
+            completed += 1
+
+
+def collect_results(queue):
+    """Return the results of all completed units as one DataFrame, ordered by run and step."""
+    paths = queue.result_paths()
+    if not paths:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True).sort_values(['RunId', 'Step'], kind='stable')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-node sweeps of the flood adaptation model through a shared work queue.")
+    parser.add_argument("--heartbeat-timeout", type=float, default=300, help="seconds after which a silent claim is re-issued")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="shard the sweep in a JSON spec file into units")
+    create.add_argument("queue")
+    create.add_argument("spec")
+    work = commands.add_parser("work", help="run units until the queue is empty")
+    work.add_argument("queue")
+    work.add_argument("--worker-id", default=None)
+    work.add_argument("--wait", action="store_true", help="wait for units claimed by other workers to finish or be re-issued")
+    work.add_argument("--metrics", default=None, metavar="SINK",
+                      help="publish the step metrics of every run, e.g. to 'udp://HOST:PORT' of a MetricsServer, see metrics.py")
+    status = commands.add_parser("status", help="show the number of pending, claimed and done units")
+    status.add_argument("queue")
+    collect = commands.add_parser("collect", help="write the results of all completed units to a CSV file")
+    collect.add_argument("queue")
+    collect.add_argument("output_path")
+    args = parser.parse_args(argv)
+
+    queue = open_queue(args.queue, args.heartbeat_timeout)
+    if args.command == "create":
+        with open(args.spec) as f:
+            units = shard_sweep(json.load(f))
+        queue.create(units)
+        print(f"{len(units)} units created")
+    elif args.command == "work":
+        # heartbeats at a tenth of the timeout leave room for slow shared file systems
+        print(f"{run_worker(queue, args.worker_id, heartbeat_interval=args.heartbeat_timeout / 10, wait=args.wait, metrics_sink=args.metrics)} units completed")
+    elif args.command == "status":
+        print(queue.counts())
+    elif args.command == "collect":
+        collect_results(queue).to_csv(args.output_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sweeps and of the household change tracking on the synthetic 'small' inputs, run with `python -m pytest test_sweeps.py`.
+"""
+import json
+import random
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import experiment_runner
+import sweep_queue
+from experiment_runner import RunJournal, run_journaled, run_key, sweep_runs
+from input_providers import SyntheticInputProvider, get_preset_input_provider
+from model import AdaptationModel
+from sweep_queue import DirectoryWorkQueue, SQLiteWorkQueue, collect_results, run_worker, shard_sweep
+
+# a sweep that runs in about a second
+SWEEP_PARAMETERS = {'number_of_households': 10, 'seed': 1, 'political_situation': [0.05, 0.95]}
+MAX_STEPS = 2
+
+
+@pytest.fixture
+def input_provider():
+    return get_preset_input_provider('small')
+
+
+@pytest.fixture(params=['directory', 'sqlite'])
+def open_work_queue(request, tmp_path):
+    """Return a function that opens the work queue in tmp_path with a heartbeat timeout, of both queue types."""
+    if request.param == 'directory':
+        return lambda heartbeat_timeout=300: DirectoryWorkQueue(str(tmp_path / 'queue'), heartbeat_timeout)
+    return lambda heartbeat_timeout=300: SQLiteWorkQueue(str(tmp_path / 'queue.sqlite'), heartbeat_timeout)
+
+
+def run_sweep(journal, parameters):
+    return run_journaled(journal, AdaptationModel, parameters, iterations=1, max_steps=MAX_STEPS,
+                         data_collection_period=1, display_progress=False)
+
+
+def count_runs(monkeypatch):
+    """Count the runs that run_journaled runs, in a list that grows with every call of iterate_runs."""
+    numbers_of_runs = []
+    iterate_runs = experiment_runner.iterate_runs
+
+    def counting_iterate_runs(runs, *args, **kwargs):
+        numbers_of_runs.append(len(runs))
+        return iterate_runs(runs, *args, **kwargs)
+
+    monkeypatch.setattr(experiment_runner, 'iterate_runs', counting_iterate_runs)
+    return numbers_of_runs
+
+
+def test_journal_resumes_without_running_finished_runs(tmp_path, monkeypatch, input_provider):
+    journal = RunJournal(str(tmp_path / 'sweep.journal'))
+    parameters = dict(SWEEP_PARAMETERS, input_provider=input_provider)
+    numbers_of_runs = count_runs(monkeypatch)
+    first = run_sweep(journal, parameters)
+    second = run_sweep(journal, parameters)
+    assert numbers_of_runs == [2, 0]
+    assert sorted(first['RunId'].unique()) == [0, 1]
+    assert first.equals(second)
+
+
+def test_journal_recovers_from_a_torn_line(tmp_path, monkeypatch, input_provider):
+    journal = RunJournal(str(tmp_path / 'sweep.journal'))
+    parameters = dict(SWEEP_PARAMETERS, input_provider=input_provider)
+    run_sweep(journal, parameters)
+    # cut the last entry off halfway, as a crash while appending it would
+    with open(journal.path, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    with open(journal.path, 'wb') as f:
+        f.write(lines[0] + lines[1][:len(lines[1]) // 2])
+    assert len(journal.completed()) == 1
+
+    numbers_of_runs = count_runs(monkeypatch)
+    results = run_sweep(journal, parameters)
+    assert numbers_of_runs == [1]
+    assert sorted(results['RunId'].unique()) == [0, 1]
+    # the new entry starts on its own line after the torn one
+    with open(journal.path) as f:
+        entries = f.read().splitlines()
+    assert len(entries) == 3
+    assert json.loads(entries[2])['run_id'] == 1
+    assert len(journal.completed()) == 2
+
+
+def test_journal_keys_runs_with_different_providers_apart(tmp_path, monkeypatch, input_provider):
+    journal = RunJournal(str(tmp_path / 'sweep.journal'))
+    providers = [input_provider, SyntheticInputProvider.from_preset('small', seed=1)]
+    parameters = {'number_of_households': 10, 'seed': 1, 'input_provider': providers}
+    runs = sweep_runs(parameters, 1)
+    assert len({run_key(iteration, kwargs) for _, iteration, kwargs in runs}) == 2
+
+    numbers_of_runs = count_runs(monkeypatch)
+    results = run_sweep(journal, parameters)
+    assert numbers_of_runs == [2]
+    assert sorted(results['RunId'].unique()) == [0, 1]
+    # with only the first provider, its run is found in the journal
+    assert run_sweep(journal, dict(parameters, input_provider=providers[:1])).equals(results[results['RunId'] == 0])
+    assert numbers_of_runs == [2, 0]
+
+
+def test_run_key_rejects_objects_without_cache_key():
+    with pytest.raises(TypeError):
+        run_key(0, {'damage_curve': object()})
+
+
+def test_queue_claims_every_unit_once(open_work_queue):
+    queue = open_work_queue()
+    queue.create([{'unit_id': f"unit-{i:06d}", 'runs': []} for i in range(40)])
+    claims = {}
+
+    def claim_all(worker_id):
+        claims[worker_id] = []
+        while (unit := queue.claim(worker_id)) is not None:
+            claims[worker_id].append(unit['unit_id'])
+
+    workers = [threading.Thread(target=claim_all, args=(f"worker-{i}",)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    claimed = [unit_id for unit_ids in claims.values() for unit_id in unit_ids]
+    assert sorted(claimed) == [f"unit-{i:06d}" for i in range(40)]
+    assert queue.counts() == {'pending': 0, 'claimed': 40, 'done': 0}
+
+
+def test_queue_requeues_stale_claims(open_work_queue):
+    queue = open_work_queue(heartbeat_timeout=0.5)
+    queue.create([{'unit_id': 'unit-000000', 'runs': []}])
+    assert queue.claim('lost')['unit_id'] == 'unit-000000'
+    assert queue.requeue_stale() == 0
+    time.sleep(1)
+    assert queue.requeue_stale() == 1
+    assert queue.claim('other')['unit_id'] == 'unit-000000'
+    # the worker that lost the claim learns so from its next heartbeat
+    assert not queue.heartbeat('unit-000000', 'lost')
+    assert queue.heartbeat('unit-000000', 'other')
+    assert queue.counts() == {'pending': 0, 'claimed': 1, 'done': 0}
+
+
+def test_queue_worker_runs_all_units(open_work_queue):
+    queue = open_work_queue()
+    queue.create(shard_sweep({'parameters': SWEEP_PARAMETERS, 'iterations': 2, 'max_steps': MAX_STEPS,
+                              'input_preset': 'small', 'runs_per_unit': 3}))
+    assert run_worker(queue, 'worker') == 2
+    assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 2}
+    assert sorted(collect_results(queue)['RunId'].unique()) == [0, 1, 2, 3]
+
+
+def test_queue_worker_abandons_a_lost_unit(open_work_queue, monkeypatch):
+    queue = open_work_queue(heartbeat_timeout=0.2)
+    queue.create(shard_sweep({'parameters': SWEEP_PARAMETERS, 'input_preset': 'small', 'runs_per_unit': 2}))
+    runs = []
+
+    def lose_claim(run, *args, **kwargs):
+        # the worker stalls until its claim is re-issued to another worker, its next heartbeat then fails
+        runs.append(run[0])
+        time.sleep(0.3)
+        assert queue.requeue_stale() == 1
+        assert queue.claim('other') is not None
+        time.sleep(0.5)
+        return []
+
+    monkeypatch.setattr(sweep_queue, 'run_model_run', lose_claim)
+    assert run_worker(queue, 'worker', heartbeat_interval=0.5) == 0
+    assert runs == [0]
+    assert queue.counts() == {'pending': 0, 'claimed': 1, 'done': 0}
+    assert queue.result_paths() == []
+
+
+def test_queue_only_completes_units_of_their_worker(open_work_queue):
+    queue = open_work_queue()
+    queue.create([{'unit_id': 'unit-000000', 'runs': []}, {'unit_id': 'unit-000001', 'runs': []}])
+    queue.claim('worker')
+    rows = [{'RunId': 0, 'Step': 0}]
+    assert not queue.complete('unit-000000', 'other', rows)
+    assert not queue.complete('unit-000001', 'worker', rows)
+    assert queue.counts() == {'pending': 1, 'claimed': 1, 'done': 0}
+    assert queue.result_paths() == []
+    assert queue.complete('unit-000000', 'worker', rows)
+    assert queue.counts() == {'pending': 1, 'claimed': 0, 'done': 1}
+
+
+def run_households(steps, **kwargs):
+    """Run a model with 30 households on an Erdos-Renyi network, on which the political perceptions settle exactly."""
+    random.seed(3)
+    model = AdaptationModel(seed=1, number_of_households=30, network='erdos_renyi',
+                            input_provider=get_preset_input_provider('small'), **kwargs)
+    updated_in_step = []
+    for _ in range(steps):
+        model.step()
+        if model.change_tracker is not None:
+            updated_in_step.append(model.change_tracker.updated_in_step)
+    return model, updated_in_step
+
+
+def test_skipping_unchanged_households_is_bit_identical():
+    reference, _ = run_households(100)
+    model, updated_in_step = run_households(100, skip_unchanged_households=True)
+    # the perceptions settle after about 50 steps, from then on the step phase skips households
+    assert min(updated_in_step) < 30
+    for name, column in reference.household_state.columns.items():
+        assert np.array_equal(column, model.household_state.columns[name]), name
+    assert reference.datacollector.get_model_vars_dataframe().equals(model.datacollector.get_model_vars_dataframe())
+    assert reference.datacollector.get_agent_vars_dataframe().equals(model.datacollector.get_agent_vars_dataframe())
+
+
+def test_skipped_households_verify():
+    # raises an AssertionError when the update of a skipped household would change it
+    _, updated_in_step = run_households(100, skip_unchanged_households='verify')
+    assert min(updated_in_step) < 30
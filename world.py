@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+World initialisation for the Flood Adaptation Model.
+
+The world holds everything about a model that only depends on the seed, the number of households,
+the network settings and the flood map: the social network and, per household, the location,
+whether it lies in the floodplain, the estimated flood depth and the value of the house.
+Worlds can be cached on disk as .npy files and are memory-mapped when reused, so that runs that only
+differ in e.g. political_situation, welfare or scenarioNO skip the construction of the world.
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+from shapely import contains_xy
+
+from network import CSRNetwork
+from raster_index import RasterIndexTable
+from functions import generate_random_locations_within_map_domain
+
+# bump when the way worlds are built changes, so that old cache entries are not reused
+WORLD_FORMAT_VERSION = 1
+
+WORLD_ARRAYS = ['indptr', 'indices', 'x', 'y', 'in_floodplain', 'flood_depth_estimated', 'value_house']
+
+# model arguments the world depends on, see world_cache_key
+WORLD_PARAMETERS = ['seed', 'number_of_households', 'network', 'probability_of_network_connection', 'number_of_edges',
+                    'number_of_nearest_neighbours', 'flood_map_choice', 'input_provider']
+
+
+class World:
+    """
+    Static world of a model, see the module docstring.
+    All per household arrays are indexed by the node of the household in the social network.
+    The raster_indices hold the flood map (row, col) of all households, they are not stored in the cache.
+    """
+
+    def __init__(self, network, x, y, in_floodplain, flood_depth_estimated, value_house):
+        self.network = network
+        self.x = x
+        self.y = y
+        self.in_floodplain = in_floodplain
+        self.flood_depth_estimated = flood_depth_estimated
+        self.value_house = value_house
+        self.raster_indices = RasterIndexTable(x, y)
+
+    @property
+    def number_of_households(self):
+        return self.network.number_of_nodes
+
+    def save(self, directory):
+        """Write the world to directory as one .npy file per array, the directory is replaced atomically."""
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        partial_directory = tempfile.mkdtemp(dir=parent, prefix='.partial_world_')
+        arrays = {'indptr': self.network.indptr, 'indices': self.network.indices, 'x': self.x, 'y': self.y,
+                  'in_floodplain': self.in_floodplain, 'flood_depth_estimated': self.flood_depth_estimated,
+                  'value_house': self.value_house}
+        for name, array in arrays.items():
+            np.save(os.path.join(partial_directory, name + '.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(partial_directory, 'world.json'), 'w') as f:
+            json.dump({'version': WORLD_FORMAT_VERSION, 'number_of_households': self.number_of_households}, f)
+        try:
+            os.rename(partial_directory, directory)
+        except OSError:
+            # another process stored the same world in the meantime
+            shutil.rmtree(partial_directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load a world written by save, the arrays are memory-mapped unless mmap_mode is None."""
+        with open(os.path.join(directory, 'world.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != WORLD_FORMAT_VERSION:
+            raise ValueError(f"World in '{directory}' has format version {meta['version']}, expected {WORLD_FORMAT_VERSION}")
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in WORLD_ARRAYS}
+        network = CSRNetwork(meta['number_of_households'], arrays.pop('indptr'), arrays.pop('indices'))
+        return cls(network, **arrays)
+
+
+def build_world(model):
+    """
+    Build the world of a model: the social network and the placement of all households.
+
+    Parameters
+    ----------
+    model: AdaptationModel with its network settings and maps initialised
+
+    Returns
+    -------
+    world: the World of the model
+    """
+    network = model.initialize_network()
+    # placements use their own random stream, so that they do not depend on the network type. Without a seed
+    # the stream is seeded from the random module, so that random.seed fixes the world as it did before
+    rng = np.random.default_rng(random.getrandbits(64) if model.seed is None else [model.seed, 1])
+    n = network.number_of_nodes
+    # determine value of house to convert flood damages to monetary damages
+    value_house = rng.integers(200, 1500, size=n) * 1000
+    # random locations on the map and whether they are within the floodplain
+    x, y = generate_random_locations_within_map_domain(model.map_domain_polygon, n, rng)
+    in_floodplain = contains_xy(model.floodplain_multipolygon, x, y)
+    world = World(network, x, y, in_floodplain, None, value_house)
+    # estimated flood depth at those coordinates, based on the flood map
+    world.flood_depth_estimated = world.raster_indices.sample(model.flood_map, model.get_flood_band(model.flood_map_choice)).astype(np.float64)
+    return world
+
+
+def world_cache_key(model, flood_map_choice):
+    """Return the cache key of the world of a model, None if the world is not reproducible (no seed)."""
+    if model.seed is None:
+        return None
+    settings = (WORLD_FORMAT_VERSION, model.seed, model.number_of_households, model.network,
+                model.probability_of_network_connection, model.number_of_edges, model.number_of_nearest_neighbours,
+                flood_map_choice, model.input_provider.cache_key())
+    return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+
+def preload_world(model):
+    """
+    Keep the world of a model in memory for all models with the same world created in this process,
+    and in processes forked from it (see fork_server.py). The world is shared, models only read it.
+    """
+    key = world_cache_key(model, model.flood_map_choice)
+    if key is None:
+        raise ValueError("Only the world of a model with a seed can be preloaded")
+    _preloaded_worlds[key] = model.world
+
+
+def load_or_build_world(model, flood_map_choice, cache_directory=None):
+    """
+    Return the world of a model, a preloaded world or from the cache in cache_directory if present.
+    A newly built world is stored in the cache. Without cache_directory or seed the world is always built.
+    """
+    key = world_cache_key(model, flood_map_choice)
+    if key is not None and key in _preloaded_worlds:
+        return _preloaded_worlds[key]
+    if cache_directory is None or key is None:
+        return build_world(model)
+    directory = os.path.join(cache_directory, key)
+    if os.path.exists(os.path.join(directory, 'world.json')):
+        return World.load(directory)
+    world = build_world(model)
+    world.save(directory)
+    return world
+
+
+# worlds kept in memory by preload_world, by their cache key
+_preloaded_worlds = {}